@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+"""
+Time and peak memory of writing an Atom feed of many entries, by building
+and validating the whole feed before writing it (as Feed used to on every
+request) and by streaming it with Feed.stream.
+
+    python benchmarks/atom.py [entries]
+
+Each run happens in a forked process, and reports how far that process's
+peak RSS grew while writing the feed.
+"""
+import os
+import resource
+import sys
+import time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from django.conf import settings
+settings.configure()
+
+from eventtools.feeds.atom import Feed
+
+class Booking(object):
+    def __init__(self, i):
+        self.id = i
+        self.start = datetime(2010, 1, 1, 9, 0) + timedelta(hours=7 * i)
+        self.title = u'Booking %s, with a description long enough to matter \u2013 perhaps' % i
+
+class UpcomingFeed(Feed):
+    feed_id = 'upcoming'
+    feed_title = 'Upcoming bookings'
+    feed_authors = [{'name': 'Bookings'}]
+    feed_updated = datetime(2010, 1, 1)
+
+    def __init__(self, count, validate):
+        self.count = count
+        self.VALIDATE = validate
+
+    def items(self):
+        return (Booking(i) for i in xrange(self.count))
+
+    def item_id(self, item):
+        return 'booking-%s' % item.id
+
+    def item_title(self, item):
+        return item.title
+
+    def item_updated(self, item):
+        return item.start
+
+    def item_content(self, item):
+        return '%s at %s' % (item.title, item.start)
+
+def built(count, out):
+    UpcomingFeed(count, True).get_feed().write(out, 'utf-8')
+
+def streamed(count, out):
+    for chunk in UpcomingFeed(count, False).stream():
+        out.write(chunk)
+
+def measure(func, count):
+    read, write = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read)
+        before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        started = time.time()
+        func(count, open(os.devnull, 'w'))
+        elapsed = time.time() - started
+        grown = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - before
+        os.write(write, '%s %s' % (elapsed, grown))
+        os._exit(0)
+    os.close(write)
+    result = os.read(read, 100)
+    os.waitpid(pid, 0)
+    elapsed, grown = result.split()
+    return float(elapsed), int(grown)
+
+def main():
+    counts = sys.argv[1:] and [int(sys.argv[1])] or [1000, 5000, 20000]
+    print "%8s %12s %12s %14s %14s" % ('entries', 'built (s)', 'stream (s)', 'built (KB)', 'stream (KB)')
+    for count in counts:
+        built_time, built_rss = measure(built, count)
+        stream_time, stream_rss = measure(streamed, count)
+        print "%8s %12.2f %12.2f %14s %14s" % (count, built_time, stream_time, built_rss, stream_rss)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+"""
+Time and peak memory of writing an iCalendar feed of many events, by
+building a vobject calendar and serializing it (as ICalendarFeed used to)
+and by streaming it with ICalendarFeed.serialize.
+
+    python benchmarks/icalendar.py [events]
+
+Each run happens in a forked process, and reports how far that process's
+peak RSS grew while writing the feed.
+"""
+import os
+import resource
+import sys
+import time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from django.conf import settings
+settings.configure()
+
+import vobject
+from eventtools.feeds.icalendar import EVENT_ITEMS, ICalendarFeed
+
+class Booking(object):
+    def __init__(self, i):
+        self.id = i
+        self.start = datetime(2010, 1, 1, 9, 0) + timedelta(hours=7 * i)
+        self.end = self.start + timedelta(hours=2)
+        self.title = u'Booking %s, with a description long enough to be folded \u2013 twice, perhaps' % i
+
+class Feed(ICalendarFeed):
+    def __init__(self, count):
+        self.count = count
+
+    def items(self):
+        return (Booking(i) for i in xrange(self.count))
+
+    def item_uid(self, item):
+        return str(item.id)
+
+    def item_start(self, item):
+        return item.start
+
+    def item_end(self, item):
+        return item.end
+
+    def item_summary(self, item):
+        return item.title
+
+def with_vobject(feed, out):
+    cal = vobject.iCalendar()
+    for item in feed.items():
+        event = cal.add('vevent')
+        for vkey, key in EVENT_ITEMS:
+            value = getattr(feed, 'item_' + key)(item)
+            if value:
+                event.add(vkey).value = value
+    out.write(cal.serialize())
+
+def streamed(feed, out):
+    for chunk in feed.serialize():
+        out.write(chunk)
+
+def measure(func, count):
+    read, write = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read)
+        before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        started = time.time()
+        func(Feed(count), open(os.devnull, 'w'))
+        elapsed = time.time() - started
+        grown = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - before
+        os.write(write, '%s %s' % (elapsed, grown))
+        os._exit(0)
+    os.close(write)
+    result = os.read(read, 100)
+    os.waitpid(pid, 0)
+    elapsed, grown = result.split()
+    return float(elapsed), int(grown)
+
+def main():
+    counts = sys.argv[1:] and [int(sys.argv[1])] or [1000, 5000, 20000]
+    print "%8s %12s %12s %14s %14s" % ('events', 'vobject (s)', 'stream (s)', 'vobject (KB)', 'stream (KB)')
+    for count in counts:
+        vobject_time, vobject_rss = measure(with_vobject, count)
+        stream_time, stream_rss = measure(streamed, count)
+        print "%8s %12.2f %12.2f %14s %14s" % (count, vobject_time, stream_time, vobject_rss, stream_rss)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,58 @@
+#!/usr/bin/env python
+"""
+Time expanding one month of a recurrence rule, with dateutil and with
+eventtools.recurrence, for rules that started longer and longer ago.
+
+    python benchmarks/recurrence.py
+
+dateutil iterates from the first occurrence, so its time grows with the age
+of the rule; a RegularPattern seeks straight to the month. If NumPy is
+installed, it then times expanding a year into datetime objects and into a
+datetime64 array.
+"""
+import os
+import sys
+import timeit
+from datetime import datetime
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from dateutil import rrule
+from eventtools.recurrence import numpy, regular_pattern
+
+WINDOW = (datetime(2026, 3, 1), datetime(2026, 4, 1))
+
+RULES = [
+    ('daily', rrule.DAILY, {}),
+    ('weekly mo,we,fr', rrule.WEEKLY, {'byweekday': [0, 2, 4]}),
+    ('every 3 hours', rrule.HOURLY, {'interval': 3}),
+]
+
+def best_of(func, number=20):
+    return min(timeit.repeat(func, number=number, repeat=3)) / number
+
+def main():
+    print "%-18s %6s %14s %14s" % ('rule', 'age', 'dateutil (ms)', 'pattern (ms)')
+    for name, frequency, params in RULES:
+        for years in (1, 5, 20, 50):
+            dtstart = datetime(2026 - years, 1, 1, 10, 0)
+            rule = rrule.rrule(frequency, dtstart=dtstart, **params)
+            pattern = regular_pattern(frequency, dtstart, params)
+            assert pattern.between(*WINDOW, **{'inc': True}) == rule.between(*WINDOW, **{'inc': True})
+            print "%-18s %5sy %14.3f %14.3f" % (name, years,
+                best_of(lambda: rule.between(*WINDOW, **{'inc': True})) * 1000,
+                best_of(lambda: pattern.between(*WINDOW, **{'inc': True})) * 1000)
+
+    if numpy is None:
+        return
+    year = (datetime(2026, 1, 1), datetime(2027, 1, 1))
+    print
+    print "%-18s %14s %14s" % ('one year of', 'objects (ms)', 'array (ms)')
+    for name, frequency, params in RULES:
+        pattern = regular_pattern(frequency, datetime(2000, 1, 1, 10, 0), params)
+        print "%-18s %14.3f %14.3f" % (name,
+            best_of(lambda: pattern.between(*year)) * 1000,
+            best_of(lambda: pattern.between_array(*year)) * 1000)
+
+if __name__ == '__main__':
+    main()
@@ -47,7 +47,7 @@ def make_exceptional_occurrence(request, event_id, gen_id, year, month, day, hou
     occurrence = generator.get_occurrence(datetime.datetime(int(year), int(month), int(day), int(hour), int(minute), int(second)))
 
     occurrence.save()
-    OccurrenceModel = occurrence.__class__
+    OccurrenceModel = event.OccurrenceModel
     admin_url_name = ('admin:%s_%s_change' % (OccurrenceModel._meta.app_label, OccurrenceModel.__name__)).lower()
     event_change_url = urlresolvers.reverse(admin_url_name, args=(occurrence.id,))
     return HttpResponseRedirect(event_change_url)
@@ -0,0 +1,188 @@
+"""
+An optional cache of occurrence lists, shared between processes through
+Django's cache framework. Turn it on with ``OCCURRENCE_CACHE = True``.
+
+Each event has a version number in the cache, which is bumped whenever one of
+its generators or exceptional occurrences, a variation of it, or a rule one
+of its generators uses is saved or deleted. A list of occurrences is stored
+under a key made from the window and the versions of its events, so changing
+an event simply makes the keys of the lists it appeared in unreachable.
+Nothing relies on entries expiring to become fresh, as long as saves are
+committed as they happen. Versions are bumped by the save, before the
+transaction it is part of commits, so until then another process may store
+the old occurrences under the new version; lists are kept for
+``OCCURRENCE_CACHE_TIMEOUT`` seconds, which bounds how long that lasts.
+
+A missing version (never set, or evicted) starts from the current time in
+microseconds rather than from 0, so it can't take a value that keys written
+under an earlier version of that event were made with.
+
+Lists are stored compactly: the field values of their generators, rules and
+exceptional occurrences, and a tuple of numbers per generated occurrence.
+Reading one back doesn't touch the database.
+
+``get_validators`` gives feeds an ETag and a last-modified time for a set of
+events, so they can answer a conditional GET without expanding anything.
+"""
+import time
+from datetime import datetime, timedelta
+from django.core.cache import cache
+from django.db.models import Count, Max
+from django.utils.hashcompat import md5_constructor
+from eventtools.conf.settings import OCCURRENCE_CACHE, OCCURRENCE_CACHE_TIMEOUT
+from eventtools.models import GeneratedOccurrence, Rule
+
+EPOCH = datetime(1970, 1, 1)
+
+def _microseconds(dt):
+    delta = dt - EPOCH
+    return (delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds
+
+def _datetime(microseconds):
+    return EPOCH + timedelta(microseconds=microseconds)
+
+def _label(model):
+    return '%s.%s' % (model._meta.app_label, model._meta.object_name.lower())
+
+def _version_key(EventModel, event_id):
+    return 'eventtools.version.%s.%s' % (_label(EventModel), event_id)
+
+def _initial_version():
+    return int(time.time() * 1000000)
+
+def get_versions(EventModel, event_ids):
+    """
+    Returns a dict of the current versions of the events of ``EventModel``
+    with ``event_ids``, starting those that have none.
+    """
+    keys = dict([(_version_key(EventModel, event_id), event_id) for event_id in event_ids])
+    found = cache.get_many(keys.keys())
+    versions = {}
+    for key, event_id in keys.items():
+        version = found.get(key)
+        if version is None:
+            version = _initial_version()
+            if not cache.add(key, version):
+                # someone else just started it
+                version = cache.get(key, version)
+        versions[event_id] = version
+    return versions
+
+def bump_versions(EventModel, event_ids):
+    """
+    Makes the cached occurrence lists of the events of ``EventModel`` with
+    ``event_ids`` unreachable.
+    """
+    for event_id in set(event_ids):
+        try:
+            cache.incr(_version_key(EventModel, event_id))
+        except ValueError:
+            # no version, so nothing is cached under one
+            pass
+
+def _occurrences_key(events, start, end):
+    EventModel = type(events[0])
+    versions = get_versions(EventModel, [event.id for event in events])
+    parts = [_label(EventModel), start.isoformat(), end.isoformat()]
+    parts += ['%s:%s' % item for item in sorted(versions.items())]
+    return 'eventtools.occurrences.%s' % md5_constructor(' '.join(parts)).hexdigest()
+
+def _values(instance):
+    return tuple([getattr(instance, field.attname) for field in instance._meta.fields])
+
+def _instance(Model, values):
+    return Model(**dict(zip([field.attname for field in Model._meta.fields], values)))
+
+def _pack(occurrences):
+    generators, exceptions, rows = [], [], []
+    positions = {}
+    def position(generator):
+        if generator.id not in positions:
+            positions[generator.id] = len(generators)
+            rule = generator.rule_id and _values(generator.rule)
+            generators.append((_values(generator), rule))
+        return positions[generator.id]
+    for occ in occurrences:
+        if isinstance(occ, GeneratedOccurrence):
+            rows.append((position(occ.generator), _microseconds(occ.start), _microseconds(occ.end)))
+        else:
+            rows.append((len(exceptions),))
+            exceptions.append((_values(occ), position(occ.generator)))
+    return generators, exceptions, rows
+
+def _unpack(events, packed):
+    generators, exceptions, rows = packed
+    GeneratorModel, OccurrenceModel = events[0].GeneratorModel, events[0].OccurrenceModel
+    events_by_id = dict([(event.id, event) for event in events])
+    event_cache = GeneratorModel._meta.get_field('event').get_cache_name()
+    rule_cache = GeneratorModel._meta.get_field('rule').get_cache_name()
+    generator_cache = OccurrenceModel._meta.get_field('generator').get_cache_name()
+
+    for i, (values, rule) in enumerate(generators):
+        generator = generators[i] = _instance(GeneratorModel, values)
+        setattr(generator, event_cache, events_by_id[generator.event_id])
+        if rule:
+            setattr(generator, rule_cache, _instance(Rule, rule))
+    for i, (values, generator) in enumerate(exceptions):
+        occ = exceptions[i] = _instance(OccurrenceModel, values)
+        setattr(occ, generator_cache, generators[generator])
+    occurrences = []
+    for row in rows:
+        if len(row) == 1:
+            occurrences.append(exceptions[row[0]])
+        else:
+            occurrences.append(GeneratedOccurrence(generators[row[0]], _datetime(row[1]), _datetime(row[2])))
+    return occurrences
+
+def cached_occurrences(events, start, end, expand):
+    """
+    Returns ``expand(start, end)``, the sorted occurrences of ``events``
+    (instances of one EventBase subclass) between ``start`` and ``end``,
+    from the cache if ``OCCURRENCE_CACHE`` is on and it has them.
+    """
+    if not OCCURRENCE_CACHE or not events:
+        return expand(start, end)
+    key = _occurrences_key(events, start, end)
+    packed = cache.get(key)
+    if packed is not None:
+        return _unpack(events, packed)
+    occurrences = expand(start, end)
+    cache.set(key, _pack(occurrences), OCCURRENCE_CACHE_TIMEOUT)
+    return occurrences
+
+def get_validators(events):
+    """
+    Returns an ETag and a last-modified time (or None, if nothing has one)
+    for the occurrences of ``events`` (instances of one EventBase subclass),
+    from the latest ``modified`` stamp and the number of rows of the events,
+    and of their variations, generators, rules and exceptional occurrences
+    (one aggregate query for each table). Deleting a generator, exceptional
+    occurrence or variation stamps its event, so the last-modified time moves
+    on then too. The ETag also covers the events' versions, if
+    ``OCCURRENCE_CACHE`` is on.
+    """
+    if not events:
+        return md5_constructor('').hexdigest(), None
+    EventModel = type(events[0])
+    ids = sorted([event.id for event in events])
+    GeneratorModel = events[0].GeneratorModel
+    OccurrenceModel = events[0].OccurrenceModel
+    querysets = [
+        ('events', EventModel._default_manager.filter(id__in=ids)),
+        ('generators', GeneratorModel._default_manager.filter(event__in=ids)),
+        ('rules', Rule.objects.filter(id__in=GeneratorModel._default_manager.filter(event__in=ids).values('rule'))),
+        ('occurrences', OccurrenceModel._default_manager.filter(generator__event__in=ids)),
+    ]
+    if hasattr(EventModel, 'varied_by'):
+        VariationModel = OccurrenceModel._meta.get_field('_varied_event').rel.to
+        querysets.append(('variations', VariationModel._default_manager.filter(unvaried_event__in=ids)))
+    parts = [_label(EventModel)] + ['%s' % id for id in ids]
+    stamps = []
+    for name, queryset in querysets:
+        values = queryset.aggregate(modified=Max('modified'), count=Count('id'))
+        parts.append('%s:%s:%s' % (name, values['modified'], values['count']))
+        if values['modified'] is not None:
+            stamps.append(values['modified'])
+    if OCCURRENCE_CACHE:
+        parts += ['%s:%s' % item for item in sorted(get_versions(EventModel, ids).items())]
+    return md5_constructor(' '.join(parts)).hexdigest(), stamps and max(stamps) or None
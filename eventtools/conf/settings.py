@@ -45,3 +45,32 @@ if not GET_EVENTS_FUNC:
 
 # URL to redirect to to after an occurrence is canceled
 OCCURRENCE_CANCEL_REDIRECT = getattr(settings, 'OCCURRENCE_CANCEL_REDIRECT', None)
+
+# Maximum number of compiled recurrence rules kept in the process-wide cache
+# (see eventtools.utils.RRuleCache). Set to 0 to compile rules every time.
+RRULE_CACHE_SIZE = getattr(settings, 'RRULE_CACHE_SIZE', 1000)
+
+# Number of days ahead that materialized occurrences cover, for event models
+# that set materialize_occurrences = True (see eventtools.materialization).
+MATERIALIZATION_HORIZON = getattr(settings, 'MATERIALIZATION_HORIZON', 548)
+
+# Whether rules that repeat at a fixed period (DAILY, WEEKLY and HOURLY rules
+# without month-dependent parts) are expanded arithmetically rather than by
+# dateutil (see eventtools.recurrence).
+REGULAR_RULE_EXPANSION = getattr(settings, 'REGULAR_RULE_EXPANSION', True)
+
+# Whether Period occurrence lists are kept in Django's cache, keyed by
+# versions of their events that saving them bumps (see eventtools.caching).
+# Versions are bumped when the save happens, not when it is committed, so the
+# cache is only kept consistent under autocommit: inside a longer transaction
+# (TransactionMiddleware, say) another process can cache the old occurrences
+# under the new version, and they are served until the entry expires.
+OCCURRENCE_CACHE = getattr(settings, 'OCCURRENCE_CACHE', False)
+
+# Seconds that a cached occurrence list is kept, which bounds how long such a
+# stale list can be served.
+OCCURRENCE_CACHE_TIMEOUT = getattr(settings, 'OCCURRENCE_CACHE_TIMEOUT', 300)
+
+# Whether Atom feeds (eventtools.feeds.atom.Feed) are validated as they are
+# written. Worth it in development; it costs time on every request.
+VALIDATE_FEEDS = getattr(settings, 'VALIDATE_FEEDS', settings.DEBUG)
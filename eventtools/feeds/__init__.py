@@ -5,6 +5,7 @@ from django.conf import settings
 from events.feeds.atom import Feed
 from events.feeds.icalendar import ICalendarFeed
 from django.http import HttpResponse
+from eventtools.utils import EventListManager
 import datetime, itertools
 from django.utils.translation import ugettext_lazy as _
 
@@ -25,7 +26,7 @@ class UpcomingEventsFeed(Feed):
         return obj.get_absolute_url()
     
     def items(self, obj):
-        return itertools.islice(obj.occurrences_after(datetime.datetime.now()), 
+        return itertools.islice(EventListManager(obj.events.all()).occurrences_after(datetime.datetime.now()),
             getattr(settings, "FEED_LIST_LENGTH", 10))
     
     def item_id(self, item):
@@ -30,6 +30,10 @@
 
 from xml.sax.saxutils import XMLGenerator
 from datetime import datetime
+from django.db.models.query import QuerySet
+from django.http import HttpResponse
+from django.views.decorators.http import condition
+from eventtools.conf.settings import VALIDATE_FEEDS
 
 
 GENERATOR_TEXT = 'django-atompub'
@@ -40,6 +44,21 @@ GENERATOR_ATTR = {
 
 
 
+class ChunkWriter(object):
+    "A file-like object that keeps what is written until it is taken"
+    def __init__(self):
+        self.chunks = []
+    
+    def write(self, data):
+        self.chunks.append(data)
+    
+    def take(self):
+        data = ''.join(self.chunks)
+        self.chunks = []
+        return data
+
+
+
 ## based on django.utils.xmlutils.SimplerXMLGenerator
 class SimplerXMLGenerator(XMLGenerator):
     def addQuickElement(self, name, contents=None, attrs=None):
@@ -73,7 +92,7 @@ def get_tag_uri(url, date):
 class Feed(object):
     
     
-    VALIDATE = True
+    VALIDATE = VALIDATE_FEEDS
     
     
     def __init__(self, slug, feed_url):
@@ -102,20 +121,74 @@ class Feed(object):
         return attr
     
     
-    def get_feed(self, extra_params=None):
-        
+    def __get_object(self, extra_params):
         if extra_params:
             try:
-                obj = self.get_object(extra_params.split('/'))
+                return self.get_object(extra_params.split('/'))
             except (AttributeError, LookupError):
                 raise LookupError('Feed does not exist')
-        else:
-            obj = None
+        return None
+    
+    
+    def get_response(self, request, extra_params=None):
+        """
+        Returns the feed as a response to ``request``, or a 304 if the
+        request's If-None-Match or If-Modified-Since shows the client has it
+        already, according to ``feed_etag`` and ``feed_last_modified``
+        (which are worked out before the feed is). The feed is written to
+        the response as it is iterated (see ``stream``).
+        """
+        obj = self.__get_object(extra_params)
+        etag = self.__get_dynamic_attr('feed_etag', obj)
+        last_modified = self.__get_dynamic_attr('feed_last_modified', obj)
+        def respond(request):
+            return HttpResponse(self.stream(extra_params, obj), mimetype='application/atom+xml; charset=utf-8')
+        return condition(lambda request: etag, lambda request: last_modified)(respond)(request)
+    
+    
+    def stream(self, extra_params=None, obj=None, encoding='utf-8'):
+        """
+        Returns an iterator over the feed, written in ``encoding``, that
+        gets each item and writes its entry as it goes, rather than building
+        the whole feed first (see ``AtomFeed.generate``), as long as the feed
+        has a ``feed_updated`` or ``feed_last_modified``. If ``VALIDATE``,
+        each part is validated just before it is written.
+        """
+        if obj is None:
+            obj = self.__get_object(extra_params)
+        feed = self.__get_atom_feed(obj)
+        items = self.__get_items(obj)
+        if isinstance(items, QuerySet):
+            # don't keep every row in the queryset's cache
+            items = items.iterator()
+        entries = (self.__get_entry(feed, item) for item in items)
+        return feed.generate(encoding, entries, validate=self.VALIDATE)
+    
+    
+    def get_feed(self, extra_params=None, obj=None):
+        
+        if obj is None:
+            obj = self.__get_object(extra_params)
         
-        feed = AtomFeed(
+        feed = self.__get_atom_feed(obj)
+        for item in self.__get_items(obj):
+            feed.items.append(self.__get_entry(feed, item))
+        
+        if self.VALIDATE:
+            feed.validate()
+        return feed
+    
+    
+    def __get_atom_feed(self, obj):
+        updated = self.__get_dynamic_attr('feed_updated', obj)
+        if updated is None:
+            # otherwise it's the latest entry's, so every entry has to be
+            # got before any can be written
+            updated = self.__get_dynamic_attr('feed_last_modified', obj)
+        return AtomFeed(
             atom_id = self.__get_dynamic_attr('feed_id', obj),
             title = self.__get_dynamic_attr('feed_title', obj),
-            updated = self.__get_dynamic_attr('feed_updated', obj),
+            updated = updated,
             icon = self.__get_dynamic_attr('feed_icon', obj),
             logo = self.__get_dynamic_attr('feed_logo', obj),
             rights = self.__get_dynamic_attr('feed_rights', obj),
@@ -127,31 +200,31 @@ class Feed(object):
             extra_attrs = self.__get_dynamic_attr('feed_extra_attrs', obj),
             hide_generator = self.__get_dynamic_attr('hide_generator', obj, default=False)
         )
-        
+    
+    
+    def __get_items(self, obj):
         items = self.__get_dynamic_attr('items', obj)
         if items is None:
             raise LookupError('Feed has no items field')
-        
-        for item in items:
-            feed.add_item(
-                atom_id = self.__get_dynamic_attr('item_id', item), 
-                title = self.__get_dynamic_attr('item_title', item),
-                updated = self.__get_dynamic_attr('item_updated', item),
-                content = self.__get_dynamic_attr('item_content', item),
-                published = self.__get_dynamic_attr('item_published', item),
-                rights = self.__get_dynamic_attr('item_rights', item),
-                source = self.__get_dynamic_attr('item_source', item),
-                summary = self.__get_dynamic_attr('item_summary', item),
-                authors = self.__get_dynamic_attr('item_authors', item, default=[]),
-                categories = self.__get_dynamic_attr('item_categories', item, default=[]),
-                contributors = self.__get_dynamic_attr('item_contributors', item, default=[]),
-                links = self.__get_dynamic_attr('item_links', item, default=[]),
-                extra_attrs = self.__get_dynamic_attr('item_extra_attrs', None, default={}),
-            )
-        
-        if self.VALIDATE:
-            feed.validate()
-        return feed
+        return items
+    
+    
+    def __get_entry(self, feed, item):
+        return feed.make_item(
+            atom_id = self.__get_dynamic_attr('item_id', item), 
+            title = self.__get_dynamic_attr('item_title', item),
+            updated = self.__get_dynamic_attr('item_updated', item),
+            content = self.__get_dynamic_attr('item_content', item),
+            published = self.__get_dynamic_attr('item_published', item),
+            rights = self.__get_dynamic_attr('item_rights', item),
+            source = self.__get_dynamic_attr('item_source', item),
+            summary = self.__get_dynamic_attr('item_summary', item),
+            authors = self.__get_dynamic_attr('item_authors', item, default=[]),
+            categories = self.__get_dynamic_attr('item_categories', item, default=[]),
+            contributors = self.__get_dynamic_attr('item_contributors', item, default=[]),
+            links = self.__get_dynamic_attr('item_links', item, default=[]),
+            extra_attrs = self.__get_dynamic_attr('item_extra_attrs', None, default={}),
+        )
 
 
 
@@ -160,6 +233,17 @@ class ValidationError(Exception):
 
 
 
+def validate_text_construct(obj):
+    if isinstance(obj, tuple):
+        if obj[0] not in ['text', 'html', 'xhtml']:
+            return False
+    # @@@ no validation is done that 'html' text constructs are valid HTML
+    # @@@ no validation is done that 'xhtml' text constructs are well-formed XML or valid XHTML
+    
+    return True
+
+
+
 ## based on django.utils.feedgenerator.SyndicationFeed and django.utils.feedgenerator.Atom1Feed
 class AtomFeed(object):
     
@@ -193,7 +277,11 @@ class AtomFeed(object):
         self.items = []
     
     
-    def add_item(self, atom_id, title, updated, content=None, published=None, rights=None, source=None, summary=None,
+    def add_item(self, *args, **kwargs):
+        self.items.append(self.make_item(*args, **kwargs))
+    
+    
+    def make_item(self, atom_id, title, updated, content=None, published=None, rights=None, source=None, summary=None,
         authors=[], categories=[], contributors=[], links=[], extra_attrs={}):
         if atom_id is None:
             raise LookupError('Feed has no item_id method')
@@ -201,7 +289,7 @@ class AtomFeed(object):
             raise LookupError('Feed has no item_title method')
         if updated is None:
             raise LookupError('Feed has no item_updated method')
-        self.items.append({
+        return {
             'id': atom_id,
             'title': title,
             'updated': updated,
@@ -215,14 +303,16 @@ class AtomFeed(object):
             'contributors': contributors,
             'links': links,
             'extra_attrs': extra_attrs,
-        })
+        }
     
     
-    def latest_updated(self):
+    def latest_updated(self, items=None):
         """
         Returns the latest item's updated or the current time if there are no items.
         """
-        updates = [item['updated'] for item in self.items]
+        if items is None:
+            items = self.items
+        updates = [item['updated'] for item in items]
         if len(updates) > 0:
             updates.sort()
             return updates[-1]
@@ -304,7 +394,31 @@ class AtomFeed(object):
     
     
     def write(self, outfile, encoding):
-        handler = SimplerXMLGenerator(outfile, encoding)
+        for chunk in self.generate(encoding):
+            outfile.write(chunk)
+    
+    
+    def generate(self, encoding, items=None, validate=False):
+        """
+        Yields the feed, written in ``encoding``, a chunk at a time: the head
+        of the feed, then each entry. ``items`` (by default the items added)
+        may be any iterable of item dicts (see ``make_item``), and is only
+        read as the feed is written -- unless the feed has no ``updated``,
+        in which case all the items have to be read first to find the
+        latest. If ``validate``, the feed and each item are validated (see
+        ``validate``) just before they are written.
+        """
+        if items is None:
+            items = self.items
+        updated = self.feed['updated']
+        if not updated:
+            items = list(items)
+            updated = self.latest_updated(items)
+        if validate:
+            self.validate_feed()
+        
+        out = ChunkWriter()
+        handler = SimplerXMLGenerator(out, encoding)
         handler.startDocument()
         feed_attrs = {u'xmlns': self.ns}
         if self.feed.get('extra_attrs'):
@@ -318,10 +432,7 @@ class AtomFeed(object):
             handler.addQuickElement(u'icon', self.feed['icon'])
         if self.feed.get('logo'):
             handler.addQuickElement(u'logo', self.feed['logo'])
-        if self.feed['updated']:
-            handler.addQuickElement(u'updated', rfc3339_date(self.feed['updated']))
-        else:
-            handler.addQuickElement(u'updated', rfc3339_date(self.latest_updated()))
+        handler.addQuickElement(u'updated', rfc3339_date(updated))
         for category in self.feed['categories']:
             self.write_category_construct(handler, category)
         for link in self.feed['links']:
@@ -334,54 +445,60 @@ class AtomFeed(object):
             self.write_text_construct(handler, u'rights', self.feed['rights'])
         if not self.feed.get('hide_generator'):
             handler.addQuickElement(u'generator', GENERATOR_TEXT, GENERATOR_ATTR)
+        yield out.take()
         
-        self.write_items(handler)
+        for item in items:
+            if validate:
+                self.validate_item(item)
+            self.write_item(handler, item)
+            yield out.take()
         
         handler.endElement(u'feed')
+        yield out.take()
     
     
     def write_items(self, handler):
         for item in self.items:
-            entry_attrs = item.get('extra_attrs', {})
-            handler.startElement(u'entry', entry_attrs)
-            
-            handler.addQuickElement(u'id', item['id'])
-            self.write_text_construct(handler, u'title', item['title'])
-            handler.addQuickElement(u'updated', rfc3339_date(item['updated']))
-            if item.get('published'):
-                handler.addQuickElement(u'published', rfc3339_date(item['published']))
-            if item.get('rights'):
-                self.write_text_construct(handler, u'rights', item['rights'])
-            if item.get('source'):
-                self.write_source(handler, item['source'])
-            
-            for author in item['authors']:
-                self.write_person_construct(handler, u'author', author)
-            for contributor in item['contributors']:
-                self.write_person_construct(handler, u'contributor', contributor)
-            for category in item['categories']:
-                self.write_category_construct(handler, category)
-            for link in item['links']:
-                self.write_link_construct(handler, link)
-            if item.get('summary'):
-                self.write_text_construct(handler, u'summary', item['summary'])
-            if item.get('content'):
-                self.write_content(handler, item['content'])
-            
-            handler.endElement(u'entry')
+            self.write_item(handler, item)
     
     
-    def validate(self):
+    def write_item(self, handler, item):
+        entry_attrs = item.get('extra_attrs', {})
+        handler.startElement(u'entry', entry_attrs)
         
-        def validate_text_construct(obj):
-            if isinstance(obj, tuple):
-                if obj[0] not in ['text', 'html', 'xhtml']:
-                    return False
-            # @@@ no validation is done that 'html' text constructs are valid HTML
-            # @@@ no validation is done that 'xhtml' text constructs are well-formed XML or valid XHTML
-            
-            return True
+        handler.addQuickElement(u'id', item['id'])
+        self.write_text_construct(handler, u'title', item['title'])
+        handler.addQuickElement(u'updated', rfc3339_date(item['updated']))
+        if item.get('published'):
+            handler.addQuickElement(u'published', rfc3339_date(item['published']))
+        if item.get('rights'):
+            self.write_text_construct(handler, u'rights', item['rights'])
+        if item.get('source'):
+            self.write_source(handler, item['source'])
         
+        for author in item['authors']:
+            self.write_person_construct(handler, u'author', author)
+        for contributor in item['contributors']:
+            self.write_person_construct(handler, u'contributor', contributor)
+        for category in item['categories']:
+            self.write_category_construct(handler, category)
+        for link in item['links']:
+            self.write_link_construct(handler, link)
+        if item.get('summary'):
+            self.write_text_construct(handler, u'summary', item['summary'])
+        if item.get('content'):
+            self.write_content(handler, item['content'])
+        
+        handler.endElement(u'entry')
+    
+    
+    def validate(self):
+        self.validate_feed()
+        for item in self.items:
+            self.validate_item(item)
+    
+    
+    def validate_feed(self):
         if not validate_text_construct(self.feed['title']):
             raise ValidationError('feed title has invalid type')
         if self.feed.get('subtitle'):
@@ -398,77 +515,69 @@ class AtomFeed(object):
                 if key in alternate_links:
                     raise ValidationError('alternate links must have unique type/hreflang')
                 alternate_links[key] = link
+    
+    
+    def validate_item(self, item):
+        if not self.feed.get('authors') and not item.get('authors'):
+            if item.get('source') and item['source'].get('authors'):
+                pass
+            else:
+                raise ValidationError('if no feed author, all entries must have author (possibly in source)')
         
-        if self.feed.get('authors'):
-            feed_author = True
-        else:
-            feed_author = False
+        if not validate_text_construct(item['title']):
+            raise ValidationError('entry title has invalid type')
+        if item.get('rights'):
+            if not validate_text_construct(item['rights']):
+                raise ValidationError('entry rights has invalid type')
+        if item.get('summary'):
+            if not validate_text_construct(item['summary']):
+                raise ValidationError('entry summary has invalid type')
+        source = item.get('source')
+        if source:
+            if source.get('title'):
+                if not validate_text_construct(source['title']):
+                    raise ValidationError('source title has invalid type')
+            if source.get('subtitle'):
+                if not validate_text_construct(source['subtitle']):
+                    raise ValidationError('source subtitle has invalid type')
+            if source.get('rights'):
+                if not validate_text_construct(source['rights']):
+                    raise ValidationError('source rights has invalid type')
         
-        for item in self.items:
-            if not feed_author and not item.get('authors'):
-                if item.get('source') and item['source'].get('authors'):
-                    pass
-                else:
-                    raise ValidationError('if no feed author, all entries must have author (possibly in source)')
-            
-            if not validate_text_construct(item['title']):
-                raise ValidationError('entry title has invalid type')
-            if item.get('rights'):
-                if not validate_text_construct(item['rights']):
-                    raise ValidationError('entry rights has invalid type')
-            if item.get('summary'):
-                if not validate_text_construct(item['summary']):
-                    raise ValidationError('entry summary has invalid type')
-            source = item.get('source')
-            if source:
-                if source.get('title'):
-                    if not validate_text_construct(source['title']):
-                        raise ValidationError('source title has invalid type')
-                if source.get('subtitle'):
-                    if not validate_text_construct(source['subtitle']):
-                        raise ValidationError('source subtitle has invalid type')
-                if source.get('rights'):
-                    if not validate_text_construct(source['rights']):
-                        raise ValidationError('source rights has invalid type')
-            
-            alternate_links = {}
-            for link in item.get('links'):
-                if link.get('rel') == 'alternate' or link.get('rel') == None:
-                    key = (link.get('type'), link.get('hreflang'))
-                    if key in alternate_links:
-                        raise ValidationError('alternate links must have unique type/hreflang')
-                    alternate_links[key] = link
-            
-            if not item.get('content'):
-                if not alternate_links:
-                    raise ValidationError('if no content, entry must have alternate link')
-            
-            if item.get('content') and isinstance(item.get('content'), tuple):
-                content_type = item.get('content')[0].get('type')
-                if item.get('content')[0].get('src'):
-                    if item.get('content')[1]:
-                        raise ValidationError('content with src should be empty')
-                    if not item.get('summary'):
-                        raise ValidationError('content with src requires a summary too')
-                    if content_type in ['text', 'html', 'xhtml']:
-                        raise ValidationError('content with src cannot have type of text, html or xhtml')
-                if content_type:
-                    if '/' in content_type and \
-                        not content_type.startswith('text/') and \
-                        not content_type.endswith('/xml') and not content_type.endswith('+xml') and \
-                        not content_type in ['application/xml-external-parsed-entity', 'application/xml-dtd']:
-                        # @@@ check content is Base64
-                        if not item.get('summary'):
-                            raise ValidationError('content in Base64 requires a summary too')
-                    if content_type not in ['text', 'html', 'xhtml'] and '/' not in content_type:
-                        raise ValidationError('content type does not appear to be valid')
-                    
-                    # @@@ no validation is done that 'html' text constructs are valid HTML
-                    # @@@ no validation is done that 'xhtml' text constructs are well-formed XML or valid XHTML
-                    
-                    return
+        alternate_links = {}
+        for link in item.get('links'):
+            if link.get('rel') == 'alternate' or link.get('rel') == None:
+                key = (link.get('type'), link.get('hreflang'))
+                if key in alternate_links:
+                    raise ValidationError('alternate links must have unique type/hreflang')
+                alternate_links[key] = link
         
-        return
+        if not item.get('content'):
+            if not alternate_links:
+                raise ValidationError('if no content, entry must have alternate link')
+        
+        if item.get('content') and isinstance(item.get('content'), tuple):
+            content_type = item.get('content')[0].get('type')
+            if item.get('content')[0].get('src'):
+                if item.get('content')[1]:
+                    raise ValidationError('content with src should be empty')
+                if not item.get('summary'):
+                    raise ValidationError('content with src requires a summary too')
+                if content_type in ['text', 'html', 'xhtml']:
+                    raise ValidationError('content with src cannot have type of text, html or xhtml')
+            if content_type:
+                if '/' in content_type and \
+                    not content_type.startswith('text/') and \
+                    not content_type.endswith('/xml') and not content_type.endswith('+xml') and \
+                    not content_type in ['application/xml-external-parsed-entity', 'application/xml-dtd']:
+                    # @@@ check content is Base64
+                    if not item.get('summary'):
+                        raise ValidationError('content in Base64 requires a summary too')
+                if content_type not in ['text', 'html', 'xhtml'] and '/' not in content_type:
+                    raise ValidationError('content type does not appear to be valid')
+                
+                # @@@ no validation is done that 'html' text constructs are valid HTML
+                # @@@ no validation is done that 'xhtml' text constructs are well-formed XML or valid XHTML
 
 
 
@@ -1,6 +1,14 @@
-import vobject
+import datetime
+import random
+import socket
 
+from django.db.models import Q
+from django.db.models.query import QuerySet
 from django.http import HttpResponse
+from django.utils.hashcompat import md5_constructor
+from django.views.decorators.http import condition
+from eventtools.caching import get_validators
+from eventtools.models import _generators_and_exceptions
 
 EVENT_ITEMS = (
     ('uid', 'uid'),
@@ -12,28 +20,119 @@ EVENT_ITEMS = (
     ('created', 'created'),
 )
 
+PRODID = '-//glamkit//NONSGML eventtools//EN'
+
+def escape(value):
+    """
+    Escapes a TEXT value (RFC 5545, 3.3.11).
+    """
+    if not isinstance(value, basestring):
+        value = unicode(value)
+    if isinstance(value, unicode):
+        value = value.encode('utf-8')
+    return value.replace('\\', '\\\\').replace(';', '\\;').replace(',', '\\,') \
+        .replace('\r\n', '\\n').replace('\n', '\\n')
+
+def format_datetime(value):
+    if value.tzinfo is not None and value.utcoffset() is not None:
+        return (value - value.utcoffset()).strftime('%Y%m%dT%H%M%SZ')
+    return value.strftime('%Y%m%dT%H%M%S')
+
+def format_value(value):
+    if isinstance(value, datetime.datetime):
+        return format_datetime(value)
+    return value.strftime('%Y%m%d')
+
+def content_line(name, value):
+    """
+    Returns the folded content line for the property ``name`` (e.g.
+    'last_modified', which is written LAST-MODIFIED) with ``value``, which
+    may be a datetime, a date or text.
+    """
+    name = name.upper().replace('_', '-')
+    if isinstance(value, datetime.datetime):
+        return fold('%s:%s' % (name, format_value(value)))
+    if isinstance(value, datetime.date):
+        return fold('%s;VALUE=DATE:%s' % (name, format_value(value)))
+    return fold('%s:%s' % (name, escape(value)))
+
+def fold(line):
+    """
+    Folds a UTF-8 encoded content line into lines of at most 75 octets,
+    without splitting a character, and ends it with CRLF.
+    """
+    parts = []
+    limit = 75
+    while len(line) > limit:
+        cut = limit
+        # back up to the start of a UTF-8 sequence
+        while cut > 1 and ord(line[cut]) & 0xC0 == 0x80:
+            cut -= 1
+        parts.append(line[:cut])
+        line = line[cut:]
+        limit = 74 # after the leading space
+    parts.append(line)
+    return '\r\n '.join(parts) + '\r\n'
+
+
 class ICalendarFeed(object):
+    """
+    An iCalendar feed of ``items``, one VEVENT each. The calendar is written
+    to the response as it is iterated, one event at a time (see
+    ``serialize``), so it never has to be held in memory whole.
 
+    Requests with an If-None-Match or If-Modified-Since that still holds
+    (see ``validators``) are answered with a 304, without writing anything.
+    """
     def __call__(self, *args, **kwargs):
         self.args = args
         self.kwargs = kwargs
-        
-        cal = vobject.iCalendar()
-
-        for item in self.items():
 
-            event = cal.add('vevent')
+        etag, last_modified = self.validators()
+        return condition(lambda *args, **kwargs: etag,
+            lambda *args, **kwargs: last_modified)(self.respond)(*args, **kwargs)
 
-            for vkey, key in EVENT_ITEMS:
-                value = getattr(self, 'item_' + key)(item)
-                if value:
-                    event.add(vkey).value = value
-
-        response = HttpResponse(cal.serialize())
+    def respond(self, *args, **kwargs):
+        response = HttpResponse(self.serialize())
         response['Content-Type'] = 'text/calendar'
 
         return response
 
+    def validators(self):
+        """
+        Returns the ETag and last-modified time of the feed, or None for
+        either that it hasn't got. These should be much cheaper to work out
+        than the feed (see ``eventtools.caching.get_validators``).
+        """
+        return None, None
+
+    def serialize(self):
+        """
+        Yields the calendar in chunks, one per event.
+        """
+        yield 'BEGIN:VCALENDAR\r\nVERSION:2.0\r\n' + content_line('prodid', PRODID)
+        items = self.items()
+        if isinstance(items, QuerySet):
+            # don't keep every row in the queryset's cache
+            items = items.iterator()
+        for item in items:
+            yield self.serialize_item(item)
+        yield 'END:VCALENDAR\r\n'
+
+    def serialize_item(self, item):
+        dtstamp = datetime.datetime.utcnow().strftime('%Y%m%dT%H%M%SZ')
+        lines = ['BEGIN:VEVENT\r\n']
+        for vkey, key in EVENT_ITEMS:
+            value = getattr(self, 'item_' + key)(item)
+            if vkey == 'uid' and not value:
+                # as vobject does for events without one
+                value = '%s - %s@%s' % (dtstamp, random.randint(0, 99999), socket.gethostname())
+            if value:
+                lines.append(content_line(vkey, value))
+        lines.append('DTSTAMP:%s\r\n' % dtstamp)
+        lines.append('END:VEVENT\r\n')
+        return ''.join(lines)
+
     def items(self):
         return []
 
@@ -56,4 +155,139 @@ class ICalendarFeed(object):
         pass
 
     def item_created(self, item):
-        pass
\ No newline at end of file
+        pass
+
+
+class RecurringICalendarFeed(ICalendarFeed):
+    """
+    An iCalendar feed of the occurrences of ``events()`` (instances of one
+    EventBase subclass) that writes each generator once, as a VEVENT with an
+    RRULE, instead of a VEVENT per occurrence. Of its exceptional
+    occurrences, cancelled ones become EXDATEs, moved or varied ones VEVENTs
+    with the generator's UID and a RECURRENCE-ID, and ones that don't replace
+    a generated occurrence VEVENTs of their own. (A one-off generator is
+    written as its exception, if it has one, or not at all if that is
+    cancelled.) The feed grows with the generators and exceptions, not the
+    occurrences.
+
+    A generator whose rule can't be written as an RRULE (see
+    ``Rule.to_rrule``) is written a VEVENT per occurrence, up to
+    ``expansion_horizon`` from the start of today. Since that changes the
+    feed every day, the validators then cover the day too.
+    """
+    expansion_horizon = datetime.timedelta(days=365)
+
+    def events(self):
+        return []
+
+    def validators(self):
+        events = list(self.events())
+        etag, last_modified = get_validators(events)
+        if not events:
+            return etag, last_modified
+        generators = events[0].GeneratorModel._default_manager.filter(
+            event__in=events, rule__isnull=False).select_related('rule')
+        for generator in generators:
+            if generator.rule.to_rrule(generator.repeat_until) is None:
+                today = datetime.datetime.combine(datetime.date.today(), datetime.time.min)
+                etag = md5_constructor('%s %s' % (etag, today.date())).hexdigest()
+                if last_modified is None or last_modified < today:
+                    last_modified = today
+                return etag, last_modified
+        return etag, last_modified
+
+    def horizon_end(self):
+        """
+        The end of the occurrences written of generators with rules that
+        can't be written as an RRULE.
+        """
+        return datetime.datetime.combine(datetime.date.today(), datetime.time.min) + self.expansion_horizon
+
+    def items(self):
+        events = list(self.events())
+        if not events:
+            return []
+        generators, exceptions = _generators_and_exceptions(events, Q())
+        return [(generator, exceptions[generator.id]) for generator in generators]
+
+    def serialize_item(self, item):
+        generator, exceptions = item
+        dtstamp = datetime.datetime.utcnow()
+        uid = self.generator_uid(generator)
+        rrule = generator.rule and generator.rule.to_rrule(generator.repeat_until)
+        if generator.rule and rrule is None:
+            return self.serialize_expanded(generator, exceptions, uid, dtstamp)
+
+        rule = generator.get_rrule_object()
+        duration = generator.end - generator.start
+        def replaces(occ):
+            original = occ.original_start
+            if occ.original_end - original != duration:
+                return False
+            if rule is None:
+                return original == generator.start
+            if generator.repeat_until and original > generator.repeat_until:
+                return False
+            return rule.after(original, inc=True) == original
+
+        master = (generator.start, generator.end, self.generator_summary(generator))
+        exdates = []
+        components = []
+        for occ in sorted(exceptions, key=lambda occ: occ.original_start):
+            if replaces(occ):
+                if rule is None:
+                    # a one-off's only occurrence is written as it is, or not
+                    # at all if it is cancelled
+                    master = not occ.cancelled and (occ.start, occ.end, self.occurrence_summary(occ)) or None
+                elif occ.cancelled:
+                    exdates.append(format_value(occ.original_start))
+                elif occ.is_moved or getattr(occ, '_varied_event_id', None):
+                    components.append(self.serialize_component(uid, occ.start, occ.end,
+                        self.occurrence_summary(occ), dtstamp, recurrence_id=occ.original_start))
+            elif not occ.cancelled:
+                components.append(self.serialize_component('%s-%s' % (uid, occ.id), occ.start, occ.end,
+                    self.occurrence_summary(occ), dtstamp))
+
+        if master is None:
+            return ''.join(components)
+        extra = []
+        if rrule:
+            extra.append(fold('RRULE:%s' % rrule))
+        if exdates:
+            extra.append(fold('EXDATE:%s' % ','.join(exdates)))
+        start, end, summary = master
+        return self.serialize_component(uid, start, end, summary, dtstamp, extra) + ''.join(components)
+
+    def serialize_expanded(self, generator, exceptions, uid, dtstamp):
+        end = self.horizon_end()
+        if generator.repeat_until and generator.repeat_until < end:
+            end = generator.repeat_until
+        components = []
+        for occ in generator.get_occurrences(generator.start, end, exceptions):
+            if not occ.cancelled:
+                components.append(self.serialize_component('%s-%s' % (uid, format_value(occ.original_start)),
+                    occ.start, occ.end, self.occurrence_summary(occ), dtstamp))
+        return ''.join(components)
+
+    def serialize_component(self, uid, start, end, summary, dtstamp, extra=(), recurrence_id=None):
+        lines = ['BEGIN:VEVENT\r\n', content_line('uid', uid)]
+        if recurrence_id is not None:
+            lines.append(content_line('recurrence-id', recurrence_id))
+        lines += [
+            content_line('dtstart', start),
+            content_line('dtend', end),
+            content_line('summary', summary),
+            'DTSTAMP:%s\r\n' % dtstamp.strftime('%Y%m%dT%H%M%SZ'),
+        ]
+        lines.extend(extra)
+        lines.append('END:VEVENT\r\n')
+        return ''.join(lines)
+
+    def generator_uid(self, generator):
+        return '%s.%s-%s' % (generator._meta.app_label, generator._meta.object_name.lower(), generator.id)
+
+    def generator_summary(self, generator):
+        return getattr(generator.event, 'title', None) or unicode(generator.event)
+
+    def occurrence_summary(self, occurrence):
+        return getattr(occurrence.merged_event, 'title', None) or self.generator_summary(occurrence.generator)
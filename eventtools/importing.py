@@ -0,0 +1,375 @@
+"""
+Imports iCalendar (.ics) files into an event model's events, generators,
+rules and exceptional occurrences.
+
+The file is read a line at a time, and VEVENTs are saved in batches of
+``batch_size``, each batch in one transaction, so neither the file nor its
+events have to be held in memory whole. Each VEVENT becomes an event with one
+generator. Its RRULE becomes a Rule, which is shared by every generator with
+the same rule (existing Rules included), and its UNTIL becomes the
+generator's ``repeat_until``. EXDATEs become cancelled exceptions, and
+VEVENTs with a RECURRENCE-ID (which may come before or after the VEVENT they
+override) moved or cancelled ones.
+
+    importer = ICalendarImporter(LectureEvent)
+    importer.import_file(open('lectures.ics'))
+    print importer.events_per_second()
+
+or, from the command line, ``manage.py import_ics app_label.ModelName file``.
+"""
+import re
+import time
+from datetime import datetime, timedelta
+from dateutil import tz
+from django.db import models, transaction
+from eventtools.models import (ICALENDAR_WEEKDAYS, RRULE_PARAMS, Rule, _generator_saved, _resume_handlers,
+    _suspend_handlers, freqs)
+from eventtools.utils import bulk_create
+
+ICALENDAR_PARAMS = dict([(value, key) for key, value in RRULE_PARAMS.items()])
+FREQUENCIES = [frequency for frequency, name in freqs]
+DURATION = re.compile(r'^([+-])?P(?:(\d+)W)?(?:(\d+)D)?(?:T(?:(\d+)H)?(?:(\d+)M)?(?:(\d+)S)?)?$')
+
+def unfold(lines):
+    """
+    Yields the content lines of ``lines``, with folded lines joined up.
+    """
+    line = None
+    for next_line in lines:
+        next_line = next_line.rstrip('\r\n')
+        if next_line[:1] in (' ', '\t'):
+            if line is not None:
+                line += next_line[1:]
+            continue
+        if line:
+            yield line
+        line = next_line
+    if line:
+        yield line
+
+def parse_line(line):
+    """
+    Returns the name, parameters and value of a content line.
+
+    >>> parse_line('DTSTART;TZID="Europe/London";VALUE=DATE-TIME:20100104T090000')
+    ('DTSTART', {'TZID': 'Europe/London', 'VALUE': 'DATE-TIME'}, '20100104T090000')
+    """
+    quoted = False
+    for i, char in enumerate(line):
+        if char == '"':
+            quoted = not quoted
+        elif char == ':' and not quoted:
+            break
+    else:
+        raise ValueError("Not a content line: %r" % line)
+    parts = line[:i].split(';')
+    params = {}
+    for param in parts[1:]:
+        key, value = param.split('=', 1)
+        params[key.upper()] = value.strip('"')
+    return parts[0].upper(), params, line[i + 1:]
+
+def unescape(value):
+    if not isinstance(value, unicode):
+        value = value.decode('utf-8')
+    return re.sub(r'\\([\\;,nN])', lambda m: m.group(1) in 'nN' and '\n' or m.group(1), value)
+
+def parse_vevents(lines):
+    """
+    Yields a dict for each VEVENT in ``lines``, of its property names and
+    lists of their ``(params, value)``. The properties of components inside
+    a VEVENT (such as VALARMs) are left out.
+    """
+    vevent = None
+    depth = 0
+    for line in unfold(lines):
+        name, params, value = parse_line(line)
+        if name == 'BEGIN':
+            if vevent is not None:
+                depth += 1
+            elif value.upper() == 'VEVENT':
+                vevent = {}
+        elif name == 'END' and vevent is not None:
+            if depth:
+                depth -= 1
+            else:
+                yield vevent
+                vevent = None
+        elif vevent is not None and not depth:
+            vevent.setdefault(name, []).append((params, value))
+
+def parse_datetime(value, params={}):
+    """
+    Returns a DATE or DATE-TIME value as a naive local datetime (a DATE as
+    midnight at its start).
+    """
+    value = value.strip()
+    if params.get('VALUE') == 'DATE' or len(value) == 8:
+        return datetime.strptime(value, '%Y%m%d')
+    if value.endswith('Z'):
+        utc = datetime.strptime(value[:-1], '%Y%m%dT%H%M%S').replace(tzinfo=tz.tzutc())
+        return utc.astimezone(tz.tzlocal()).replace(tzinfo=None)
+    if params.get('TZID') and tz.gettz(params['TZID']):
+        there = datetime.strptime(value, '%Y%m%dT%H%M%S').replace(tzinfo=tz.gettz(params['TZID']))
+        return there.astimezone(tz.tzlocal()).replace(tzinfo=None)
+    return datetime.strptime(value, '%Y%m%dT%H%M%S')
+
+def parse_duration(value):
+    match = DURATION.match(value.strip().upper())
+    if match is None:
+        raise ValueError("Not a duration: %r" % value)
+    sign, weeks, days, hours, minutes, seconds = match.groups()
+    duration = timedelta(weeks=int(weeks or 0), days=int(days or 0), hours=int(hours or 0),
+        minutes=int(minutes or 0), seconds=int(seconds or 0))
+    if sign == '-':
+        return -duration
+    return duration
+
+def parse_rrule(value):
+    """
+    Returns the Rule fields (``frequency``, ``params`` and ``complex_rule``)
+    for an RRULE value, and its UNTIL as a datetime, or None. Rules that
+    ``Rule.params`` can't hold (e.g. BYDAY=-1FR) become complex rules.
+
+    >>> fields, until = parse_rrule('FREQ=WEEKLY;BYDAY=MO,WE;INTERVAL=2;UNTIL=20101231')
+    >>> fields['frequency'], fields['params'], until
+    ('WEEKLY', 'interval:2;byweekday:0,2', datetime.datetime(2010, 12, 31, 23, 59, 59))
+    """
+    parts = []
+    until = None
+    for part in value.strip().upper().split(';'):
+        key, part_value = part.split('=', 1)
+        if key == 'UNTIL':
+            until = parse_datetime(part_value)
+            if len(part_value) == 8:
+                # the whole of the day
+                until += timedelta(days=1, seconds=-1)
+        else:
+            parts.append((key, part_value))
+    values = dict(parts)
+    simple = values.get('FREQ') in FREQUENCIES
+    params = []
+    for key, part_value in parts:
+        if key == 'FREQ':
+            continue
+        if key not in ICALENDAR_PARAMS:
+            simple = False
+            break
+        if key in ('BYDAY', 'WKST'):
+            if [day for day in part_value.split(',') if day not in ICALENDAR_WEEKDAYS]:
+                simple = False
+                break
+            part_value = ','.join([str(ICALENDAR_WEEKDAYS.index(day)) for day in part_value.split(',')])
+        params.append((ICALENDAR_PARAMS[key], part_value))
+    if simple:
+        params.sort(key=lambda param: RRULE_PARAMS.keyOrder.index(param[0]))
+        fields = {
+            'frequency': values['FREQ'],
+            'params': ';'.join(['%s:%s' % param for param in params]),
+            'complex_rule': '',
+        }
+    else:
+        fields = {
+            'frequency': '',
+            'params': '',
+            'complex_rule': 'RRULE:%s' % ';'.join(['%s=%s' % part for part in parts]),
+        }
+    return fields, until
+
+
+class ICalendarImporter(object):
+    """
+    Imports VEVENTs into ``EventModel`` (an EventBase subclass); see the
+    module docstring. Counts of what was imported are kept in ``counts``.
+    """
+    def __init__(self, EventModel, batch_size=200):
+        self.EventModel = EventModel
+        self.GeneratorModel = models.get_model(EventModel._meta.app_label, EventModel._generator_model_name)
+        self.OccurrenceModel = models.get_model(EventModel._meta.app_label, EventModel._occurrence_model_name)
+        self.batch_size = batch_size
+        self.counts = {'events': 0, 'rules': 0, 'exceptions': 0, 'skipped': 0}
+        self.elapsed = 0
+        self._rules = {}
+        # the generator id and duration of each UID imported, for the
+        # RECURRENCE-IDs that come after it
+        self._generators = {}
+
+    def import_file(self, lines):
+        """
+        Imports the VEVENTs in ``lines`` (e.g. an open .ics file).
+        """
+        started = time.time()
+        batch = []
+        overrides = []
+        # (position, override) of the overrides whose VEVENT hasn't been
+        # imported yet, by UID
+        waiting = {}
+        for position, vevent in enumerate(parse_vevents(lines)):
+            if 'RECURRENCE-ID' in vevent:
+                overrides.append((position, vevent))
+            else:
+                batch.append(vevent)
+            if len(batch) + len(overrides) >= self.batch_size:
+                self._save_batch(batch, overrides, waiting)
+                batch, overrides = [], []
+        self._save_batch(batch, overrides, waiting)
+        # overrides of VEVENTs that aren't in the file are events of their own
+        overrides = sorted([override for uid_overrides in waiting.values() for override in uid_overrides])
+        overrides = [vevent for position, vevent in overrides]
+        for i in range(0, len(overrides), self.batch_size):
+            self._save_batch(overrides[i:i + self.batch_size], [], {})
+        self.elapsed += time.time() - started
+
+    def events_per_second(self):
+        if not self.elapsed:
+            return 0
+        return self.counts['events'] / self.elapsed
+
+    def event_fields(self, vevent):
+        """
+        Returns the field values of the event for ``vevent``. By default,
+        the SUMMARY, DESCRIPTION and LOCATION become the fields ``title``,
+        ``description`` and ``location``, where the event model has them.
+        """
+        fields = {}
+        names = [field.name for field in self.EventModel._meta.fields]
+        for name, property in (('title', 'SUMMARY'), ('description', 'DESCRIPTION'), ('location', 'LOCATION')):
+            if name in names and property in vevent:
+                fields[name] = unescape(vevent[property][0][1])
+        return fields
+
+    def _save_batch(self, vevents, overrides, waiting):
+        """
+        Saves ``vevents``, and the ``overrides`` (with their positions) of
+        VEVENTs that have been imported, as well as those ``waiting`` for the
+        VEVENTs saved now, in one transaction. Overrides whose VEVENTs are
+        still to come are added to ``waiting``.
+
+        The save handlers of the event model are suspended meanwhile, and the
+        materialized and cached occurrences of each generator saved or given
+        exceptions are refreshed once, at the end.
+        """
+        _suspend_handlers(self.EventModel)
+        try:
+            generators = self._save_rows(vevents, overrides, waiting)
+        finally:
+            _resume_handlers(self.EventModel)
+        for generator in generators:
+            _generator_saved(self.GeneratorModel, generator)
+    _save_batch = transaction.commit_on_success(_save_batch)
+
+    def _save_rows(self, vevents, overrides, waiting):
+        # _save_batch's work; returns the generators it saved or gave exceptions
+        overrides = list(overrides)
+        exceptions = {}
+        generators = {}
+        saved = {}
+        for vevent in vevents:
+            try:
+                start, end = self._times(vevent)
+            except (KeyError, ValueError):
+                self.counts['skipped'] += 1
+                continue
+            event = self.EventModel(**self.event_fields(vevent))
+            event.save()
+            generator = self.GeneratorModel(event=event,
+                first_start_date=start.date(), first_start_time=start.time(),
+                first_end_date=end.date(), first_end_time=end.time())
+            if 'RRULE' in vevent:
+                generator.rule, generator.repeat_until = self._rule(vevent['RRULE'][0][1])
+            generator.save()
+            generators[generator.id] = generator
+            saved[generator.id] = generator
+            self.counts['events'] += 1
+            if 'UID' in vevent:
+                uid = vevent['UID'][0][1]
+                self._generators[uid] = (generator.id, end - start)
+                overrides += waiting.pop(uid, [])
+            for params, value in vevent.get('EXDATE', []):
+                for exdate in value.split(','):
+                    exception = self._exception(generator, parse_datetime(exdate, params), end - start)
+                    if exception is None:
+                        self.counts['skipped'] += 1
+                        continue
+                    exception.cancelled = True
+                    exceptions[(generator, exception.unvaried_start)] = exception
+
+        ready = []
+        for position, vevent in overrides:
+            uid = vevent.get('UID', [({}, None)])[0][1]
+            if uid in self._generators:
+                ready.append(vevent)
+            else:
+                waiting.setdefault(uid, []).append((position, vevent))
+        # the generators of earlier batches, in one query
+        earlier = [self._generators[vevent['UID'][0][1]][0] for vevent in ready]
+        earlier = [id for id in earlier if id not in generators]
+        if earlier:
+            for generator in self.GeneratorModel.objects.filter(id__in=earlier).select_related('rule'):
+                generators[generator.id] = generator
+        for vevent in ready:
+            generator_id, duration = self._generators[vevent['UID'][0][1]]
+            generator = generators[generator_id]
+            try:
+                params, value = vevent['RECURRENCE-ID'][0]
+                exception = self._exception(generator, parse_datetime(value, params), duration)
+                start, end = self._times(vevent, duration)
+            except (KeyError, ValueError):
+                self.counts['skipped'] += 1
+                continue
+            if exception is None:
+                self.counts['skipped'] += 1
+                continue
+            exception.varied_start_date, exception.varied_start_time = start.date(), start.time()
+            exception.varied_end_date, exception.varied_end_time = end.date(), end.time()
+            exception.cancelled = vevent.get('STATUS', [({}, '')])[0][1].upper() == 'CANCELLED'
+            # (an override wins over an EXDATE of the same occurrence)
+            exceptions[(generator, exception.unvaried_start)] = exception
+        bulk_create(self.OccurrenceModel, exceptions.values())
+        self.counts['exceptions'] += len(exceptions)
+        for generator, start in exceptions:
+            saved[generator.id] = generator
+        return saved.values()
+
+    def _times(self, vevent, duration=None):
+        params, value = vevent['DTSTART'][0]
+        start = parse_datetime(value, params)
+        if 'DTEND' in vevent:
+            params, value = vevent['DTEND'][0]
+            return start, parse_datetime(value, params)
+        if 'DURATION' in vevent:
+            return start, start + parse_duration(vevent['DURATION'][0][1])
+        if duration is not None:
+            return start, start + duration
+        if params.get('VALUE') == 'DATE' or len(value.strip()) == 8:
+            return start, start + timedelta(days=1)
+        return start, start
+
+    def _rule(self, value):
+        fields, until = parse_rrule(value)
+        key = (fields['frequency'], fields['params'], fields['complex_rule'])
+        if key not in self._rules:
+            rules = Rule.objects.filter(**fields)[:1]
+            if rules:
+                self._rules[key] = rules[0]
+            else:
+                name = fields['complex_rule'] or ('%s %s' % (fields['frequency'], fields['params'])).strip()
+                self._rules[key] = Rule.objects.create(name=name[:100], **fields)
+                self.counts['rules'] += 1
+        return self._rules[key], until
+
+    def _exception(self, generator, start, duration):
+        """
+        Returns an unsaved exception to the occurrence of ``generator`` at
+        ``start``, or None if it has none there.
+        """
+        rule = generator.get_rrule_object()
+        if rule is None:
+            if start != generator.start:
+                return None
+        elif (generator.repeat_until and start > generator.repeat_until) or rule.after(start, inc=True) != start:
+            return None
+        end = start + duration
+        return self.OccurrenceModel(generator=generator,
+            unvaried_start_date=start.date(), unvaried_start_time=start.time(),
+            unvaried_end_date=end.date(), unvaried_end_time=end.time())
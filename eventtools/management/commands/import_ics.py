@@ -0,0 +1,42 @@
+from optparse import make_option
+from django.core.management.base import BaseCommand, CommandError
+from django.db import models
+from eventtools.importing import ICalendarImporter
+
+class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option('--batch-size', dest='batch_size', type='int', default=200,
+            help='Number of VEVENTs saved in each transaction (default: 200).'),
+    )
+    help = "Imports the VEVENTs of the given iCalendar files as events of the given event model (app_label.ModelName), with their generators, rules and exceptional occurrences."
+    args = 'app_label.ModelName file [file ...]'
+
+    def handle(self, *args, **options):
+        if len(args) < 2:
+            raise CommandError("Expected app_label.ModelName and at least one file")
+        label, paths = args[0], args[1:]
+        try:
+            app_label, model_name = label.split('.')
+        except ValueError:
+            raise CommandError("Expected app_label.ModelName, got %r" % label)
+        model = models.get_model(app_label, model_name)
+        if model is None or not hasattr(model, '_generator_model_name'):
+            raise CommandError("%s is not an event model" % label)
+
+        importer = ICalendarImporter(model, batch_size=options['batch_size'])
+        for path in paths:
+            try:
+                ics = open(path)
+            except IOError, e:
+                raise CommandError("Can't read %s: %s" % (path, e))
+            try:
+                importer.import_file(ics)
+            finally:
+                ics.close()
+            if int(options.get('verbosity', 1)) > 0:
+                print "Imported %s" % path
+        if int(options.get('verbosity', 1)) > 0:
+            counts = importer.counts
+            print "%s events (%s new rules, %s exceptional occurrences, %s VEVENTs skipped) in %.1fs: %.0f events/s" % (
+                counts['events'], counts['rules'], counts['exceptions'], counts['skipped'],
+                importer.elapsed, importer.events_per_second())
@@ -0,0 +1,37 @@
+import datetime
+from optparse import make_option
+from django.core.management.base import BaseCommand, CommandError
+from django.db import models
+from eventtools.materialization import materialize
+
+class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option('--days', dest='days', type='int', default=None,
+            help='Number of days ahead to materialize (default: the MATERIALIZATION_HORIZON setting).'),
+    )
+    help = "Rebuilds the materialized occurrences of the given event models (app_label.ModelName), or of every event model that materializes its occurrences. Run it daily to roll the horizon forward. Events are rebuilt 500 at a time, each batch in its own transaction."
+    args = '[app_label.ModelName ...]'
+
+    def handle(self, *labels, **options):
+        if labels:
+            event_models = []
+            for label in labels:
+                try:
+                    app_label, model_name = label.split('.')
+                except ValueError:
+                    raise CommandError("Expected app_label.ModelName, got %r" % label)
+                model = models.get_model(app_label, model_name)
+                if model is None or not getattr(model, 'materialize_occurrences', False):
+                    raise CommandError("%s is not an event model that materializes its occurrences" % label)
+                event_models.append(model)
+        else:
+            event_models = [model for model in models.get_models() if getattr(model, 'materialize_occurrences', False) and hasattr(model, '_materialized_model_name')]
+
+        for model in event_models:
+            if options.get('days') is not None:
+                start = datetime.datetime.combine(datetime.date.today(), datetime.time.min)
+                materialize(model, start, start + datetime.timedelta(days=options['days']))
+            else:
+                materialize(model)
+            if int(options.get('verbosity', 1)) > 0:
+                print "Materialized occurrences of %s" % model._meta.object_name
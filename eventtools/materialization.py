@@ -0,0 +1,238 @@
+"""
+Materialized occurrences.
+
+Expanding rules in Python on every request means that "what's on between X
+and Y" can't be answered by the database. Event models that set
+``materialize_occurrences = True`` get an extra table (ModelNameMaterializedOccurrence)
+holding every occurrence, generated and exceptional, within a horizon that is
+recorded in OccurrenceHorizon. ``get_occurrences_for_events`` (and so Period
+and EventBase.get_occurrences) reads windows inside the horizon from that table
+with one indexed query, and expands rules as usual outside it.
+
+The horizon is rolled forward by calling ``materialize`` regularly, e.g. with
+the ``materialize_occurrences`` management command from a nightly cron job.
+In between, saving or deleting a generator, a Rule or an exceptional
+occurrence refreshes just the rows it affects (the signal handlers are
+connected by EventModelBase). Those refreshes run in the transaction of the
+save or delete, so they are committed or rolled back with it; only
+``materialize`` manages transactions of its own. Rows are always computed
+before they are swapped in, so the table isn't locked while a generator
+re-expands.
+"""
+import datetime
+from django.db import models, transaction
+from django.db.models import Q
+from eventtools.conf.settings import MATERIALIZATION_HORIZON
+from eventtools.models import GeneratedOccurrence, OccurrenceHorizon, exceptions_in_window, get_occurrences_for_events
+from eventtools.utils import OccurrenceReplacer, bulk_create
+
+def _label(EventModel):
+    return "%s.%s" % (EventModel._meta.app_label, EventModel._meta.object_name)
+
+def _materialized_model(EventModel):
+    return models.get_model(EventModel._meta.app_label, EventModel._materialized_model_name)
+
+def get_horizon(EventModel):
+    """
+    Returns the (start, end) window covered by the materialized occurrences of
+    ``EventModel``, or None if they haven't been materialized.
+    """
+    try:
+        horizon = OccurrenceHorizon.objects.get(model=_label(EventModel))
+    except OccurrenceHorizon.DoesNotExist:
+        return None
+    return horizon.start, horizon.end
+
+def _rows(MaterializedModel, occurrences):
+    # occurrences must have their generator cached (it is, by the callers)
+    return [MaterializedModel(
+        event_id=occ.generator.event_id,
+        generator_id=occ.generator_id,
+        occurrence_id=occ.id,
+        unvaried_start=occ.original_start,
+        unvaried_end=occ.original_end,
+        start=occ.start,
+        end=occ.end,
+        cancelled=occ.cancelled,
+    ) for occ in occurrences]
+
+def materialize(EventModel, start=None, end=None, chunk_size=500):
+    """
+    Rebuilds the materialized occurrences of every ``EventModel`` between
+    ``start`` (default: midnight today) and ``end`` (default:
+    MATERIALIZATION_HORIZON days after ``start``), and records that window as
+    the horizon. Events are rebuilt ``chunk_size`` at a time, each chunk in
+    its own short transaction, so the table is never locked for the whole
+    rebuild. Meanwhile the horizon is narrowed to the part of the window that
+    both the old rows and the new ones cover.
+    """
+    if start is None:
+        start = datetime.datetime.combine(datetime.date.today(), datetime.time.min)
+    if end is None:
+        end = start + datetime.timedelta(days=MATERIALIZATION_HORIZON)
+    MaterializedModel = _materialized_model(EventModel)
+    old = get_horizon(EventModel)
+    if old is not None and old[0] < end and start < old[1]:
+        _set_horizon(EventModel, max(old[0], start), min(old[1], end))
+    else:
+        OccurrenceHorizon.objects.filter(model=_label(EventModel)).delete()
+    event_ids = list(EventModel.objects.values_list('id', flat=True))
+    for i in range(0, len(event_ids), chunk_size):
+        _rebuild_events(EventModel, MaterializedModel, event_ids[i:i+chunk_size], start, end)
+    # rows of events deleted since the last rebuild
+    MaterializedModel.objects.exclude(event__in=EventModel.objects.all()).delete()
+    _set_horizon(EventModel, start, end)
+
+def _rebuild_events(EventModel, MaterializedModel, event_ids, start, end):
+    events = EventModel.objects.filter(id__in=event_ids)
+    occurrences = get_occurrences_for_events(events, start, end, materialized=False)
+    MaterializedModel.objects.filter(event__in=event_ids).delete()
+    bulk_create(MaterializedModel, _rows(MaterializedModel, occurrences))
+_rebuild_events = transaction.commit_on_success(_rebuild_events)
+
+def _set_horizon(EventModel, start, end):
+    horizon, created = OccurrenceHorizon.objects.get_or_create(model=_label(EventModel),
+        defaults={'start': start, 'end': end})
+    if not created:
+        horizon.start = start
+        horizon.end = end
+        horizon.save()
+
+def _materialized_rows(events, start, end):
+    # the rows get_materialized_occurrences reads, or None outside the horizon
+    EventModel = events[0].__class__
+    horizon = get_horizon(EventModel)
+    if horizon is None or start < horizon[0] or end > horizon[1]:
+        return None
+    return _materialized_model(EventModel).objects.filter(
+        Q(occurrence__isnull=True, start__lte=end) | Q(occurrence__isnull=False, start__lt=end),
+        Q(occurrence__isnull=True) | Q(cancelled=False) | Q(unvaried_start__lte=end, unvaried_end__gte=start),
+        event__in=[event.id for event in events],
+        end__gte=start,
+    )
+
+def get_materialized_occurrences(events, start, end):
+    """
+    Returns the sorted occurrences of ``events`` between ``start`` and ``end``,
+    read from the materialized table, or None if the window isn't entirely
+    within the horizon.
+
+    The result is the same as expanding the generators: generated occurrences
+    are included if they overlap the window, and exceptional occurrences if
+    they were moved into it, or (even if cancelled) if the occurrence they
+    replace would have been generated in it.
+    """
+    rows = _materialized_rows(events, start, end)
+    if rows is None:
+        return None
+    rows = rows.select_related('generator', 'occurrence')
+    events_by_id = dict([(event.id, event) for event in events])
+    generator_cache = events[0].OccurrenceModel._meta.get_field('generator').get_cache_name()
+    event_cache = events[0].GeneratorModel._meta.get_field('event').get_cache_name()
+
+    generators = {}
+    occurrences = []
+    for row in rows:
+        generator = generators.get(row.generator_id)
+        if generator is None:
+            generator = generators[row.generator_id] = row.generator
+            setattr(generator, event_cache, events_by_id[row.event_id])
+        if row.occurrence_id is None:
+            occurrences.append(GeneratedOccurrence(generator, row.unvaried_start, row.unvaried_end))
+        else:
+            occ = row.occurrence
+            setattr(occ, generator_cache, generator)
+            occurrences.append(occ)
+    return occurrences
+
+def count_materialized_occurrences(events, start, end, include_cancelled=True):
+    """
+    Returns ``len(get_materialized_occurrences(events, start, end))`` (less
+    the cancelled ones, unless ``include_cancelled``) with one COUNT query, or
+    None if the window isn't entirely within the horizon.
+    """
+    rows = _materialized_rows(events, start, end)
+    if rows is None:
+        return None
+    if not include_cancelled:
+        rows = rows.filter(cancelled=False)
+    return rows.count()
+
+def _event_model(generator):
+    return generator._meta.get_field('event').rel.to
+
+def _replace_rows(MaterializedModel, stale, rows):
+    # Insert before deleting, so that the new rows can't be given the keys of
+    # stale ones: when an exceptional occurrence is deleted, Django has already
+    # collected the keys of its rows, and deletes them after we've refreshed.
+    stale_ids = list(stale.values_list('id', flat=True))
+    bulk_create(MaterializedModel, rows)
+    MaterializedModel.objects.filter(id__in=stale_ids).delete()
+
+def refresh_generator(generator):
+    """
+    Recomputes every materialized occurrence of ``generator`` (e.g. after its
+    times or its rule changed). Does nothing if its event model has no
+    materialized occurrences.
+    """
+    EventModel = _event_model(generator)
+    horizon = get_horizon(EventModel)
+    if horizon is None:
+        return
+    start, end = horizon
+    MaterializedModel = _materialized_model(EventModel)
+    generator_cache = generator.OccurrenceModel._meta.get_field('generator').get_cache_name()
+    exceptions = list(generator.occurrences.filter(exceptions_in_window(start, end)))
+    for occ in exceptions:
+        setattr(occ, generator_cache, generator)
+    rows = _rows(MaterializedModel, generator.get_occurrences(start, end, exceptions))
+    _replace_rows(MaterializedModel, MaterializedModel.objects.filter(generator=generator.id), rows)
+
+def refresh_generator_dates(generator, first_date, last_date, occurrence_id=None):
+    """
+    Recomputes the materialized occurrences of ``generator`` whose *unvaried*
+    start falls between ``first_date`` and ``last_date`` (inclusive), and
+    removes any row for the exceptional occurrence ``occurrence_id``. This is
+    all that can change when an exceptional occurrence is saved or deleted.
+    """
+    EventModel = _event_model(generator)
+    horizon = get_horizon(EventModel)
+    if horizon is None:
+        return
+    start, end = horizon
+    MaterializedModel = _materialized_model(EventModel)
+    slice_start = datetime.datetime.combine(first_date, datetime.time.min)
+    slice_end = datetime.datetime.combine(last_date + datetime.timedelta(days=1), datetime.time.min)
+
+    # Generate exactly the occurrences that expanding the whole horizon would
+    # generate with an unvaried start in the slice...
+    difference = generator.end - generator.start
+    generate_from = max(slice_start, start - difference)
+    generate_until = min(slice_end - datetime.timedelta(microseconds=1), end)
+    if generate_from <= generate_until:
+        generated = generator._get_occurrence_list(generate_from + difference, generate_until)
+    else:
+        generated = []
+
+    # ...and replace them the way OccurrenceGeneratorBase.get_occurrences does.
+    generator_cache = generator.OccurrenceModel._meta.get_field('generator').get_cache_name()
+    exceptions = list(generator.occurrences.filter(unvaried_start_date__gte=first_date, unvaried_start_date__lte=last_date))
+    for occ in exceptions:
+        setattr(occ, generator_cache, generator)
+    occ_replacer = OccurrenceReplacer(exceptions)
+    occurrences = []
+    for occ in generated:
+        if occ_replacer.has_occurrence(occ):
+            p_occ = occ_replacer.get_occurrence(occ)
+            if p_occ.start < end and p_occ.end >= start:
+                occurrences.append(p_occ)
+        else:
+            occurrences.append(occ)
+    occurrences += occ_replacer.get_additional_occurrences(start, end)
+
+    stale = Q(unvaried_start__gte=slice_start, unvaried_start__lt=slice_end)
+    if occurrence_id is not None:
+        stale |= Q(occurrence=occurrence_id)
+    _replace_rows(MaterializedModel,
+        MaterializedModel.objects.filter(stale, generator=generator.id),
+        _rows(MaterializedModel, occurrences))
@@ -1,12 +1,23 @@
 # −*− coding: UTF−8 −*−
 from django.db import models
+from django.db.models import Q
+from django.utils.datastructures import SortedDict
 from django.utils.translation import ugettext, ugettext_lazy as _
 from django.template.defaultfilters import date as date_filter
 from datetime import date, datetime, time
-from django.core.exceptions import ObjectDoesNotExist
-from eventtools.utils import OccurrenceReplacer
+from django.core.exceptions import ImproperlyConfigured, ObjectDoesNotExist
+from django.db.models.signals import pre_save, post_save, pre_delete, post_delete
+from eventtools.conf.settings import OCCURRENCE_CACHE, REGULAR_RULE_EXPANSION
+from eventtools.recurrence import RegularPattern, RuleCursor, count_until, nth, ordinal, regular_pattern
+from eventtools.utils import OccurrenceHistogram, OccurrenceReplacer, merge_occurrences, rrule_cache
 from dateutil import rrule
+from itertools import islice
 import sys
+import threading
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 from django.db.models.base import ModelBase
 
@@ -34,6 +45,7 @@ class OccurrenceGeneratorBase(models.Model):
     first_end_time = models.TimeField(_('first end time')) #wasn't originally required, but it turns out you do have to say when an event ends...
     rule = models.ForeignKey('Rule', verbose_name=_("repetition rule"), null = True, blank = True, help_text="Select '----' for a one-off event.")
     repeat_until = models.DateTimeField(null = True, blank = True, help_text=_("This date is ignored for one-off events."))
+    modified = models.DateTimeField(_("modified"), auto_now=True, null=True, editable=False)
     
     class Meta:
         ordering = ('first_start_date', 'first_start_time')
@@ -84,10 +96,18 @@ class OccurrenceGeneratorBase(models.Model):
             'end': date_filter(self.end, date_format),
         }
 
-    def get_occurrences(self, start, end):
-        exceptional_occurrences = self.occurrences.all()
+    def get_occurrences(self, start, end, exceptional_occurrences=None, rule=None):
+        """
+        Return this generator's occurrences between ``start`` and ``end``, with
+        exceptional occurrences swapped in. Pass ``exceptional_occurrences`` if
+        they have already been fetched (see ``get_occurrences_for_events``),
+        and ``rule`` to expand something other than the compiled rule (such as
+        a RuleCursor of it, see ``SlidingExpansion``).
+        """
+        if exceptional_occurrences is None:
+            exceptional_occurrences = self.occurrences.filter(exceptions_in_window(start, end))
         occ_replacer = OccurrenceReplacer(exceptional_occurrences)
-        occurrences = self._get_occurrence_list(start, end)
+        occurrences = self._get_occurrence_list(start, end, rule)
         final_occurrences = []
         for occ in occurrences:
             # replace occurrences with their exceptional counterparts
@@ -106,35 +126,159 @@ class OccurrenceGeneratorBase(models.Model):
         return final_occurrences
         
 
+    def count_occurrences(self, start, end, exceptional_occurrences=None, include_cancelled=True):
+        """
+        Returns ``len(self.get_occurrences(start, end))`` (less the cancelled
+        occurrences, unless ``include_cancelled``) without building any
+        occurrences. Regular rules are counted arithmetically and others by
+        iterating the rule; the exceptional occurrences then correct the count.
+        """
+        if exceptional_occurrences is None:
+            exceptional_occurrences = self.occurrences.filter(exceptions_in_window(start, end))
+        difference = self.end - self.start
+        rule = self.get_rrule_object()
+        if rule is None:
+            starts = set((self.start < end and self.end >= start) and [self.start] or [])
+        else:
+            if self.end_recurring_period and self.end_recurring_period < end:
+                end_generated = self.end_recurring_period
+            else:
+                end_generated = end
+            if isinstance(rule, RegularPattern):
+                starts = None
+                count = rule.count_between(start - difference, end_generated, inc=True)
+            else:
+                starts = set(rule.between(start - difference, end_generated, inc=True))
+        if starts is not None:
+            count = len(starts)
+
+        for occ in exceptional_occurrences:
+            if occ.original_end - occ.original_start != difference:
+                replaces = False
+            elif starts is not None:
+                replaces = occ.original_start in starts
+            else:
+                replaces = start - difference <= occ.original_start <= end_generated and \
+                    rule.after(occ.original_start, inc=True) == occ.original_start
+            if replaces:
+                count -= 1
+            if occ.cancelled and not (replaces and include_cancelled):
+                continue
+            if occ.start < end and occ.end >= start:
+                count += 1
+        return count
+
+    def add_to_histogram(self, histogram, exceptional_occurrences=None, include_cancelled=True):
+        """
+        Adds the occurrences of this generator (less the cancelled ones,
+        unless ``include_cancelled``) to ``histogram``, an
+        OccurrenceHistogram, without building any occurrences. A regular
+        rule with more occurrences than there are bins is counted a bin at a
+        time; otherwise each start the rule produces for the window is added.
+        The exceptional occurrences then correct it, as in
+        ``count_occurrences``.
+        """
+        start, end = histogram.start, histogram.end
+        if exceptional_occurrences is None:
+            exceptional_occurrences = self.occurrences.filter(exceptions_in_window(start, end))
+        difference = self.end - self.start
+        rule = self.get_rrule_object()
+        if rule is None:
+            starts = set((self.start < end and self.end >= start) and [self.start] or [])
+        else:
+            if self.end_recurring_period and self.end_recurring_period < end:
+                end = self.end_recurring_period
+            if isinstance(rule, RegularPattern):
+                starts = None
+                if rule.count_between(start - difference, end, inc=True) > histogram.bins:
+                    histogram.add_pattern(rule, difference, end)
+                else:
+                    for o_start in rule.iter_from(start - difference):
+                        if o_start > end:
+                            break
+                        histogram.add(o_start, o_start + difference)
+            else:
+                starts = set(rule.between(start - difference, end, inc=True))
+        if starts is not None:
+            for o_start in starts:
+                histogram.add(o_start, o_start + difference)
+
+        for occ in exceptional_occurrences:
+            if occ.original_end - occ.original_start != difference:
+                replaces = False
+            elif starts is not None:
+                replaces = occ.original_start in starts
+            else:
+                replaces = start - difference <= occ.original_start <= end
+                if replaces:
+                    try:
+                        rule.index(occ.original_start)
+                    except ValueError:
+                        replaces = False
+            if replaces:
+                histogram.add(occ.original_start, occ.original_end, -1)
+            if occ.cancelled and not (replaces and include_cancelled):
+                continue
+            histogram.add(occ.start, occ.end)
+
+    def get_nth_occurrence(self, n):
+        """
+        Returns the ``n``th (from 0) occurrence of this generator, or raises
+        IndexError. Occurrences are numbered in the order the rule generates
+        them, and an exceptional occurrence has the number of the occurrence it
+        replaces, so moving or cancelling one doesn't renumber the others.
+        """
+        rule = self.get_rrule_object()
+        if rule is None:
+            if n != 0:
+                raise IndexError(n)
+            o_start = self.start
+        else:
+            o_start = nth(rule, n)
+            if self.end_recurring_period and o_start > self.end_recurring_period:
+                raise IndexError(n)
+        return self.check_for_exceptions(self._create_occurrence(o_start))
+
+    def get_occurrence_ordinal(self, occurrence):
+        """
+        Returns the number (from 0) of ``occurrence`` (generated or
+        exceptional) among this generator's occurrences, as used by
+        ``get_nth_occurrence``, or raises ValueError if the rule doesn't
+        generate it.
+        """
+        o_start = occurrence.original_start
+        if occurrence.original_end - o_start != self.end - self.start or \
+            (self.end_recurring_period and o_start > self.end_recurring_period):
+            raise ValueError("%s is not an occurrence of %s" % (o_start, self))
+        rule = self.get_rrule_object()
+        if rule is None:
+            if o_start != self.start:
+                raise ValueError("%s is not an occurrence of %s" % (o_start, self))
+            return 0
+        return ordinal(rule, o_start)
+
+    def get_occurrence_total(self):
+        """
+        Returns the number of occurrences this generator has, or None if it
+        repeats forever.
+        """
+        rule = self.get_rrule_object()
+        if rule is None:
+            return 1
+        if self.end_recurring_period:
+            return count_until(rule, self.end_recurring_period)
+        if self.rule.is_bounded():
+            return count_until(rule, datetime.max)
+        return None
+
     def get_rrule_object(self):
         if self.rule is not None:
-            if self.rule.complex_rule:
-                try:
-                    return rrule.rrulestr(str(self.rule.complex_rule),dtstart=self.start)
-                except:
-                    pass
-            params = self.rule.get_params()
-            frequency = 'rrule.%s' % self.rule.frequency
-            simple_rule = rrule.rrule(eval(frequency), dtstart=self.start, **params)
-            set = rrule.rruleset()
-            set.rrule(simple_rule)
-#             goodfriday = rrule.rrule(rrule.YEARLY, dtstart=self.start, byeaster=-2)
-#             christmas = rrule.rrule(rrule.YEARLY, dtstart=self.start, bymonth=12, bymonthday=25)
-#             set.exrule(goodfriday)
-#             set.exrule(christmas)
-            return set
+            return rrule_cache.get(self.rule, self.start)
 
     def _create_occurrence(self, start, end=None):
         if end is None:
             end = start + (self.end - self.start)
-        occ = self.OccurrenceModel(
-            generator=self,
-            unvaried_start_date=start.date(),
-            unvaried_start_time=start.time(),
-            unvaried_end_date=end.date(),
-            unvaried_end_time=end.time(),
-        )
-        return occ
+        return GeneratedOccurrence(self, start, end)
     
     def check_for_exceptions(self, occ):
         """
@@ -182,12 +326,12 @@ class OccurrenceGeneratorBase(models.Model):
             next_occurrence = self.start
         if next_occurrence == date:
             try:
-                return self.OccurrenceModel.objects.get(generator__event = self, unvaried_start_date = date)
+                return self.OccurrenceModel.objects.get(generator = self, unvaried_start_date = date.date(), unvaried_start_time = date.time())
             except self.OccurrenceModel.DoesNotExist:
                 return self._create_occurrence(next_occurrence)
         # import pdb; pdb.set_trace()
 
-    def _get_occurrence_list(self, start, end):
+    def _get_occurrence_list(self, start, end, rule=None):
         """
         generates a list of unexceptional occurrences for this event from start to end.
         """
@@ -197,7 +341,8 @@ class OccurrenceGeneratorBase(models.Model):
             occurrences = []
             if self.end_recurring_period and self.end_recurring_period < end:
                 end = self.end_recurring_period
-            rule = self.get_rrule_object()
+            if rule is None:
+                rule = self.get_rrule_object()
             o_starts = rule.between(start-difference, end, inc=True)
             for o_start in o_starts:
                 o_end = o_start + difference
@@ -210,6 +355,23 @@ class OccurrenceGeneratorBase(models.Model):
             else:
                 return []
                         
+    def _get_start_array(self, start, end):
+        """
+        The starts of ``_get_occurrence_list(start, end)``, as a NumPy array of
+        datetime64[s] values.
+        """
+        if self.rule is not None:
+            if self.end_recurring_period and self.end_recurring_period < end:
+                end = self.end_recurring_period
+            rule = self.get_rrule_object()
+            difference = self.end - self.start
+            if isinstance(rule, RegularPattern):
+                return rule.between_array(start - difference, end, inc=True)
+            return numpy.array(rule.between(start - difference, end, inc=True), dtype='datetime64[s]')
+        if self.start < end and self.end >= start:
+            return numpy.array([self.start], dtype='datetime64[s]')
+        return numpy.array([], dtype='datetime64[s]')
+
     def _occurrences_after_generator(self, after=None):
         """
         returns a generator that produces unexceptional occurrences after the
@@ -217,34 +379,47 @@ class OccurrenceGeneratorBase(models.Model):
         """
 
         if after is None:
-            after = datetime.datetime.now()
+            after = datetime.now()
         rule = self.get_rrule_object()
         if rule is None:
             if self.end > after:
                 yield self._create_occurrence(self.start, self.end)
-            raise StopIteration
-        date_iter = iter(rule)
+            return
+        end_recurring_period = self.end_recurring_period
         difference = self.end - self.start
-        while True:
-            o_start = date_iter.next()
-            if o_start > self.end_recurring_period:
-                raise StopIteration
+        if isinstance(rule, RegularPattern):
+            # skip straight to the first occurrence that ends after ``after``
+            o_starts = rule.iter_from(after - difference, inc=False)
+        else:
+            o_starts = iter(rule)
+        for o_start in o_starts:
+            if end_recurring_period and o_start > end_recurring_period:
+                return
             o_end = o_start + difference
             if o_end > after:
                 yield self._create_occurrence(o_start, o_end)
 
-
-    def occurrences_after(self, after=None):
+    def occurrences_after(self, after=None, exceptional_occurrences=None):
         """
         returns a generator that produces occurrences after the datetime
-        ``after``.	Includes all of the exceptional Occurrences.
+        ``after``, in start order. Includes all of the exceptional Occurrences.
+        Pass ``exceptional_occurrences`` if they have already been fetched (see
+        ``get_occurrences_after_for_events``).
+
+        An exceptional occurrence takes the place of the occurrence it replaces
+        if that would have been produced (even if it is cancelled), and is
+        otherwise included if it has been moved after ``after`` and isn't
+        cancelled.
         """
-        occ_replacer = OccurrenceReplacer(self.occurrence_set.all())
-        generator = self._occurrences_after_generator(after)
-        while True:
-            next = generator.next()
-            yield occ_replacer.get_occurrence(next)
-
+        if after is None:
+            after = datetime.now()
+        if exceptional_occurrences is None:
+            exceptional_occurrences = self.occurrences.filter(exceptions_in_window(after, datetime.max))
+        occ_replacer = OccurrenceReplacer(exceptional_occurrences)
+        exceptions = sorted([occ for occ in occ_replacer.lookup.values() if occ.end > after and
+            (occ.original_end > after or not occ.cancelled)])
+        generated = (occ for occ in self._occurrences_after_generator(after) if not occ_replacer.has_occurrence(occ))
+        return merge_occurrences([generated, iter(exceptions)])
 
 class MergedObject():
     """
@@ -277,6 +452,130 @@ class MergedObject():
     
         
 
+def _promotable(name, unpromoted):
+    """
+    A GeneratedOccurrence property that returns ``unpromoted(occurrence)`` until
+    the occurrence is promoted, and the promoted instance's ``name`` after that.
+    Setting it promotes the occurrence.
+    """
+    def fget(self):
+        if self._occurrence is None:
+            return unpromoted(self)
+        return getattr(self._occurrence, name)
+    def fset(self, value):
+        setattr(self.promote(), name, value)
+    return property(fget, fset)
+
+class GeneratedOccurrence(object):
+    """
+    A lightweight, unsaved occurrence as produced by an OccurrenceGenerator's rule.
+
+    Generators can produce thousands of occurrences for a single calendar page,
+    so rather than a model instance each one is a small slotted object with the
+    same read API as OccurrenceBase (start, end, original_start, cancelled,
+    generator, merged_event, sorting, ...). It is promoted to an instance of the
+    generator's OccurrenceModel only when something changes, saves or cancels it,
+    or asks for an attribute that only the model has; after that every attribute
+    is read from, and written to, the promoted instance.
+    """
+    __slots__ = ('generator', '_start', '_end', '_occurrence')
+
+    def __init__(self, generator, start, end):
+        object.__setattr__(self, 'generator', generator)
+        object.__setattr__(self, '_start', start)
+        object.__setattr__(self, '_end', end)
+        object.__setattr__(self, '_occurrence', None)
+
+    def promote(self):
+        """
+        Return the OccurrenceModel instance for this occurrence, creating (but
+        not saving) it the first time.
+        """
+        if self._occurrence is None:
+            object.__setattr__(self, '_occurrence', self.generator.OccurrenceModel(
+                generator=self.generator,
+                unvaried_start_date=self._start.date(),
+                unvaried_start_time=self._start.time(),
+                unvaried_end_date=self._end.date(),
+                unvaried_end_time=self._end.time(),
+            ))
+        return self._occurrence
+
+    def __getattr__(self, name):
+        if name.startswith('__') or name in GeneratedOccurrence.__slots__:
+            raise AttributeError(name)
+        return getattr(self.promote(), name)
+
+    def __setattr__(self, name, value):
+        if name in GeneratedOccurrence.__slots__ or hasattr(GeneratedOccurrence, name):
+            object.__setattr__(self, name, value)
+        else:
+            setattr(self.promote(), name, value)
+
+    start = varied_start = _promotable('varied_start', lambda self: self._start)
+    end = varied_end = _promotable('varied_end', lambda self: self._end)
+    original_start = unvaried_start = _promotable('unvaried_start', lambda self: self._start)
+    original_end = unvaried_end = _promotable('unvaried_end', lambda self: self._end)
+
+    unvaried_start_date = _promotable('unvaried_start_date', lambda self: self._start.date())
+    unvaried_start_time = _promotable('unvaried_start_time', lambda self: self._start.time())
+    unvaried_end_date = _promotable('unvaried_end_date', lambda self: self._end.date())
+    unvaried_end_time = _promotable('unvaried_end_time', lambda self: self._end.time())
+    varied_start_date = _promotable('varied_start_date', lambda self: self._start.date())
+    varied_start_time = _promotable('varied_start_time', lambda self: self._start.time())
+    varied_end_date = _promotable('varied_end_date', lambda self: self._end.date())
+    varied_end_time = _promotable('varied_end_time', lambda self: self._end.time())
+    start_time = _promotable('start_time', lambda self: self._start.time())
+    end_time = _promotable('end_time', lambda self: self._end.time())
+
+    id = pk = _promotable('id', lambda self: None)
+    cancelled = _promotable('cancelled', lambda self: False)
+    is_moved = _promotable('is_moved', lambda self: False)
+    is_varied = _promotable('is_varied', lambda self: False)
+    varied_event = _promotable('varied_event', lambda self: None)
+    unvaried_event = _promotable('unvaried_event', lambda self: self.generator.event)
+    merged_event = _promotable('merged_event', lambda self: MergedObject(self.generator.event, None))
+
+    def save(self, *args, **kwargs):
+        self.promote().save(*args, **kwargs)
+
+    def cancel(self):
+        self.promote().cancel()
+
+    def uncancel(self):
+        self.promote().uncancel()
+
+    def __unicode__(self):
+        return OccurrenceBase.__unicode__.im_func(self)
+
+    def __repr__(self):
+        return '<%s: %s>' % (self.__class__.__name__, unicode(self).encode('utf-8'))
+
+    def unvaried_range_string(self):
+        return OccurrenceBase.unvaried_range_string.im_func(self)
+
+    def varied_range_string(self):
+        return OccurrenceBase.varied_range_string.im_func(self)
+
+    def __cmp__(self, other): #used for sorting occurrences.
+        rank = cmp(self.start, other.start)
+        if rank == 0:
+            return cmp(self.end, other.end)
+        return rank
+
+    def __eq__(self, other):
+        return self.generator_id == other.generator_id and self.original_start == other.original_start and self.original_end == other.original_end
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    def __hash__(self):
+        return hash((self.generator_id, self.original_start, self.original_end))
+
+    def _generator_id(self):
+        return self.generator.id
+    generator_id = property(_generator_id)
+
 class OccurrenceBase(models.Model):
     """
     Occurrences represent an occurrence of an event, which have been lazily generated by one of the event's OccurrenceGenerators. The foreign key to the right 'OccurrenceGenerator' is monkeypatched in to the 'OccurrenceBase' subclass. This foreign key is called 'generator'.
@@ -301,6 +600,7 @@ class OccurrenceBase(models.Model):
     varied_end_time = models.TimeField(_("varied end time"), blank=True, null=True, db_index=True)
     
     cancelled = models.BooleanField(_("cancelled"), default=False)
+    modified = models.DateTimeField(_("modified"), auto_now=True, null=True, editable=False)
 
     #_varied_event will be injected by eventmodelbase because we don't yet know the name of the varied event model.
     
@@ -428,7 +728,10 @@ class OccurrenceBase(models.Model):
         return rank
 
     def __eq__(self, other):
-        return self.generator.event == other.generator.event and self.original_start == other.original_start and self.original_end == other.original_end
+        return self.generator_id == other.generator_id and self.original_start == other.original_start and self.original_end == other.original_end
+
+    def __hash__(self):
+        return hash((self.generator_id, self.original_start, self.original_end))
         
     def _get_varied_event(self):
         try:
@@ -446,6 +749,36 @@ class OccurrenceBase(models.Model):
         return self.generator.event
     unvaried_event = property(_get_unvaried_event)
 
+class MaterializedOccurrenceBase(models.Model):
+    """
+    A precomputed occurrence: either a plain generated occurrence, or (if
+    ``occurrence`` is set) an exceptional occurrence stored in the database.
+
+    These rows are only created for EventBase subclasses that set
+    ``materialize_occurrences = True``. The foreign keys to the event, the
+    generator and the exceptional occurrence are injected by EventModelBase.
+    """
+    unvaried_start = models.DateTimeField()
+    unvaried_end = models.DateTimeField()
+    start = models.DateTimeField(db_index=True)
+    end = models.DateTimeField(db_index=True)
+    cancelled = models.BooleanField(default=False)
+
+    class Meta:
+        abstract = True
+        ordering = ('start', 'end')
+
+class OccurrenceHorizon(models.Model):
+    """
+    Records the window that the materialized occurrences of an event model cover.
+    """
+    model = models.CharField(max_length=255, unique=True)
+    start = models.DateTimeField()
+    end = models.DateTimeField()
+
+    def __unicode__(self):
+        return u"%s: %s-%s" % (self.model, self.start, self.end)
+
 class EventModelBase(ModelBase):
     def __init__(cls, name, bases, attrs):
         """
@@ -475,6 +808,10 @@ class EventModelBase(ModelBase):
             
             # add a foreign key back to the event class
             generator_class.add_to_class('event', models.ForeignKey(cls, related_name = 'generators'))
+            post_save.connect(_generator_saved, sender=generator_class)
+            # (a deleted generator's materialized occurrences are deleted with it)
+            pre_delete.connect(_generator_deleting, sender=generator_class)
+            post_delete.connect(_generator_deleted, sender=generator_class)
 
             # Create the occurrence class
             # globals()[occ_name]
@@ -486,10 +823,29 @@ class EventModelBase(ModelBase):
             occurrence_class = sys.modules[cls.__module__].__dict__[occ_name]
 
             occurrence_class.add_to_class('generator', models.ForeignKey(generator_class, related_name = 'occurrences'))
+            pre_save.connect(_occurrence_saving, sender=occurrence_class)
+            post_save.connect(_occurrence_changed, sender=occurrence_class)
+            post_delete.connect(_occurrence_deleted, sender=occurrence_class)
+            _event_models.append(cls)
             if hasattr(cls, 'varied_by'):
                 occurrence_class.add_to_class('_varied_event', models.ForeignKey(cls.varied_by, related_name = 'occurrences', null=True))
                # we need to add an unvaried_event FK into the variation class, BUT at this point the variation class hasn't been defined yet. For now, let's insist that this is done by using a base class for variation.
 
+            # Optionally create a table of materialized occurrences (see eventtools.materialization)
+            if getattr(cls, 'materialize_occurrences', False):
+                mat_name = "%s%s" % (name, "MaterializedOccurrence")
+                cls.add_to_class('_materialized_model_name', mat_name)
+                setattr(sys.modules[cls.__module__], mat_name, type(mat_name,
+                        (MaterializedOccurrenceBase,),
+                        dict(__module__ = cls.__module__,),
+                    )
+                )
+                materialized_class = sys.modules[cls.__module__].__dict__[mat_name]
+                materialized_class.add_to_class('event', models.ForeignKey(cls, related_name = 'materialized_occurrences'))
+                materialized_class.add_to_class('generator', models.ForeignKey(generator_class, related_name = 'materialized_occurrences'))
+                materialized_class.add_to_class('occurrence', models.ForeignKey(occurrence_class, related_name = 'materializations', null=True))
+                _materialized_event_models.append(cls)
+
         super(EventModelBase, cls).__init__(name, bases, attrs)
         
 class EventBase(models.Model):
@@ -500,6 +856,10 @@ class EventBase(models.Model):
     """
     __metaclass__ = EventModelBase
 
+    materialize_occurrences = False
+
+    modified = models.DateTimeField(_("modified"), auto_now=True, null=True, editable=False)
+
     class Meta:
         abstract = True
 
@@ -515,6 +875,11 @@ class EventBase(models.Model):
         return models.get_model(self._meta.app_label, self._generator_model_name)
     GeneratorModel = property(_generator_model)
 
+    def _materialized_model(self):
+        if hasattr(self, '_materialized_model_name'):
+            return models.get_model(self._meta.app_label, self._materialized_model_name)
+    MaterializedModel = property(_materialized_model)
+
     def first_generator(self):
         return self.generators.order_by('first_start_date', 'first_start_time')[0]
         
@@ -531,11 +896,13 @@ class EventBase(models.Model):
             raise IndexError("This Event type has no generators defined")
     
     def get_occurrences(self, start, end):
-        occs = []
-        for gen in self.generators.all():
-            occs += gen.get_occurrences(start, end)
-        return sorted(occs)
+        return get_occurrences_for_events([self], start, end)
 
+    def occurrences_after(self, after=None):
+        return get_occurrences_after_for_events([self], after)
+
+    def count_occurrences(self, start, end, include_cancelled=True):
+        return count_occurrences_for_events([self], start, end, include_cancelled)
 
         
     def get_last_day(self):
@@ -552,7 +919,16 @@ class EventBase(models.Model):
     has_zero_generators = property(_has_zero_generators)
         
     def _has_multiple_occurrences(self):
-        return self.generators.count() > 1 or (self.generators.count() > 0 and self.generators.all()[0].rule != None)
+        generators = list(self.generators.select_related('rule')[:2])
+        if len(generators) != 1:
+            return len(generators) > 1
+        generator = generators[0]
+        rule = generator.get_rrule_object()
+        if rule is None:
+            return False
+        # a second start, unless the rule (or repeat_until) stops at one
+        second = list(islice(rule, 2))[1:]
+        return bool(second) and not (generator.end_recurring_period and second[0] > generator.end_recurring_period)
     has_multiple_occurrences = property(_has_multiple_occurrences)
 
     def edit_occurrences_link(self):
@@ -622,6 +998,287 @@ class EventBase(models.Model):
             period = Period(self.generators.all(), datetime.datetime.now(), datetime.datetime.now() + datetime.timedelta(days=28))		
         return period.get_occurrences()
 
+def _overlapping(prefix, start, end):
+    # an omitted end date means the occurrence ends on the day it starts.
+    return Q(**{'%s_start_date__lte' % prefix: end.date()}) & (
+        Q(**{'%s_end_date__gte' % prefix: start.date()}) |
+        Q(**{'%s_end_date__isnull' % prefix: True, '%s_start_date__gte' % prefix: start.date()})
+    )
+
+def exceptions_in_window(start, end):
+    """
+    Returns a Q object matching the exceptional occurrences that can affect
+    the occurrences between ``start`` and ``end``: those that replace an
+    occurrence generated in the window (matched on the unvaried dates) and
+    those that have been moved into the window (matched on the varied dates).
+
+    The filter works on the indexed date columns, so it is a superset at the
+    ends of the window; OccurrenceReplacer does the exact comparison.
+    """
+    return _overlapping('unvaried', start, end) | _overlapping('varied', start, end)
+
+def get_occurrences_for_events(events, start, end, materialized=True):
+    """
+    Return the sorted occurrences of ``events`` (instances of one EventBase
+    subclass) between ``start`` and ``end``.
+
+    If the event model materializes its occurrences and the window is within
+    the materialized horizon, the occurrences are read from that table.
+    Otherwise all the generators are fetched in one query and all the
+    exceptional occurrences in another, however many events and generators
+    there are; the exceptions are then handed to the generator they belong to.
+    """
+    events = list(events)
+    if not events:
+        return []
+    if materialized and events[0].MaterializedModel is not None:
+        from eventtools.materialization import get_materialized_occurrences
+        occs = get_materialized_occurrences(events, start, end)
+        if occs is not None:
+            return occs
+    generators, exceptions = _generators_and_exceptions(events, exceptions_in_window(start, end))
+    occs = []
+    for generator in generators:
+        occs += generator.get_occurrences(start, end, exceptions[generator.id])
+    return sorted(occs)
+
+def count_occurrences_for_events(events, start, end, include_cancelled=True):
+    """
+    Returns ``len(get_occurrences_for_events(events, start, end))`` (less the
+    cancelled occurrences, unless ``include_cancelled``) without building the
+    occurrences: with one COUNT query within the materialized horizon, and
+    otherwise with ``OccurrenceGeneratorBase.count_occurrences`` after
+    fetching the generators and exceptions in two queries.
+    """
+    events = list(events)
+    if not events:
+        return 0
+    if events[0].MaterializedModel is not None:
+        from eventtools.materialization import count_materialized_occurrences
+        count = count_materialized_occurrences(events, start, end, include_cancelled)
+        if count is not None:
+            return count
+    generators, exceptions = _generators_and_exceptions(events, exceptions_in_window(start, end))
+    return sum([generator.count_occurrences(start, end, exceptions[generator.id], include_cancelled) for
+        generator in generators])
+
+def get_occurrence_histogram_for_events(events, start, end, size, include_cancelled=True):
+    """
+    Returns the number of occurrences of ``events`` (instances of one
+    EventBase subclass) overlapping each ``size`` long bin from ``start`` to
+    ``end``, as an array of integers (see OccurrenceHistogram), less the
+    cancelled occurrences unless ``include_cancelled``. No occurrences are
+    built: the generators and exceptions are fetched in two queries and
+    ``OccurrenceGeneratorBase.add_to_histogram`` does the rest.
+    """
+    histogram = OccurrenceHistogram(start, end, size)
+    events = list(events)
+    if events:
+        generators, exceptions = _generators_and_exceptions(events, exceptions_in_window(start, end))
+        for generator in generators:
+            generator.add_to_histogram(histogram, exceptions[generator.id], include_cancelled)
+    return histogram.counts()
+
+def get_occurrences_after_for_events(events, after=None):
+    """
+    Returns a generator that produces the occurrences of ``events`` (instances
+    of one EventBase subclass) after the datetime ``after``, in start order.
+
+    The generators and the exceptional occurrences that can affect them are
+    fetched in two queries up front; the occurrences themselves are merged
+    lazily, so taking the next few only iterates each rule as far as needed.
+    """
+    if after is None:
+        after = datetime.now()
+    events = list(events)
+    if not events:
+        return iter([])
+    generators, exceptions = _generators_and_exceptions(events, exceptions_in_window(after, datetime.max))
+    return merge_occurrences([generator.occurrences_after(after, exceptions[generator.id]) for
+        generator in generators])
+
+OCCURRENCE_ARRAY_DTYPE = [
+    ('generator_id', 'int64'),
+    ('occurrence_id', 'int64'), # -1 for generated occurrences
+    ('start', 'datetime64[s]'),
+    ('end', 'datetime64[s]'),
+    ('cancelled', 'bool'),
+]
+
+def get_occurrence_arrays_for_events(events, start, end):
+    """
+    Returns the same occurrences as ``get_occurrences_for_events`` (expanding
+    the generators, even if the event model materializes its occurrences), as
+    a NumPy record array of OCCURRENCE_ARRAY_DTYPE sorted by start and end.
+
+    Regular rules are expanded straight into arrays and no occurrence objects
+    are built, which makes this much cheaper for year views, exports and
+    statistics over thousands of generators. Requires NumPy.
+    """
+    if numpy is None:
+        raise ImproperlyConfigured("get_occurrence_arrays_for_events requires NumPy")
+    events = list(events)
+    if not events:
+        return numpy.zeros(0, dtype=OCCURRENCE_ARRAY_DTYPE)
+    generators, exceptions = _generators_and_exceptions(events, exceptions_in_window(start, end))
+    chunks = []
+    for generator in generators:
+        difference = generator.end - generator.start
+        starts = generator._get_start_array(start, end)
+        # swap in the exceptions the way OccurrenceReplacer does
+        replaced = set()
+        keys = [occ.original_start for occ in exceptions[generator.id] if occ.original_end - occ.original_start == difference]
+        if keys:
+            is_replaced = numpy.in1d(starts, numpy.array(keys, dtype='datetime64[s]'))
+            replaced = set(starts[is_replaced].astype(object))
+            starts = starts[~is_replaced]
+        chunk = numpy.zeros(len(starts), dtype=OCCURRENCE_ARRAY_DTYPE)
+        chunk['generator_id'] = generator.id
+        chunk['occurrence_id'] = -1
+        chunk['start'] = starts
+        chunk['end'] = starts + numpy.timedelta64(difference.days * 86400 + difference.seconds, 's')
+        chunks.append(chunk)
+
+        kept = [occ for occ in exceptions[generator.id] if occ.start < end and occ.end >= start and
+            (not occ.cancelled or (occ.original_start in replaced and occ.original_end - occ.original_start == difference))]
+        if kept:
+            chunks.append(numpy.array([(generator.id, occ.id, occ.start, occ.end, occ.cancelled) for occ in kept],
+                dtype=OCCURRENCE_ARRAY_DTYPE))
+    if not chunks:
+        return numpy.zeros(0, dtype=OCCURRENCE_ARRAY_DTYPE)
+    result = numpy.concatenate(chunks)
+    return result[numpy.lexsort((result['end'], result['start']))]
+
+def _generators_and_exceptions(events, exceptions_filter):
+    """
+    Fetches the generators of ``events`` in one query and their exceptional
+    occurrences matching ``exceptions_filter`` in another. Returns the
+    generators (with their event cached) and a dict of their exceptions (with
+    their generator cached) by generator id.
+    """
+    generators = _generators_for_events(events)
+    exceptions = dict([(generator.id, []) for generator in generators])
+    for occ in _exceptions_for_generators(generators, exceptions_filter):
+        exceptions[occ.generator_id].append(occ)
+    return generators, exceptions
+
+def _generators_for_events(events):
+    """
+    Returns the generators of ``events`` (fetched in one query), with their
+    event cached.
+    """
+    events_by_id = dict([(event.id, event) for event in events])
+    GeneratorModel = events[0].GeneratorModel
+    generators = list(GeneratorModel.objects.filter(event__in=events_by_id.keys()).select_related('rule'))
+    event_cache = GeneratorModel._meta.get_field('event').get_cache_name()
+    for generator in generators:
+        setattr(generator, event_cache, events_by_id[generator.event_id])
+    return generators
+
+def _exceptions_for_generators(generators, exceptions_filter):
+    """
+    Returns the exceptional occurrences of ``generators`` matching
+    ``exceptions_filter`` (fetched in one query), with their generator cached.
+    """
+    if not generators:
+        return []
+    generators_by_id = dict([(generator.id, generator) for generator in generators])
+    OccurrenceModel = generators[0].event.OccurrenceModel
+    generator_cache = OccurrenceModel._meta.get_field('generator').get_cache_name()
+    occs = list(OccurrenceModel.objects.filter(exceptions_filter, generator__in=generators_by_id.keys()))
+    for occ in occs:
+        setattr(occ, generator_cache, generators_by_id[occ.generator_id])
+    return occs
+
+class SlidingExpansion(object):
+    """
+    Expands the occurrences of ``events`` (instances of one EventBase
+    subclass) for one window after another, as when paging through a calendar
+    or scrolling an agenda. It is what ``get_occurrences_for_events`` does for
+    each window, except that:
+
+    * the generators are fetched once, for the first window;
+    * the exceptional occurrences held for the previous windows are kept
+      while they may still matter, and only those of the part of a window
+      that no previous window covered are fetched;
+    * an irregular rule carries on iterating from where the previous window
+      stopped (see RuleCursor), rather than from its start, when the windows
+      move forward. (Regular rules seek to any window anyway.)
+
+    Windows within the materialized horizon are read from that table, as
+    with ``get_occurrences_for_events``.
+    """
+    def __init__(self, events):
+        self.events = list(events)
+        self._generators = None
+        # RuleCursors of the irregular rules, by generator id
+        self._cursors = {}
+        self._exceptions = []
+        self._covered = None
+
+    def _get_generators(self):
+        if self._generators is None:
+            self._generators = _generators_for_events(self.events)
+            for generator in self._generators:
+                rule = generator.get_rrule_object()
+                if rule is not None and not isinstance(rule, RegularPattern):
+                    self._cursors[generator.id] = RuleCursor(rule)
+        return self._generators
+
+    def _get_exceptions(self, start, end):
+        """
+        The exceptional occurrences that may matter between ``start`` and
+        ``end``: those held from the previous windows, and those of the parts
+        of the window they didn't cover, which are fetched (one query each).
+        """
+        covered = self._covered
+        if covered is None or start > covered[1] or end < covered[0]:
+            held, uncovered = [], [(start, end)]
+        else:
+            held, uncovered = self._exceptions, []
+            if start < covered[0]:
+                uncovered.append((start, covered[0]))
+            if end > covered[1]:
+                uncovered.append((covered[1], end))
+        fetched = []
+        for window in uncovered:
+            fetched += _exceptions_for_generators(self._get_generators(), exceptions_in_window(*window))
+        ids = set([occ.id for occ in held])
+        exceptions = list(held)
+        for occ in fetched:
+            if occ.id not in ids:
+                ids.add(occ.id)
+                exceptions.append(occ)
+        # keep those whose replaced or actual occurrence touches the window
+        self._exceptions = [occ for occ in exceptions
+            if (occ.unvaried_start <= end and occ.unvaried_end >= start) or
+                (occ.start <= end and occ.end >= start)]
+        self._covered = (start, end)
+        return self._exceptions
+
+    def get_occurrences(self, start, end):
+        """
+        Returns the sorted occurrences of the events between ``start`` and
+        ``end``, the same as ``get_occurrences_for_events``.
+        """
+        if not self.events:
+            return []
+        if self.events[0].MaterializedModel is not None:
+            from eventtools.materialization import get_materialized_occurrences
+            occs = get_materialized_occurrences(self.events, start, end)
+            if occs is not None:
+                return occs
+        generators = self._get_generators()
+        if not generators:
+            return []
+        exceptions = dict([(generator.id, []) for generator in generators])
+        for occ in self._get_exceptions(start, end):
+            exceptions[occ.generator_id].append(occ)
+        occs = []
+        for generator in generators:
+            occs += generator.get_occurrences(start, end, exceptions[generator.id], self._cursors.get(generator.id))
+        return sorted(occs)
+
 class EventVariationModelBase(ModelBase):
     def __init__(cls, name, bases, attrs):
         if name != 'EventVariationBase': # This should only fire if this is a subclass
@@ -629,6 +1286,8 @@ class EventVariationModelBase(ModelBase):
             #Uses the unDRY cls.varies to name the class to FK to.
             if not attrs.has_key('unvaried_event'):
                 cls.add_to_class('unvaried_event', models.ForeignKey(cls.varies, related_name="variations"))
+            post_save.connect(_variation_changed, sender=cls)
+            post_delete.connect(_variation_deleted, sender=cls)
                 
         super(EventVariationModelBase, cls).__init__(name, bases, attrs)
 
@@ -637,6 +1296,7 @@ class EventVariationBase(models.Model):
     __metaclass__ = EventVariationModelBase
     
     reason = models.CharField(_("Short reason for variation"), max_length = 255, help_text=_("this won't normally be shown to visitors, but is useful for identifying this variation in lists"))
+    modified = models.DateTimeField(_("modified"), auto_now=True, null=True, editable=False)
 
     def __unicode__(self):
         return self.reason
@@ -652,6 +1312,25 @@ freqs = (
     ("HOURLY", _("Hourly")),
 )
 
+# the iCalendar names of the parameters Rule.get_params understands, in the
+# order they are written
+RRULE_PARAMS = SortedDict([
+    ('interval', 'INTERVAL'),
+    ('count', 'COUNT'),
+    ('wkst', 'WKST'),
+    ('bysetpos', 'BYSETPOS'),
+    ('bymonth', 'BYMONTH'),
+    ('bymonthday', 'BYMONTHDAY'),
+    ('byyearday', 'BYYEARDAY'),
+    ('byweekno', 'BYWEEKNO'),
+    ('byweekday', 'BYDAY'),
+    ('byhour', 'BYHOUR'),
+    ('byminute', 'BYMINUTE'),
+    ('bysecond', 'BYSECOND'),
+])
+
+ICALENDAR_WEEKDAYS = ('MO', 'TU', 'WE', 'TH', 'FR', 'SA', 'SU')
+
 class Rule(models.Model):
     """
     This defines a rule by which an event will repeat.  This is defined by the
@@ -687,6 +1366,7 @@ class Rule(models.Model):
     frequency = models.CharField(_("frequency"), choices=freqs, max_length=10, blank=True, help_text=_("the base repetition period."))
     params = models.TextField(_("inclusion parameters"), blank=True, help_text=_("extra params required to define this type of repetition."))
     complex_rule = models.TextField(_("complex rules"), help_text=_("over-rides all other settings."), blank=True)
+    modified = models.DateTimeField(_("modified"), auto_now=True, null=True, editable=False)
 
     class Meta:
         verbose_name = _('repetition rule')
@@ -699,7 +1379,7 @@ class Rule(models.Model):
         >>> rule.get_params()
         {'count': 1, 'byminute': [1, 2, 4, 5], 'bysecond': 1}
         """
-    	params = self.params
+        params = self.params
         if params is None:
             return {}
         params = params.split(';')
@@ -712,8 +1392,207 @@ class Rule(models.Model):
                     param = (param[0], param[1][0])
                 param_dict.append(param)
         return dict(param_dict)
-        
+
+    def to_rrule(self, until=None):
+        """
+        Returns this rule as the value of an iCalendar RRULE property (e.g.
+        'FREQ=WEEKLY;BYDAY=MO,WE'), ending at ``until`` if given, or None if
+        it can't be written as one (BYEASTER is a dateutil extension, a
+        complex rule may be a whole ruleset, and an RRULE can't end both
+        after a count and at ``until``).
+
+        >>> Rule(frequency="WEEKLY", params="interval:2;byweekday:0,2").to_rrule()
+        'FREQ=WEEKLY;INTERVAL=2;BYDAY=MO,WE'
+        """
+        if self.complex_rule:
+            lines = str(self.complex_rule).strip().splitlines()
+            if len(lines) != 1:
+                return None
+            value = lines[0].upper()
+            if value.startswith('RRULE:'):
+                value = value[len('RRULE:'):]
+            if not value.startswith('FREQ='):
+                return None
+            parts = [value]
+        elif self.frequency:
+            parts = ['FREQ=%s' % self.frequency]
+            params = self.get_params()
+            for key in RRULE_PARAMS:
+                if key not in params:
+                    continue
+                values = params.pop(key)
+                if not isinstance(values, list):
+                    values = [values]
+                if key in ('byweekday', 'wkst'):
+                    values = [ICALENDAR_WEEKDAYS[value] for value in values]
+                parts.append('%s=%s' % (RRULE_PARAMS[key], ','.join([str(value) for value in values])))
+            if params:
+                return None
+        else:
+            return None
+        if until is not None:
+            # an RRULE can't have both (and a complex rule may have one)
+            if 'COUNT=' in parts[0] or 'UNTIL=' in parts[0] or 'count' in self.get_params():
+                return None
+            parts.append('UNTIL=%s' % until.strftime('%Y%m%dT%H%M%S'))
+        return ';'.join(parts)
+
+    def compile(self, dtstart):
+        """
+        Build the dateutil rule (or ruleset) for this Rule, starting at
+        ``dtstart``, or an equivalent RegularPattern if the rule is regular
+        enough to be expanded without iterating from ``dtstart`` (see
+        eventtools.recurrence). This is relatively slow; use
+        ``OccurrenceGeneratorBase.get_rrule_object``, which caches the result.
+        """
+        if self.complex_rule:
+            try:
+                return rrule.rrulestr(str(self.complex_rule),dtstart=dtstart)
+            except:
+                pass
+        params = self.get_params()
+        frequency = getattr(rrule, self.frequency)
+        if REGULAR_RULE_EXPANSION:
+            pattern = regular_pattern(frequency, dtstart, params)
+            if pattern is not None:
+                return pattern
+        # a plain rrule rather than a set of one, so that it can be restarted
+        # part way through (see eventtools.recurrence.IterationCheckpoint)
+        return rrule.rrule(frequency, dtstart=dtstart, **params)
+
+    def is_bounded(self):
+        """
+        Returns whether this rule has a last occurrence (every RRULE of a
+        complex rule has a COUNT or an UNTIL), without compiling it.
+
+        >>> Rule(frequency="DAILY", params="count:10").is_bounded()
+        True
+        >>> Rule(complex_rule="RRULE:FREQ=DAILY;UNTIL=20100101\\nRRULE:FREQ=WEEKLY").is_bounded()
+        False
+        """
+        if self.complex_rule:
+            lines = [line.upper() for line in str(self.complex_rule).split()]
+            rules = [line for line in lines if line.startswith('RRULE:') or line.startswith('FREQ=')]
+            return not [line for line in rules if 'COUNT=' not in line and 'UNTIL=' not in line]
+        return 'count' in self.get_params()
+
     def __unicode__(self):
         """Human readable string for Rule"""
         return self.name
 
+# Keeping derived data up to date. The generator and occurrence handlers are
+# connected to each generated class by EventModelBase.
+
+_event_models = []
+_materialized_event_models = []
+
+def _bump_versions(EventModel, event_ids):
+    if OCCURRENCE_CACHE:
+        from eventtools.caching import bump_versions
+        bump_versions(EventModel, event_ids)
+
+def _stamp_event(EventModel, event_id):
+    # a deleted row leaves no modified stamp behind, so its event takes one
+    # for eventtools.caching.get_validators to find
+    EventModel._default_manager.filter(pk=event_id).update(modified=datetime.now())
+
+def _rule_changed(sender, instance, **kwargs):
+    rrule_cache.invalidate(instance.id)
+    if OCCURRENCE_CACHE:
+        for EventModel in _event_models:
+            GeneratorModel = models.get_model(EventModel._meta.app_label, EventModel._generator_model_name)
+            _bump_versions(EventModel, GeneratorModel.objects.filter(rule=instance.id).values_list('event', flat=True))
+    if _materialized_event_models:
+        from eventtools.materialization import refresh_generator
+        for EventModel in _materialized_event_models:
+            GeneratorModel = models.get_model(EventModel._meta.app_label, EventModel._generator_model_name)
+            for generator in GeneratorModel.objects.filter(rule=instance.id):
+                refresh_generator(generator)
+post_save.connect(_rule_changed, sender=Rule)
+post_delete.connect(_rule_changed, sender=Rule)
+
+def _generator_changed(sender, instance, **kwargs):
+    _bump_versions(sender._meta.get_field('event').rel.to, [instance.event_id])
+    # compiled rules are keyed on dtstart, so a generator whose start moved
+    # leaves entries behind that nothing will ask for again.
+    if instance.rule_id is not None:
+        rrule_cache.invalidate(instance.rule_id)
+
+# Event models whose generators and exceptional occurrences this thread is
+# saving in bulk. Their save handlers do nothing; whoever suspended them calls
+# _generator_saved for each generator afterwards (see eventtools.importing).
+_suspended = threading.local()
+
+def _suspend_handlers(EventModel):
+    if not hasattr(_suspended, 'models'):
+        _suspended.models = set()
+    _suspended.models.add(EventModel)
+
+def _resume_handlers(EventModel):
+    _suspended.models.discard(EventModel)
+
+def _handlers_suspended(EventModel):
+    return EventModel in getattr(_suspended, 'models', ())
+
+def _generator_saved(sender, instance, **kwargs):
+    EventModel = sender._meta.get_field('event').rel.to
+    if _handlers_suspended(EventModel):
+        return
+    _generator_changed(sender, instance, **kwargs)
+    if EventModel.materialize_occurrences:
+        from eventtools.materialization import refresh_generator
+        refresh_generator(instance)
+
+# Generators that are in the middle of being deleted. Their exceptional
+# occurrences are deleted first, and there's no point re-materializing a
+# generator that is about to disappear.
+_deleting_generators = set()
+
+def _generator_deleting(sender, instance, **kwargs):
+    _deleting_generators.add((sender, instance.pk))
+
+def _generator_deleted(sender, instance, **kwargs):
+    _deleting_generators.discard((sender, instance.pk))
+    _generator_changed(sender, instance, **kwargs)
+    _stamp_event(sender._meta.get_field('event').rel.to, instance.event_id)
+
+def _occurrence_saving(sender, instance, **kwargs):
+    # an exceptional occurrence of a materialized event that is re-pointed to
+    # another occurrence leaves a slice behind that needs refreshing too
+    EventModel = sender._meta.get_field('generator').rel.to._meta.get_field('event').rel.to
+    if EventModel.materialize_occurrences and instance.id is not None and not _handlers_suspended(EventModel):
+        saved = sender._default_manager.filter(id=instance.id).values_list('unvaried_start_date', flat=True)
+        if saved and saved[0] != instance.unvaried_start_date:
+            instance._saved_unvaried_start_date = saved[0]
+
+def _occurrence_changed(sender, instance, **kwargs):
+    GeneratorModel = sender._meta.get_field('generator').rel.to
+    if (GeneratorModel, instance.generator_id) in _deleting_generators:
+        # _generator_deleted sees to the generator's event
+        return
+    EventModel = GeneratorModel._meta.get_field('event').rel.to
+    if not (OCCURRENCE_CACHE or EventModel.materialize_occurrences) or _handlers_suspended(EventModel):
+        # (the generator may not be loaded yet)
+        return
+    generator = instance.generator
+    _bump_versions(EventModel, [generator.event_id])
+    if not EventModel.materialize_occurrences:
+        return
+    from eventtools.materialization import refresh_generator_dates
+    saved = instance.__dict__.pop('_saved_unvaried_start_date', None)
+    if saved is not None:
+        refresh_generator_dates(generator, saved, saved, instance.id)
+    refresh_generator_dates(generator, instance.unvaried_start_date, instance.unvaried_start_date, instance.id)
+
+def _occurrence_deleted(sender, instance, **kwargs):
+    GeneratorModel = sender._meta.get_field('generator').rel.to
+    if (GeneratorModel, instance.generator_id) not in _deleting_generators:
+        _stamp_event(GeneratorModel._meta.get_field('event').rel.to, instance.generator.event_id)
+    _occurrence_changed(sender, instance, **kwargs)
+
+def _variation_changed(sender, instance, **kwargs):
+    _bump_versions(sender._meta.get_field('unvaried_event').rel.to, [instance.unvaried_event_id])
+
+def _variation_deleted(sender, instance, **kwargs):
+    _variation_changed(sender, instance, **kwargs)
+    _stamp_event(sender._meta.get_field('unvaried_event').rel.to, instance.unvaried_event_id)
@@ -3,8 +3,11 @@ from django.db.models.query import QuerySet
 from django.template.defaultfilters import date
 from django.utils.translation import ugettext, ugettext_lazy as _
 from django.utils.dates import WEEKDAYS, WEEKDAYS_ABBR
+from eventtools.caching import cached_occurrences
 from eventtools.conf.settings import FIRST_DAY_OF_WEEK, SHOW_CANCELLED_OCCURRENCES
-from eventtools.utils import OccurrenceReplacer
+from eventtools.layout import classify
+from eventtools.models import EventBase, SlidingExpansion, exceptions_in_window, get_occurrence_histogram_for_events
+from eventtools.utils import OccurrenceHistogram, OccurrenceIndex, OccurrenceReplacer
 
 weekday_names = []
 weekday_abbrs = []
@@ -50,12 +53,17 @@ class Period(object):
 
     def _get_sorted_occurrences(self):
         occurrences = []
+        if isinstance(self.occurrence_pool, OccurrenceIndex):
+            return self.occurrence_pool.overlapping(self.start, self.end)
         if hasattr(self, "occurrence_pool") and self.occurrence_pool is not None:
             for occurrence in self.occurrence_pool:
                 if occurrence.start <= self.end and occurrence.end >= self.start:
                     occurrences.append(occurrence)
             return occurrences
-        for event in self.events:
+        events = list(self.events)
+        if events and isinstance(events[0], EventBase):
+            return cached_occurrences(events, self.start, self.end, self.expansion.get_occurrences)
+        for event in events:
             event_occurrences = event.get_occurrences(self.start, self.end)
             occurrences += event_occurrences
         return sorted(occurrences)
@@ -68,35 +76,68 @@ class Period(object):
         return occs
     occurrences = property(cached_get_sorted_occurrences)
 
+    def _get_occurrence_index(self):
+        """
+        An OccurrenceIndex of this period's occurrences, which sub-periods
+        query instead of scanning them all. Sub-periods share their parent's.
+        """
+        if isinstance(self.occurrence_pool, OccurrenceIndex):
+            return self.occurrence_pool
+        if not hasattr(self, '_occurrence_index'):
+            self._occurrence_index = OccurrenceIndex(self.occurrences, self.start, self.end)
+        return self._occurrence_index
+    occurrence_index = property(_get_occurrence_index)
+
+    def _get_expansion(self):
+        """
+        The SlidingExpansion this period's occurrences are expanded with. It
+        is handed on to the periods navigated to from this one, so paging
+        through a calendar only fetches and expands what each step exposes.
+        """
+        if not hasattr(self, '_expansion'):
+            self._expansion = SlidingExpansion(self.events)
+        return self._expansion
+    expansion = property(_get_expansion)
+
+    def get_occurrence_histogram(self, size=datetime.timedelta(days=1), include_cancelled=None):
+        """
+        Returns the number of occurrences overlapping each ``size`` long bin
+        of this period (each day, by default), as an array of integers. Bins
+        are half-open, so an occurrence ending at midnight doesn't count on the
+        next day. Cancelled occurrences count if ``include_cancelled``, which
+        defaults to SHOW_CANCELLED_OCCURRENCES.
+
+        Unless this period's occurrences are already at hand, they aren't
+        built: the counts come straight from the rules and exceptions.
+        """
+        if include_cancelled is None:
+            include_cancelled = SHOW_CANCELLED_OCCURRENCES
+        if self.occurrence_pool is None and not hasattr(self, '_occurrences'):
+            events = list(self.events)
+            if events and isinstance(events[0], EventBase):
+                return get_occurrence_histogram_for_events(events, self.start, self.end, size, include_cancelled)
+        histogram = OccurrenceHistogram(self.start, self.end, size)
+        for occurrence in self.occurrences:
+            if include_cancelled or not occurrence.cancelled:
+                histogram.add(occurrence.start, occurrence.end)
+        return histogram.counts()
+
     def get_exceptional_occurrences(self):
         if hasattr(self, '_exceptional_occurrences'):
             return self._exceptional_occurrences
         else:
             if not self.OccurrenceModel:
                 return []
-            self._exceptional_occurrences = self.OccurrenceModel.objects.filter(generator__event__in = self.events)
+            self._exceptional_occurrences = self.OccurrenceModel.objects.filter(
+                exceptions_in_window(self.start, self.end), generator__event__in = self.events)
             return self._exceptional_occurrences
 
     def classify_occurrence(self, occurrence):
-        if occurrence.cancelled and not SHOW_CANCELLED_OCCURRENCES:
-            return
-        if occurrence.start > self.end or occurrence.end < self.start:
-            return None
-        started = False
-        ended = False
-        if occurrence.start >= self.start and occurrence.start < self.end:
-            started = True
-        if occurrence.end >=self.start and occurrence.end< self.end:
-            ended = True
-        if started and ended:
-            return {'occurrence': occurrence, 'class': 1}
-        elif started:
-            return {'occurrence': occurrence, 'class': 0}
-        elif ended:
-            return {'occurrence': occurrence, 'class': 3}
-        # it existed during this period but it didnt begin or end within it
-        # so it must have just continued
-        return {'occurrence': occurrence, 'class': 2}
+        """
+        Returns None if ``occurrence`` isn't shown in this period, and
+        otherwise a dict of it and its class (see eventtools.layout.classify).
+        """
+        return classify(occurrence, self.start, self.end)
 
     def get_occurrence_partials(self):
         occurrence_dicts = []
@@ -118,12 +159,47 @@ class Period(object):
 
     def get_time_slot(self, start, end ):
         if start >= self.start and end <= self.end:
+            if isinstance(self.occurrence_pool, OccurrenceIndex) or hasattr(self, '_occurrences'):
+                return Period( self.events, start, end, occurrence_pool=self.occurrence_index )
             return Period( self.events, start, end )
         return None
 
+    def get_time_slots(self, size):
+        """
+        Returns a TimeSlot for each ``size`` long slice of this period. They
+        share this period's occurrence index, so none of them is expanded.
+        """
+        index = self.occurrence_index
+        slots = []
+        start = self.start
+        while start < self.end:
+            end = min(start + size, self.end)
+            slots.append(TimeSlot(start, end, index))
+            start = end
+        return slots
+
     def create_sub_period(self, cls, start=None):
         start = start or self.start
-        return cls(self.events, start, self.get_exceptional_occurrences(), self.occurrences)
+        period = cls(self.events, start, self.get_exceptional_occurrences(), self.occurrence_index)
+        period._expansion = self.expansion
+        return period
+
+    def get_period(self, cls, date):
+        """
+        Returns the ``cls`` period containing ``date``. If it falls within the
+        window this period's occurrences are indexed for (e.g. any month, week
+        or day of a Year whose days are being shown), it is fed from that
+        index, so navigating around a calendar doesn't expand it again.
+        Otherwise it shares this period's expansion (see ``expansion``).
+        """
+        period = cls(self.events, date)
+        period._expansion = self.expansion
+        if isinstance(self.occurrence_pool, OccurrenceIndex) or hasattr(self, '_occurrences'):
+            index = self.occurrence_index
+            if index.start <= period.start and period.end <= index.end:
+                period.occurrence_pool = index
+                period._exceptional_occurrences = self.get_exceptional_occurrences()
+        return period
 
     def get_periods(self, cls):
         period = self.create_sub_period(cls)
@@ -132,23 +208,51 @@ class Period(object):
             period = period.next()
 
 
+class TimeSlot(object):
+    """
+    A slice of a period, such as a row of a day view: its start and end, and
+    where it is drawn (``top`` and ``height``), with its occurrences looked
+    up in the period's OccurrenceIndex.
+    """
+    __slots__ = ('start', 'end', 'top', 'height', '_index')
+
+    def __init__(self, start, end, index, top=0, height=0):
+        self.start = start
+        self.end = end
+        self.top = top
+        self.height = height
+        self._index = index
+
+    def get_occurrences(self):
+        return self._index.overlapping(self.start, self.end)
+    occurrences = property(get_occurrences)
+
+    def has_occurrences(self):
+        for occurrence in self.occurrences:
+            if classify(occurrence, self.start, self.end):
+                return True
+        return False
+
+
 class Year(Period):
-    def __init__(self, events, date=None, parent_exceptional_occurrences=None):
+    def __init__(self, events, date=None, parent_exceptional_occurrences=None,
+        occurrence_pool=None):
         if date is None:
             date = datetime.datetime.now()
         start, end = self._get_year_range(date)
-        super(Year, self).__init__(events, start, end, parent_exceptional_occurrences)
+        super(Year, self).__init__(events, start, end,
+            parent_exceptional_occurrences, occurrence_pool)
 
     def get_months(self):
         return self.get_periods(Month)
 
     def next_year(self):
-        return Year(self.events, self.end)
+        return self.get_period(Year, self.end)
     next = next_year
 
     def prev_year(self):
         start = datetime.datetime(self.start.year-1, self.start.month, self.start.day)
-        return Year(self.events, start)
+        return self.get_period(Year, start)
     prev = prev_year
 
     def _get_year_range(self, year):
@@ -190,24 +294,24 @@ class Month(Period):
         return self.create_sub_period(Day, date)
 
     def next_month(self):
-        return Month(self.events, self.end)
+        return self.get_period(Month, self.end)
     next = next_month
 
     def prev_month(self):
         start = (self.start - datetime.timedelta(days=1)).replace(day=1)
-        return Month(self.events, start)
+        return self.get_period(Month, start)
     prev = prev_month
 
     def current_year(self):
-        return Year(self.events, self.start)
+        return self.get_period(Year, self.start)
 
     def prev_year(self):
         start = datetime.datetime.min.replace(year=self.start.year-1)
-        return Year(self.events, start)
+        return self.get_period(Year, start)
 
     def next_year(self):
         start = datetime.datetime.min.replace(year=self.start.year+1)
-        return Year(self.events, start)
+        return self.get_period(Year, start)
 
     def _get_month_range(self, month):
         year = month.year
@@ -242,18 +346,18 @@ class Week(Period):
             parent_exceptional_occurrences, occurrence_pool)
 
     def prev_week(self):
-        return Week(self.events, self.start - datetime.timedelta(days=7))
+        return self.get_period(Week, self.start - datetime.timedelta(days=7))
     prev = prev_week
 
     def next_week(self):
-        return Week(self.events, self.end)
+        return self.get_period(Week, self.end)
     next = next_week
 
     def current_month(self):
-        return Month(self.events, self.start)
+        return self.get_period(Month, self.start)
 
     def current_year(self):
-        return Year(self.events, self.start)
+        return self.get_period(Year, self.start)
 
     def get_days(self):
         return self.get_periods(Day)
@@ -310,18 +414,18 @@ class Day(Period):
         }
 
     def prev_day(self):
-        return Day(self.events, self.start - datetime.timedelta(days=1))
+        return self.get_period(Day, self.start - datetime.timedelta(days=1))
     prev = prev_day
 
     def next_day(self):
-        return Day(self.events, self.end)
+        return self.get_period(Day, self.end)
     next = next_day
 
     def current_year(self):
-        return Year(self.events, self.start)
+        return self.get_period(Year, self.start)
 
     def current_month(self):
-        return Month(self.events, self.start)
+        return self.get_period(Month, self.start)
 
     def current_week(self):
-        return Week(self.events, self.start)
+        return self.get_period(Week, self.start)
@@ -0,0 +1,422 @@
+"""
+Fast expansion of regular recurrence rules.
+
+dateutil always iterates a rule from its dtstart, so expanding one month of a
+daily generator that started years ago walks through every day in between.
+Most rules are regular though: DAILY, WEEKLY and HOURLY rules with an
+interval and plain BYDAY/BYHOUR/BYMINUTE/BYSECOND parts produce the same
+offsets in every period of a fixed length. For those, ``regular_pattern``
+returns a RegularPattern, which seeks straight to any datetime with a little
+arithmetic. Anything else (MONTHLY and YEARLY rules, BYMONTHDAY, BYSETPOS,
+nth weekdays...) returns None, and should be expanded with dateutil as usual.
+
+``nth`` and ``ordinal`` give random access to the datetimes of any compiled
+rule: in constant time for a RegularPattern, and otherwise by iterating the
+dateutil rule once, keeping a checkpoint every so often to restart it from
+(see IterationCheckpoint).
+
+If NumPy is installed, ``RegularPattern.between_array`` expands a window into
+an array of datetime64 values without building a Python object per
+occurrence (see ``eventtools.models.get_occurrence_arrays_for_events``).
+
+This module doesn't depend on Django.
+"""
+import calendar
+import datetime
+import threading
+from bisect import bisect_left, bisect_right
+from itertools import islice
+from dateutil import rrule
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+DAY = 24 * 60 * 60
+
+UNITS = {
+    rrule.WEEKLY: 7 * DAY,
+    rrule.DAILY: DAY,
+    rrule.HOURLY: 60 * 60,
+}
+
+# the number of datetimes of an irregular rule between the ones an
+# IterationCheckpoint keeps
+CHECKPOINT_INTERVAL = 100
+
+REGULAR_PARAMS = ('interval', 'count', 'wkst', 'byweekday', 'byhour', 'byminute', 'bysecond')
+
+def _seconds(delta):
+    return delta.days * DAY + delta.seconds
+
+def _gcd(a, b):
+    while b:
+        a, b = b, a % b
+    return a
+
+def _as_list(value):
+    if isinstance(value, (list, tuple)):
+        return list(value)
+    return [value]
+
+def regular_pattern(frequency, dtstart, params):
+    """
+    Returns a RegularPattern equivalent to
+    ``rrule.rrule(frequency, dtstart=dtstart, **params)``, or None if the rule
+    isn't regular (see the module docstring).
+    """
+    if frequency not in UNITS:
+        return None
+    for key in params:
+        if key not in REGULAR_PARAMS:
+            return None
+    for weekday in _as_list(params.get('byweekday', [])):
+        # an nth weekday ("the 2nd monday") depends on the month
+        if getattr(weekday, 'n', None):
+            return None
+
+    dtstart = dtstart.replace(microsecond=0)
+    step = params.get('interval', 1) * UNITS[frequency]
+    if 'byweekday' in params:
+        cycle = 7 * DAY
+    elif frequency == rrule.HOURLY and 'byhour' in params:
+        cycle = DAY
+    else:
+        cycle = step
+    period = step * cycle / _gcd(step, cycle)
+
+    # the first period is the one dateutil counts the interval from.
+    midnight = datetime.datetime.combine(dtstart.date(), datetime.time.min)
+    if frequency == rrule.WEEKLY:
+        wkst = params.get('wkst', calendar.firstweekday())
+        anchor = midnight - datetime.timedelta(days=(dtstart.weekday() - wkst) % 7)
+    elif frequency == rrule.DAILY:
+        anchor = midnight
+    else:
+        anchor = dtstart.replace(minute=0, second=0)
+
+    # Every period after the first has the same offsets, so read them from the
+    # second one. (The first one only differs in skipping those before dtstart.)
+    unlimited = dict([(key, value) for key, value in params.items() if key != 'count'])
+    try:
+        rule = rrule.rrule(frequency, dtstart=dtstart, **unlimited)
+    except (TypeError, ValueError):
+        return None
+    second = anchor + datetime.timedelta(seconds=period)
+    third = second + datetime.timedelta(seconds=period)
+    offsets = [_seconds(dt - anchor) - period for dt in rule.between(second, third, inc=True) if dt < third]
+    if not offsets:
+        return None
+    pattern = RegularPattern(dtstart, anchor, period, offsets, params.get('count'))
+
+    # cheap insurance against a combination of parameters this module gets
+    # wrong: the result must agree with dateutil for the first few periods.
+    expected = list(islice(rrule.rrule(frequency, dtstart=dtstart, **params), 3 * len(offsets)))
+    if list(islice(pattern, 3 * len(offsets))) != expected:
+        return None
+    return pattern
+
+
+class RegularPattern(object):
+    """
+    The datetimes ``anchor + n * period + offset`` for every whole n >= 0 and
+    each of a fixed, sorted list of offsets (period and offsets in seconds),
+    from ``dtstart`` on, limited to the first ``count`` if given.
+
+    Implements the parts of dateutil's rrule interface that eventtools uses
+    (``between``, ``after`` and iteration), so it can be used in place of the
+    compiled rule.
+    """
+    def __init__(self, dtstart, anchor, period, offsets, count=None):
+        self.dtstart = dtstart
+        self.anchor = anchor
+        self.period = period
+        self.offsets = offsets
+        self.count = count
+        # offsets in the first period that fall before dtstart
+        self.skipped = bisect_left(offsets, _seconds(dtstart - anchor))
+
+    def _datetime(self, n, j):
+        return self.anchor + datetime.timedelta(seconds=n * self.period + self.offsets[j])
+
+    def _position(self, dt, inc=True):
+        """
+        Returns (n, j) of the first datetime at or after ``dt`` (strictly
+        after, unless ``inc``), ignoring ``count``.
+        """
+        seconds = _seconds(dt - self.anchor)
+        if seconds < 0:
+            n, j = 0, 0
+        else:
+            n, into = divmod(seconds, self.period)
+            # (a fraction of a second past ``into`` excludes ``into`` itself)
+            if inc and not dt.microsecond:
+                j = bisect_left(self.offsets, into)
+            else:
+                j = bisect_right(self.offsets, into)
+        if n == 0 and j < self.skipped:
+            j = self.skipped
+        if j == len(self.offsets):
+            n, j = n + 1, 0
+        return n, j
+
+    def _ordinal(self, dt, inc=True):
+        """
+        The ordinal of the first datetime at or after ``dt`` (strictly after,
+        unless ``inc``), ignoring ``count``.
+        """
+        n, j = self._position(dt, inc)
+        return n * len(self.offsets) + j - self.skipped
+
+    def iter_from(self, dt, inc=True):
+        """
+        Yields the datetimes at or after ``dt`` (strictly after, unless
+        ``inc``) in order, without stepping through the earlier ones.
+        """
+        n, j = self._position(dt, inc)
+        per_period = len(self.offsets)
+        index = n * per_period + j - self.skipped
+        while self.count is None or index < self.count:
+            yield self._datetime(n, j)
+            index += 1
+            j += 1
+            if j == per_period:
+                n, j = n + 1, 0
+
+    def __iter__(self):
+        return self.iter_from(self.dtstart)
+
+    def __getitem__(self, item):
+        if isinstance(item, slice):
+            if (item.start or 0) >= 0 and (item.stop or 0) >= 0 and (item.step or 1) > 0:
+                return list(islice(self, item.start, item.stop, item.step))
+            return list(self)[item]
+        if item < 0:
+            if self.count is None:
+                raise IndexError(item)
+            item += self.count
+        if item < 0 or (self.count is not None and item >= self.count):
+            raise IndexError(item)
+        n, j = divmod(item + self.skipped, len(self.offsets))
+        return self._datetime(n, j)
+
+    def index(self, dt):
+        """
+        Returns the position of ``dt`` in the recurrence (like list.index),
+        or raises ValueError if it isn't one of its datetimes.
+        """
+        if self.after(dt, inc=True) != dt:
+            raise ValueError("%s is not in the recurrence" % dt)
+        return self._ordinal(dt)
+
+    def between(self, after, before, inc=False):
+        result = []
+        for dt in self.iter_from(after, inc):
+            if dt > before or (dt == before and not inc):
+                break
+            result.append(dt)
+        return result
+
+    def count_between(self, after, before, inc=False):
+        """
+        Returns ``len(self.between(after, before, inc))``, in constant time.
+        """
+        first = self._ordinal(after, inc)
+        last = self._ordinal(before, not inc)
+        if self.count is not None:
+            first, last = min(first, self.count), min(last, self.count)
+        return max(0, last - first)
+
+    def after(self, dt, inc=False):
+        for dt in self.iter_from(dt, inc):
+            return dt
+        return None
+
+    def between_array(self, after, before, inc=False):
+        """
+        Returns ``between(after, before, inc)`` as a NumPy array of
+        datetime64[s] values. Requires NumPy.
+        """
+        first_n, first_j = self._position(after, inc)
+        last = _seconds(before - self.anchor)
+        offsets = numpy.array(self.offsets, dtype='int64')
+        n = numpy.arange(first_n, max(first_n, last // self.period) + 1, dtype='int64')
+        seconds = (n[:, numpy.newaxis] * self.period + offsets).ravel()
+        index = numpy.arange(len(seconds), dtype='int64') + (first_n * len(offsets) - self.skipped)
+        keep = index >= first_n * len(offsets) + first_j - self.skipped
+        if inc and not before.microsecond:
+            keep &= seconds <= last
+        else:
+            keep &= seconds < last + (before.microsecond and 1 or 0)
+        if self.count is not None:
+            keep &= index < self.count
+        return numpy.datetime64(self.anchor, 's') + seconds[keep].astype('timedelta64[s]')
+
+
+class IterationCheckpoint(object):
+    """
+    Random access to the datetimes of a dateutil rule, which can only be
+    iterated from its dtstart. The rule is iterated once, as far as has been
+    asked for, keeping only every ``interval``th datetime as a checkpoint (and
+    those since the last one). A datetime before the last checkpoint is found
+    by restarting the rule from the checkpoint before it, with
+    ``rrule.replace``; a rule that can't be restarted (a ruleset) is iterated
+    from its start again.
+    """
+    def __init__(self, rule, interval=CHECKPOINT_INTERVAL):
+        self.rule = rule
+        self.interval = interval
+        # the datetimes numbered 0, interval, 2 * interval...
+        self.checkpoints = []
+        # the datetimes from the last checkpoint on
+        self._tail = []
+        self._iterator = iter(rule)
+        self._exhausted = False
+        self._lock = threading.Lock()
+
+    def _seen(self):
+        if not self.checkpoints:
+            return 0
+        return (len(self.checkpoints) - 1) * self.interval + len(self._tail)
+
+    def _extend(self, done):
+        # iterate until done(), or the rule runs out
+        while not self._exhausted and not done():
+            try:
+                dt = self._iterator.next()
+            except StopIteration:
+                self._exhausted = True
+                break
+            if not self.checkpoints or len(self._tail) == self.interval:
+                self.checkpoints.append(dt)
+                self._tail = []
+            self._tail.append(dt)
+
+    def _segment(self, k):
+        """
+        The datetimes numbered ``k * interval`` up to the next checkpoint.
+        """
+        if k == len(self.checkpoints) - 1:
+            return self._tail
+        if isinstance(self.rule, rrule.rrule):
+            # the checkpoints are datetimes of the rule, so restarting from one
+            # keeps its period (and any defaults it takes from dtstart)
+            restarted = self.rule.replace(dtstart=self.checkpoints[k], count=None, until=self.checkpoints[k + 1])
+            return list(islice(restarted, self.interval))
+        return list(islice(self.rule, k * self.interval, (k + 1) * self.interval))
+
+    def _locate(self, dt):
+        # the checkpoint at or before dt, and the datetimes from it on
+        k = bisect_right(self.checkpoints, dt) - 1
+        if k < 0:
+            return 0, []
+        return k, self._segment(k)
+
+    def nth(self, n):
+        self._lock.acquire()
+        try:
+            self._extend(lambda: self._seen() > n)
+            if n >= self._seen():
+                raise IndexError(n)
+            k, i = divmod(n, self.interval)
+            return self._segment(k)[i]
+        finally:
+            self._lock.release()
+
+    def count_until(self, dt):
+        self._lock.acquire()
+        try:
+            self._extend(lambda: self._tail and self._tail[-1] > dt)
+            k, segment = self._locate(dt)
+            return k * self.interval + bisect_right(segment, dt)
+        finally:
+            self._lock.release()
+
+    def index(self, dt):
+        self._lock.acquire()
+        try:
+            self._extend(lambda: self._tail and self._tail[-1] >= dt)
+            k, segment = self._locate(dt)
+            i = bisect_left(segment, dt)
+            if i == len(segment) or segment[i] != dt:
+                raise ValueError("%s is not in the recurrence" % dt)
+            return k * self.interval + i
+        finally:
+            self._lock.release()
+
+class RuleCursor(object):
+    """
+    Wraps a dateutil rule whose windows are expanded one after another, moving
+    forward (as when paging through a calendar): each window carries on
+    iterating from where the previous one stopped, rather than from dtstart.
+    Only the datetimes from the last window's start on are kept. A window that
+    starts before that is expanded by the rule itself.
+    """
+    def __init__(self, rule):
+        self.rule = rule
+        self._iterator = iter(rule)
+        self._exhausted = False
+        self._buffer = []
+        self._floor = None
+
+    def between(self, after, before, inc=False):
+        if self._floor is not None and after < self._floor:
+            return self.rule.between(after, before, inc)
+        del self._buffer[:bisect_left(self._buffer, after)]
+        self._floor = after
+        while not self._exhausted and (not self._buffer or self._buffer[-1] <= before):
+            try:
+                dt = self._iterator.next()
+            except StopIteration:
+                self._exhausted = True
+                break
+            if dt >= after:
+                self._buffer.append(dt)
+        if inc:
+            return self._buffer[:bisect_right(self._buffer, before)]
+        return [dt for dt in self._buffer[:bisect_left(self._buffer, before)] if dt != after]
+
+    def __getattr__(self, name):
+        return getattr(self.rule, name)
+
+    def __iter__(self):
+        return iter(self.rule)
+
+    def __getitem__(self, item):
+        return self.rule[item]
+
+def _checkpoint(rule):
+    # kept on the compiled rule, so it lives as long as the rule is cached
+    checkpoint = getattr(rule, '_eventtools_checkpoint', None)
+    if checkpoint is None:
+        checkpoint = rule._eventtools_checkpoint = IterationCheckpoint(rule)
+    return checkpoint
+
+def nth(rule, n):
+    """
+    Returns the ``n``th (from 0) datetime of ``rule`` (a RegularPattern or a
+    dateutil rule), or raises IndexError.
+    """
+    if n < 0:
+        raise IndexError(n)
+    if isinstance(rule, RegularPattern):
+        return rule[n]
+    return _checkpoint(rule).nth(n)
+
+def ordinal(rule, dt):
+    """
+    Returns the position (from 0) of ``dt`` among the datetimes of ``rule``
+    (a RegularPattern or a dateutil rule), or raises ValueError.
+    """
+    if isinstance(rule, RegularPattern):
+        return rule.index(dt)
+    return _checkpoint(rule).index(dt)
+
+def count_until(rule, dt):
+    """
+    Returns the number of datetimes of ``rule`` (a RegularPattern or a
+    dateutil rule) up to and including ``dt``.
+    """
+    if isinstance(rule, RegularPattern):
+        return rule.count_between(rule.dtstart, dt, inc=True)
+    return _checkpoint(rule).count_until(dt)
@@ -4,6 +4,7 @@ from django import template
 from django.core.urlresolvers import reverse
 from django.utils.dateformat import format
 from eventtools.conf.settings import CHECK_PERMISSION_FUNC
+from eventtools.layout import layout
 from eventtools.periods import weekday_names, weekday_abbrs,  Month
 
 register = template.Library()
@@ -143,77 +144,35 @@ def detail( occurrence ):
 
 def _cook_occurrences(period, occs, width, height):
     """ Prepare occurrences to be displayed.
-        Calculate dimensions and position (in px) for each occurrence.
-        The algorithm tries to fit overlapping occurrences so that they require a minimum
-        number of "columns".
+        Returns a Box (see eventtools.layout) for each occurrence, with its
+        dimensions and position (in px). Overlapping occurrences are fitted
+        into the minimum number of "columns".
         Arguments:
         period - time period for the whole series
         occs - occurrences to be displayed
-        increment - slot size in minutes
         width - width of the occurrences column (px)
         height - height of the table (px)
     """
-    last = {}
-    # find out which occurrences overlap
-    for o in occs:
-        o.data = period.classify_occurrence(o)
-        if not o.data:
-            occs.remove(o)
-            continue
-        o.level = -1
-        o.max = 0
-        if not last:
-            last[0] = o
-            o.level = 0
-        else:
-            for k in sorted(last.keys()):
-                if last[k].end <= o.start:
-                    o.level = k
-                    last[k] = o
-                    break
-            if o.level == -1:
-                k = k + 1
-                last[k] = o
-                o.level = k
-    # calculate position and dimensions
-    for o in occs:
-        # number of overlapping occurrences
-        o.max = len([n for n in occs if not(n.end<=o.start or n.start>=o.end)])
-    for o in occs:
-        o.cls = o.data['class']
-        o.real_start = max(o.start, period.start)
-        o.real_end = min(o.end, period.end)
-        # number of "columns" is a minimum number of overlaps for each overlapping group
-        o.max = min([n.max for n in occs if not(n.end<=o.start or n.start>=o.end)] or [1])
-        w = int(width / (o.max))
-        o.width = w - 2
-        o.left = w * o.level
-        o.top = int(height * (float((o.real_start - period.start).seconds) / (period.end - period.start).seconds))
-        o.height = int(height * (float((o.real_end - o.real_start).seconds) / (period.end - period.start).seconds))
-        o.height = min(o.height, height - o.top) # trim what extends beyond the area
-    return occs
+    return layout(occs, period.start, period.end, width, height,
+        lambda occurrence, start, end: period.classify_occurrence(occurrence))
 
 
 def _cook_slots(period, increment, width, height):
     """
         Prepare slots to be displayed on the left hand side
         calculate dimensions (in px) for each slot.
+        Returns TimeSlots (see eventtools.periods) sharing the period's
+        occurrence index, rather than a Period per slot.
         Arguments:
         period - time period for the whole series
         increment - slot size in minutes
         width - width of the slot column (px)
         height - height of the table (px)
     """
-    tdiff = datetime.timedelta(minutes=increment)
-    num = (period.end - period.start).seconds/tdiff.seconds
-    s = period.start
-    slots = []
-    for i in range(num):
-        sl = period.get_time_slot(s, s + tdiff)
-        sl.top = int(height / float(num)) * i
-        sl.height = int(height / float(num))
-        slots.append(sl)
-        s = s + tdiff
+    slots = period.get_time_slots(datetime.timedelta(minutes=increment))
+    for i, sl in enumerate(slots):
+        sl.top = int(height / float(len(slots))) * i
+        sl.height = int(height / float(len(slots)))
     return slots
 
 @register.simple_tag
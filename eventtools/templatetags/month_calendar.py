@@ -1,19 +1,21 @@
 import calendar
-from datetime import date, timedelta
+from datetime import date, datetime, time, timedelta
 from dateutil.relativedelta import *
 from django import template
+from eventtools.periods import Period
 
 register = template.Library()
 
-def month_calendar(month=None, week_start=6, selected_start=None, selected_end=None):
+def month_calendar(month=None, week_start=6, selected_start=None, selected_end=None, events=None):
     """
     Creates a configurable html calendar displaying one month
     
-    It takes four optional arguments:
+    It takes five optional arguments:
     
     month: a date object representing the month to be displayed (ie. it needs to be a date within the month to be displayed).
     selected_start:
     selected_end:
+    events: events whose occurrences are counted on each day (see Period.get_occurrence_histogram). Days with any get a has_occurrences class, and their count.
     """
     
     cal = calendar.Calendar(week_start)
@@ -26,8 +28,14 @@ def month_calendar(month=None, week_start=6, selected_start=None, selected_end=N
     # month_calendar is a list of the weeks in the month of the year as full weeks. Weeks are lists of seven day numbers
     month_calendar = cal.monthdatescalendar(month.year, month.month)
     
+    counts = {}
+    if events:
+        first = month_calendar[0][0]
+        period = Period(events, datetime.combine(first, time.min), datetime.combine(month_calendar[-1][-1] + timedelta(days=1), time.min))
+        for i, count in enumerate(period.get_occurrence_histogram()):
+            counts[first + timedelta(days=i)] = count
     
-    # annotate each day with a list of class names that describes their status in the calendar - not_in_month, today, selected
+    # annotate each day with a list of class names that describes their status in the calendar - not_in_month, today, selected, has_occurrences
     def annotate(day):
         classes = []
         if day.month != month.month:
@@ -37,7 +45,9 @@ def month_calendar(month=None, week_start=6, selected_start=None, selected_end=N
         if selected_start:
             if selected_end > day >= selected_start:
                 classes.append('selected')
-        return {'date': day, 'classes': classes}
+        if counts.get(day):
+            classes.append('has_occurrences')
+        return {'date': day, 'classes': classes, 'occurrences': counts.get(day, 0)}
     month_calendar = [map(annotate, week) for week in month_calendar]
     links = {'prev': month+relativedelta(months=-1), 'next': month+relativedelta(months=+1)}
     
@@ -1,3 +1,10 @@
 from test_models import *
 from test_periods import *
+from test_materialization import *
+from test_recurrence import *
+from test_caching import *
+from test_importing import *
+from test_layout import *
+from test_views import *
+from test_feeds import *
 from test_templatetags import *
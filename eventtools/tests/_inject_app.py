@@ -1,11 +1,12 @@
-from django.test import TestCase
+from django.test import TestCase, TransactionTestCase
 from django.conf import settings
+from django.db import connection
 from django.db.models.loading import load_app
 from django.core.management import call_command
 
 APP_NAME = 'eventtools.tests.eventtools_testapp'
 
-class TestCaseWithApp(TestCase):
+class AppInjection(object):
 
     """Make sure to call super(..).setUp and tearDown on subclasses"""
     
@@ -20,3 +21,24 @@ class TestCaseWithApp(TestCase):
         
     def tearDown(self):
         settings.INSTALLED_APPS = self.old_INSTALLED_APPS
+
+    def count_queries(self, func, *args, **kwargs):
+        """
+        Call ``func`` and return a tuple of its result and the number of
+        database queries it ran.
+        """
+        old_DEBUG = settings.DEBUG
+        settings.DEBUG = True
+        connection.queries = []
+        try:
+            result = func(*args, **kwargs)
+            return result, len(connection.queries)
+        finally:
+            settings.DEBUG = old_DEBUG
+
+
+class TestCaseWithApp(AppInjection, TestCase):
+    pass
+
+class TransactionTestCaseWithApp(AppInjection, TransactionTestCase):
+    """For tests that commit or roll back transactions of their own."""
@@ -31,4 +31,8 @@ class BroadcastEventVariation(EventVariationBase):
         
 class LessonEvent(EventBase):
     subject = models.TextField(max_length=100)
-    #Test that an event can work without variations defined
\ No newline at end of file
+    #Test that an event can work without variations defined
+
+class ExhibitionEvent(EventBase):
+    title = models.CharField(_("Title"), max_length = 255)
+    materialize_occurrences = True
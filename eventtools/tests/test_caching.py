@@ -0,0 +1,190 @@
+import calendar
+import datetime
+
+from django.core.cache import get_cache
+from django.db.models.signals import post_save
+from django.http import HttpRequest
+from django.utils.http import http_date
+
+from eventtools import caching, models as eventtools_models
+from eventtools.tests.eventtools_testapp.models import *
+from eventtools.models import Rule
+from eventtools.periods import Month
+from eventtools.views import occurrences_json
+from _inject_app import TestCaseWithApp as TestCase
+
+
+def describe(occurrences):
+    return [(o.start, o.end, o.generator_id, o.id, o.cancelled) for o in occurrences]
+
+
+class TestOccurrenceCache(TestCase):
+
+    def setUp(self):
+        super(TestOccurrenceCache, self).setUp() #monkeypatch in the test app
+        self.old_cache = caching.cache
+        caching.cache = get_cache('locmem://')
+        caching.OCCURRENCE_CACHE = eventtools_models.OCCURRENCE_CACHE = True
+
+        self.rule = Rule.objects.create(frequency = "WEEKLY", params = "byweekday:1,3")
+        monthly = Rule.objects.create(frequency = "MONTHLY", params = "bymonthday:2")
+        self.lecture = LectureEvent.objects.create(title='Weekly lecture')
+        self.gen = self.lecture.create_generator(start=datetime.datetime(2009, 1, 6, 18, 0),
+            end=datetime.datetime(2009, 1, 6, 19, 0), rule=self.rule)
+        other = LectureEvent.objects.create(title='Monthly lecture')
+        other.create_generator(start=datetime.datetime(2009, 1, 2, 12, 0),
+            end=datetime.datetime(2009, 1, 2, 13, 0), rule=monthly)
+        occ = self.gen.get_occurrences(datetime.datetime(2010, 3, 1), datetime.datetime(2010, 3, 8))[0]
+        occ.varied_start_date = occ.varied_end_date = datetime.date(2010, 3, 13)
+        occ.save()
+        self.events = list(LectureEvent.objects.all())
+
+    def tearDown(self):
+        caching.cache = self.old_cache
+        caching.OCCURRENCE_CACHE = eventtools_models.OCCURRENCE_CACHE = False
+        super(TestOccurrenceCache, self).tearDown()
+
+    def month(self):
+        return Month(self.events, datetime.datetime(2010, 3, 1))
+
+    def test_shared_between_periods(self):
+        expected = describe(self.month().occurrences)
+        occurrences, num_queries = self.count_queries(lambda: self.month().occurrences)
+        self.assertEqual(num_queries, 0)
+        self.assertEqual(describe(occurrences), expected)
+        # and they work like expanded ones
+        self.assertEqual(occurrences[0].merged_event.title, 'Monthly lecture')
+        self.assertEqual([o.is_moved for o in occurrences if o.id], [True])
+
+    def test_saves_make_entries_unreachable(self):
+        def cancel():
+            self.gen.get_occurrences(datetime.datetime(2010, 3, 16), datetime.datetime(2010, 3, 17))[0].cancel()
+        def change_rule():
+            self.rule.params = "byweekday:1"
+            self.rule.save()
+        def move_generator():
+            self.gen.first_start_time = self.gen.first_end_time = datetime.time(19, 0)
+            self.gen.save()
+        def delete_exception():
+            self.gen.occurrences.all().delete()
+
+        for change in (cancel, change_rule, move_generator, delete_exception):
+            cached = describe(self.month().occurrences)
+            change()
+            changed = describe(self.month().occurrences)
+            self.assertNotEqual(changed, cached)
+            self.assertEqual(changed, describe(Month(self.events, datetime.datetime(2010, 3, 1)).expansion.get_occurrences(
+                datetime.datetime(2010, 3, 1), datetime.datetime(2010, 4, 1))))
+
+    def test_versions(self):
+        versions = caching.get_versions(LectureEvent, [self.lecture.id])
+        self.assertEqual(caching.get_versions(LectureEvent, [self.lecture.id]), versions)
+        LectureEventVariation.objects.create(unvaried_event=self.lecture, reason='Moved to the great hall')
+        self.assertEqual(caching.get_versions(LectureEvent, [self.lecture.id])[self.lecture.id], versions[self.lecture.id] + 1)
+
+        # a version that is lost starts again from the time, not from 0
+        caching.cache.delete(caching._version_key(LectureEvent, self.lecture.id))
+        self.assertTrue(caching.get_versions(LectureEvent, [self.lecture.id])[self.lecture.id] > versions[self.lecture.id] + 1)
+
+    def test_bumping_costs_no_queries(self):
+        def plain_save(occ):
+            post_save.disconnect(eventtools_models._occurrence_changed, sender=LectureEventOccurrence)
+            try:
+                return self.count_queries(occ.save)[1]
+            finally:
+                post_save.connect(eventtools_models._occurrence_changed, sender=LectureEventOccurrence)
+        num_queries = plain_save(self.gen.occurrences.all()[0])
+
+        # with the generator loaded, bumping its event's version is free
+        versions = caching.get_versions(LectureEvent, [self.lecture.id])
+        occ = self.gen.occurrences.select_related('generator')[0]
+        self.assertEqual(self.count_queries(occ.save), (None, num_queries))
+        self.assertEqual(caching.get_versions(LectureEvent, [self.lecture.id])[self.lecture.id], versions[self.lecture.id] + 1)
+
+        # and with the cache off, the generator isn't loaded at all
+        caching.OCCURRENCE_CACHE = eventtools_models.OCCURRENCE_CACHE = False
+        self.assertEqual(self.count_queries(self.gen.occurrences.all()[0].save), (None, num_queries))
+
+    def test_entries_expire(self):
+        timeout = caching.OCCURRENCE_CACHE_TIMEOUT
+        caching.OCCURRENCE_CACHE_TIMEOUT = -1
+        try:
+            self.month().occurrences
+            occurrences, num_queries = self.count_queries(lambda: self.month().occurrences)
+        finally:
+            caching.OCCURRENCE_CACHE_TIMEOUT = timeout
+        self.assertEqual(num_queries, 2)
+
+    def test_turned_off(self):
+        caching.OCCURRENCE_CACHE = False
+        self.month().occurrences
+        occurrences, num_queries = self.count_queries(lambda: self.month().occurrences)
+        self.assertEqual(num_queries, 2)
+
+
+class TestValidators(TestCase):
+
+    def setUp(self):
+        super(TestValidators, self).setUp() #monkeypatch in the test app
+        self.rule = Rule.objects.create(frequency = "WEEKLY", params = "byweekday:1,3")
+        self.lecture = LectureEvent.objects.create(title='Weekly lecture')
+        self.gen = self.lecture.create_generator(start=datetime.datetime(2009, 1, 6, 18, 0),
+            end=datetime.datetime(2009, 1, 6, 19, 0), rule=self.rule)
+        LectureEvent.objects.create(title='Lecture without generators')
+        self.events = list(LectureEvent.objects.all())
+
+    def test_one_query_per_table(self):
+        (etag, last_modified), num_queries = self.count_queries(caching.get_validators, self.events)
+        # events, generators, rules, exceptions and variations
+        self.assertEqual(num_queries, 5)
+        self.assertEqual(last_modified, max([self.gen.modified, self.rule.modified] + [e.modified for e in self.events]))
+        self.assertEqual(caching.get_validators(self.events), (etag, last_modified))
+        self.assertNotEqual(caching.get_validators(self.events[:1])[0], etag)
+
+    def test_changes(self):
+        occ = self.gen.get_occurrences(datetime.datetime(2010, 3, 1), datetime.datetime(2010, 3, 8))[0]
+        def cancel():
+            occ.cancel()
+        def change_rule():
+            self.rule.params = "byweekday:1"
+            self.rule.save()
+        def vary():
+            LectureEventVariation.objects.create(unvaried_event=self.lecture, reason='Moved to the great hall')
+        def delete_exception():
+            self.gen.occurrences.all().delete()
+        def delete_generator():
+            self.gen.delete()
+
+        for change in (cancel, change_rule, vary, delete_exception, delete_generator):
+            etag, last_modified = caching.get_validators(self.events)
+            change()
+            changed, changed_last_modified = caching.get_validators(self.events)
+            self.assertNotEqual(changed, etag)
+            self.assertTrue(changed_last_modified >= last_modified)
+
+    def test_deletions_move_last_modified(self):
+        """
+        A deletion leaves no stamp of its own, so it stamps the event, and a
+        client that only sends If-Modified-Since still sees it.
+        """
+        occ = self.gen.get_occurrences(datetime.datetime(2010, 3, 1), datetime.datetime(2010, 3, 8))[0]
+        occ.cancel()
+        LectureEventVariation.objects.create(unvaried_event=self.lecture, reason='Moved to the great hall')
+        an_hour_ago = datetime.datetime.now() - datetime.timedelta(hours=1)
+        for model in (LectureEvent, LectureEventOccurrenceGenerator, LectureEventOccurrence, LectureEventVariation, Rule):
+            model.objects.update(modified=an_hour_ago)
+
+        def get(if_modified_since):
+            request = HttpRequest()
+            request.method = 'GET'
+            request.GET['start'], request.GET['end'] = '2010-03-01', '2010-03-08'
+            request.META['HTTP_IF_MODIFIED_SINCE'] = http_date(calendar.timegm(if_modified_since.utctimetuple()))
+            return occurrences_json(request, LectureEvent.objects.all())
+
+        for delete in (self.gen.occurrences.all().delete, self.lecture.variations.all().delete, self.gen.delete):
+            etag, last_modified = caching.get_validators(self.events)
+            self.assertEqual(get(last_modified).status_code, 304)
+            delete()
+            self.assertEqual(get(last_modified).status_code, 200)
+            for model in (LectureEvent, LectureEventOccurrenceGenerator, LectureEventOccurrence, LectureEventVariation, Rule):
+                model.objects.update(modified=an_hour_ago)
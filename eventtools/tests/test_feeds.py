@@ -0,0 +1,184 @@
+import datetime
+import imp
+import os
+import unittest
+from StringIO import StringIO
+
+from dateutil import rrule
+
+import eventtools
+from eventtools import caching
+from eventtools.tests.eventtools_testapp.models import *
+from eventtools.models import Rule
+from eventtools.importing import parse_datetime, parse_vevents
+from _inject_app import TestCaseWithApp as TestCase
+
+
+def load_feed_module(name):
+    """
+    Loads the module eventtools/feeds/``name``.py on its own (the feeds
+    package itself still imports the old events app).
+    """
+    path = os.path.join(os.path.dirname(eventtools.__file__), 'feeds', '%s.py' % name)
+    return imp.load_source('eventtools_feeds_%s' % name, path)
+
+atom = load_feed_module('atom')
+icalendar = load_feed_module('icalendar')
+
+
+class LectureFeed(icalendar.RecurringICalendarFeed):
+
+    def events(self):
+        return LectureEvent.objects.all()
+
+
+def describe(feed):
+    """
+    The UID, RECURRENCE-ID, start, end, summary and EXDATEs of each VEVENT
+    written by ``feed``.
+    """
+    vevents = []
+    for vevent in parse_vevents(''.join(feed.serialize()).splitlines(True)):
+        value = lambda name: name in vevent and vevent[name][0][1] or None
+        recurrence_id = value('RECURRENCE-ID')
+        vevents.append((value('UID'), recurrence_id and parse_datetime(recurrence_id),
+            parse_datetime(value('DTSTART')), parse_datetime(value('DTEND')),
+            value('SUMMARY'), value('EXDATE')))
+    return sorted(vevents, key=lambda vevent: (vevent[0], vevent[1] or datetime.datetime.min))
+
+
+class TestRecurringICalendarFeed(TestCase):
+
+    def setUp(self):
+        super(TestRecurringICalendarFeed, self).setUp() #monkeypatch in the test app
+        weekly = Rule.objects.create(frequency = "WEEKLY", params = "byweekday:1")
+        self.lecture = LectureEvent.objects.create(title='Weekly lecture')
+        self.gen = self.lecture.create_generator(start=datetime.datetime(2010, 1, 5, 18, 0),
+            end=datetime.datetime(2010, 1, 5, 19, 0), rule=weekly, repeat_until=datetime.datetime(2010, 3, 1))
+        occs = self.gen.get_occurrences(datetime.datetime(2010, 2, 1), datetime.datetime(2010, 3, 1))
+        occs[0].cancel()
+        occs[1].varied_start_time, occs[1].varied_end_time = datetime.time(20, 0), datetime.time(21, 0)
+        occs[1].save()
+
+        self.talks = LectureEvent.objects.create(title='Talk')
+        self.one_offs = []
+        for day in (10, 11, 12, 13):
+            self.one_offs.append(self.talks.create_generator(start=datetime.datetime(2010, 1, day, 12, 0),
+                end=datetime.datetime(2010, 1, day, 13, 0)))
+        # moved, cancelled and varied; the last is left as it is
+        moved = self.one_offs[0].get_occurrences(datetime.datetime(2010, 1, 10), datetime.datetime(2010, 1, 11))[0]
+        moved.varied_start_date = moved.varied_end_date = datetime.date(2010, 1, 20)
+        moved.save()
+        self.one_offs[1].get_occurrences(datetime.datetime(2010, 1, 11), datetime.datetime(2010, 1, 12))[0].cancel()
+        varied = self.one_offs[2].get_occurrences(datetime.datetime(2010, 1, 12), datetime.datetime(2010, 1, 13))[0].promote()
+        varied.varied_event = self.talks.create_variation(title='Guest talk', reason='Guest')
+        varied.save()
+
+    def test_recurring(self):
+        uid = LectureFeed().generator_uid(self.gen)
+        self.assertEqual([vevent for vevent in describe(LectureFeed()) if vevent[0] == uid], [
+            (uid, None, datetime.datetime(2010, 1, 5, 18, 0), datetime.datetime(2010, 1, 5, 19, 0),
+                'Weekly lecture', '20100202T180000'),
+            (uid, datetime.datetime(2010, 2, 9, 18, 0), datetime.datetime(2010, 2, 9, 20, 0),
+                datetime.datetime(2010, 2, 9, 21, 0), 'Weekly lecture', None),
+        ])
+
+    def test_one_offs(self):
+        """
+        A one-off generator is written as its only occurrence: moved or
+        varied as its exception says, and not at all if that is cancelled.
+        """
+        feed = LectureFeed()
+        uids = [feed.generator_uid(generator) for generator in self.one_offs]
+        self.assertEqual([vevent for vevent in describe(feed) if vevent[0] in uids], [
+            (uids[0], None, datetime.datetime(2010, 1, 20, 12, 0), datetime.datetime(2010, 1, 20, 13, 0), 'Talk', None),
+            (uids[2], None, datetime.datetime(2010, 1, 12, 12, 0), datetime.datetime(2010, 1, 12, 13, 0), 'Guest talk', None),
+            (uids[3], None, datetime.datetime(2010, 1, 13, 12, 0), datetime.datetime(2010, 1, 13, 13, 0), 'Talk', None),
+        ])
+
+    def test_validators_cover_the_horizon(self):
+        """
+        A generator whose rule can't be written as an RRULE is expanded up
+        to a horizon that moves every day, so the validators move with it.
+        """
+        feed = LectureFeed()
+        etag, last_modified = caching.get_validators(list(LectureEvent.objects.all()))
+        self.assertEqual(feed.validators(), (etag, last_modified))
+
+        easter = Rule.objects.create(frequency = "YEARLY", params = "byeaster:0")
+        generator = self.talks.create_generator(start=datetime.datetime(2010, 4, 4, 10, 0),
+            end=datetime.datetime(2010, 4, 4, 11, 0), rule=easter)
+        etag, last_modified = caching.get_validators(list(LectureEvent.objects.all()))
+        today = datetime.datetime.combine(datetime.date.today(), datetime.time.min)
+        self.assertNotEqual(feed.validators()[0], etag)
+        self.assertEqual(feed.validators()[1], max(last_modified, today))
+        # and the expansion stops at the same horizon
+        self.assertEqual(feed.horizon_end(), today + feed.expansion_horizon)
+        uid = feed.generator_uid(generator)
+        self.assertEqual([vevent[2] for vevent in describe(feed) if vevent[0].startswith(uid + '-')],
+            list(rrule.rrule(rrule.YEARLY, dtstart=generator.start, byeaster=0, until=feed.horizon_end())))
+
+
+# what AtomFeed.write wrote of lectures() before it was streamed
+LECTURES_ATOM = (
+    '<?xml version="1.0" encoding="utf-8"?>\n'
+    '<feed xmlns="http://www.w3.org/2005/Atom"><id>tag:example.com,2010:lectures</id>'
+    '<title>Lectures \xe2\x80\x93 spring</title><updated>2010-03-03T18:00:00Z</updated>'
+    '<link href="http://example.com/lectures/" rel="alternate"></link><author><name>Zo\xc3\xab</name></author>'
+    '<generator version="r33" uri="http://code.google.com/p/django-atompub/">django-atompub</generator>'
+    '<entry><id>tag:example.com,2010:lecture-0</id><title>Caf\xc3\xa9 &lt;talk&gt; 0</title>'
+    '<updated>2010-03-01T18:00:00Z</updated><link href="http://example.com/lectures/0/"></link>'
+    '<content>At the caf\xc3\xa9 &amp; bar</content></entry>'
+    '<entry><id>tag:example.com,2010:lecture-1</id><title>Caf\xc3\xa9 &lt;talk&gt; 1</title>'
+    '<updated>2010-03-02T18:00:00Z</updated><link href="http://example.com/lectures/1/"></link>'
+    '<content>At the caf\xc3\xa9 &amp; bar</content></entry>'
+    '<entry><id>tag:example.com,2010:lecture-2</id><title>Caf\xc3\xa9 &lt;talk&gt; 2</title>'
+    '<updated>2010-03-03T18:00:00Z</updated><link href="http://example.com/lectures/2/"></link>'
+    '<content>At the caf\xc3\xa9 &amp; bar</content></entry></feed>'
+)
+
+
+class TestAtomFeed(unittest.TestCase):
+
+    def lectures(self, updated=None):
+        feed = atom.AtomFeed('tag:example.com,2010:lectures', u'Lectures \u2013 spring', updated=updated,
+            authors=[{'name': u'Zo\xeb'}], links=[{'href': 'http://example.com/lectures/', 'rel': 'alternate'}])
+        for i in range(3):
+            feed.add_item('tag:example.com,2010:lecture-%s' % i, u'Caf\xe9 <talk> %s' % i,
+                datetime.datetime(2010, 3, 1 + i, 18, 0), content=u'At the caf\xe9 & bar',
+                links=[{'href': 'http://example.com/lectures/%s/' % i}])
+        return feed
+
+    def test_same_as_writing(self):
+        self.assertEqual(''.join(self.lectures().generate('utf-8')), LECTURES_ATOM)
+        out = StringIO()
+        self.lectures().write(out, 'utf-8')
+        self.assertEqual(out.getvalue(), LECTURES_ATOM)
+
+    def test_streamed(self):
+        """
+        With its own ``updated``, a feed reads its items only as it writes
+        them: the head, then an entry at a time.
+        """
+        feed = self.lectures(updated=datetime.datetime(2010, 3, 3, 18, 0))
+        read = []
+        def items():
+            for item in feed.items:
+                read.append(item)
+                yield item
+        chunks = feed.generate('utf-8', items())
+        self.assertTrue(chunks.next().endswith('</generator>'))
+        self.assertEqual(read, [])
+        self.assertTrue(chunks.next().startswith('<entry><id>tag:example.com,2010:lecture-0</id>'))
+        self.assertEqual(len(read), 1)
+        self.assertEqual(''.join(chunks), LECTURES_ATOM[LECTURES_ATOM.index('<entry><id>tag:example.com,2010:lecture-1'):])
+
+    def test_validation(self):
+        feed = self.lectures()
+        ''.join(feed.generate('utf-8', validate=True))
+        # neither the feed nor the entry has an author
+        feed.feed['authors'] = []
+        chunks = feed.generate('utf-8', validate=True)
+        chunks.next()
+        self.assertRaises(atom.ValidationError, chunks.next)
+        self.assertEqual(''.join(feed.generate('utf-8')), LECTURES_ATOM.replace('<author><name>Zo\xc3\xab</name></author>', ''))
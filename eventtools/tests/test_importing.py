@@ -0,0 +1,175 @@
+import datetime
+
+from eventtools.tests.eventtools_testapp.models import *
+from eventtools import materialization
+from eventtools.importing import ICalendarImporter
+from eventtools.materialization import materialize
+from eventtools.models import Rule, get_occurrences_for_events
+from _inject_app import TestCaseWithApp as TestCase, TransactionTestCaseWithApp as TransactionTestCase
+
+ICS = """BEGIN:VCALENDAR\r
+VERSION:2.0\r
+BEGIN:VEVENT\r
+UID:weekly\r
+RECURRENCE-ID:20100304T180000\r
+DTSTART:20100304T200000\r
+DTEND:20100304T210000\r
+SUMMARY:Weekly lecture\\, moved\r
+END:VEVENT\r
+BEGIN:VEVENT\r
+UID:weekly\r
+DTSTART:20100105T180000\r
+DTEND:20100105T190000\r
+SUMMARY:Weekly lecture\\, with a summary long enough to have to be folded onto a s\r
+ econd line\r
+RRULE:FREQ=WEEKLY;BYDAY=TU,TH;UNTIL=20100401T000000\r
+EXDATE:20100302T180000,20100311T180000\r
+EXDATE:20100303T180000\r
+BEGIN:VALARM\r
+ACTION:DISPLAY\r
+DESCRIPTION:Not this\r
+END:VALARM\r
+END:VEVENT\r
+BEGIN:VEVENT\r
+UID:weekly\r
+RECURRENCE-ID:20100318T180000\r
+DTSTART:20100318T180000\r
+STATUS:CANCELLED\r
+END:VEVENT\r
+BEGIN:VEVENT\r
+UID:tuesdays-and-thursdays\r
+DTSTART:20100105T120000\r
+DURATION:PT30M\r
+SUMMARY:Lunchtime talk\r
+RRULE:FREQ=WEEKLY;BYDAY=TU,TH\r
+END:VEVENT\r
+BEGIN:VEVENT\r
+UID:last-friday\r
+DTSTART:20100129T100000\r
+DTEND:20100129T110000\r
+SUMMARY:Monthly review\r
+RRULE:FREQ=MONTHLY;BYDAY=-1FR\r
+END:VEVENT\r
+BEGIN:VEVENT\r
+UID:open-day\r
+DTSTART;VALUE=DATE:20100306\r
+SUMMARY:Open day\r
+END:VEVENT\r
+BEGIN:VEVENT\r
+SUMMARY:No start\r
+END:VEVENT\r
+END:VCALENDAR\r
+"""
+
+def describe(occurrences):
+    return [(o.start, o.end, o.cancelled) for o in occurrences]
+
+
+class TestICalendarImporter(TestCase):
+
+    def import_ics(self, batch_size):
+        importer = ICalendarImporter(LectureEvent, batch_size=batch_size)
+        importer.import_file(ICS.splitlines(True))
+        return importer
+
+    def test_import(self):
+        importer = self.import_ics(200)
+        # the VEVENT without a DTSTART, and the EXDATE on a wednesday
+        self.assertEqual(importer.counts, {'events': 4, 'rules': 2, 'exceptions': 4, 'skipped': 2})
+        self.assertTrue(importer.events_per_second() > 0)
+        self.assertEqual(Rule.objects.count(), 2)
+
+        weekly = LectureEvent.objects.get(title__startswith='Weekly lecture')
+        self.assertEqual(weekly.title, u'Weekly lecture, with a summary long enough to have to be folded onto a second line')
+        generator = weekly.generators.get()
+        self.assertEqual(generator.repeat_until, datetime.datetime(2010, 4, 1))
+        self.assertEqual(describe(generator.get_occurrences(datetime.datetime(2010, 3, 1), datetime.datetime(2010, 4, 10))), [
+            (datetime.datetime(2010, 3, 2, 18, 0), datetime.datetime(2010, 3, 2, 19, 0), True),
+            (datetime.datetime(2010, 3, 4, 20, 0), datetime.datetime(2010, 3, 4, 21, 0), False),
+            (datetime.datetime(2010, 3, 9, 18, 0), datetime.datetime(2010, 3, 9, 19, 0), False),
+            (datetime.datetime(2010, 3, 11, 18, 0), datetime.datetime(2010, 3, 11, 19, 0), True),
+            (datetime.datetime(2010, 3, 16, 18, 0), datetime.datetime(2010, 3, 16, 19, 0), False),
+            (datetime.datetime(2010, 3, 18, 18, 0), datetime.datetime(2010, 3, 18, 19, 0), True),
+            (datetime.datetime(2010, 3, 23, 18, 0), datetime.datetime(2010, 3, 23, 19, 0), False),
+            (datetime.datetime(2010, 3, 25, 18, 0), datetime.datetime(2010, 3, 25, 19, 0), False),
+            (datetime.datetime(2010, 3, 30, 18, 0), datetime.datetime(2010, 3, 30, 19, 0), False),
+        ])
+
+        # the same rule is shared
+        lunchtime = LectureEvent.objects.get(title='Lunchtime talk').generators.get()
+        self.assertEqual(lunchtime.rule, generator.rule)
+        self.assertEqual(lunchtime.end - lunchtime.start, datetime.timedelta(minutes=30))
+
+        review = LectureEvent.objects.get(title='Monthly review').generators.get()
+        self.assertEqual(review.rule.complex_rule, 'RRULE:FREQ=MONTHLY;BYDAY=-1FR')
+        self.assertEqual([o.start.date() for o in review.get_occurrences(datetime.datetime(2010, 2, 1), datetime.datetime(2010, 5, 1))],
+            [datetime.date(2010, 2, 26), datetime.date(2010, 3, 26), datetime.date(2010, 4, 30)])
+
+        open_day = LectureEvent.objects.get(title='Open day').generators.get()
+        self.assertEqual((open_day.rule, open_day.start, open_day.end),
+            (None, datetime.datetime(2010, 3, 6), datetime.datetime(2010, 3, 7)))
+        # only ids are kept of the generators imported
+        self.assertEqual(importer._generators['open-day'], (open_day.id, datetime.timedelta(days=1)))
+
+    def test_batches(self):
+        # overrides that come before their VEVENT wait for it across batches
+        self.import_ics(200)
+        expected = [(event.title, describe(event.get_occurrences(datetime.datetime(2010, 1, 1), datetime.datetime(2010, 4, 10))))
+            for event in LectureEvent.objects.order_by('id')]
+        LectureEvent.objects.all().delete()
+
+        importer = self.import_ics(1)
+        self.assertEqual(importer.counts, {'events': 4, 'rules': 0, 'exceptions': 4, 'skipped': 2})
+        self.assertEqual([(event.title, describe(event.get_occurrences(datetime.datetime(2010, 1, 1), datetime.datetime(2010, 4, 10))))
+            for event in LectureEvent.objects.order_by('id')], expected)
+
+
+class FailingImporter(ICalendarImporter):
+
+    def event_fields(self, vevent):
+        if vevent['SUMMARY'][0][1] == 'Monthly review':
+            raise RuntimeError("Disk full")
+        return super(FailingImporter, self).event_fields(vevent)
+
+
+class TestImportTransactions(TransactionTestCase):
+
+    def setUp(self):
+        super(TestImportTransactions, self).setUp() #monkeypatch in the test app
+        self.horizon = (datetime.datetime(2010, 1, 1), datetime.datetime(2010, 7, 1))
+        materialize(ExhibitionEvent, *self.horizon)
+
+    def assertMaterialized(self):
+        self.assertEqual(
+            describe(get_occurrences_for_events(ExhibitionEvent.objects.all(), *self.horizon)),
+            describe(get_occurrences_for_events(ExhibitionEvent.objects.all(), *self.horizon, **{'materialized': False})))
+
+    def test_refreshed_once_per_generator(self):
+        refreshed = []
+        def refresh_generator(generator):
+            refreshed.append(generator.id)
+            old_refresh_generator(generator)
+        def refresh_generator_dates(*args):
+            refreshed.append(args)
+        old_refresh_generator = materialization.refresh_generator
+        old_refresh_generator_dates = materialization.refresh_generator_dates
+        materialization.refresh_generator = refresh_generator
+        materialization.refresh_generator_dates = refresh_generator_dates
+        try:
+            ICalendarImporter(ExhibitionEvent).import_file(ICS.splitlines(True))
+        finally:
+            materialization.refresh_generator = old_refresh_generator
+            materialization.refresh_generator_dates = old_refresh_generator_dates
+        self.assertEqual(sorted(refreshed), sorted(ExhibitionEventOccurrenceGenerator.objects.values_list('id', flat=True)))
+        self.assertMaterialized()
+
+    def test_failed_batch_leaves_nothing(self):
+        # the first batch is the weekly lecture and its overrides; the
+        # second fails after saving the lunchtime talk
+        importer = FailingImporter(ExhibitionEvent, batch_size=3)
+        self.assertRaises(RuntimeError, importer.import_file, ICS.splitlines(True))
+
+        self.assertEqual([event.title[:14] for event in ExhibitionEvent.objects.all()], ['Weekly lecture'])
+        self.assertEqual(ExhibitionEventOccurrenceGenerator.objects.count(), 1)
+        self.assertEqual(ExhibitionEventOccurrence.objects.count(), 4)
+        self.assertMaterialized()
@@ -0,0 +1,116 @@
+import random
+import unittest
+from datetime import datetime, timedelta
+
+from eventtools.layout import layout, layout_days
+
+
+class Booking(object):
+    cancelled = False
+
+    def __init__(self, start, end):
+        self.start = start
+        self.end = end
+
+
+class Counted(datetime):
+    """
+    A datetime that counts the comparisons it takes part in.
+    """
+    comparisons = 0
+
+    def of(cls, dt):
+        return cls(dt.year, dt.month, dt.day, dt.hour, dt.minute, dt.second)
+    of = classmethod(of)
+
+    def _compare(name):
+        def compare(self, other):
+            Counted.comparisons += 1
+            return getattr(datetime, name)(self, other)
+        return compare
+    for name in ('__lt__', '__le__', '__gt__', '__ge__', '__eq__', '__ne__'):
+        locals()[name] = _compare(name)
+    del name, _compare
+
+
+def overlap(a, b):
+    return a.start < b.end and b.start < a.end
+
+
+class TestLayout(unittest.TestCase):
+
+    day = datetime(2010, 3, 1)
+
+    def bookings(self, n, seed=1):
+        rnd = random.Random(seed)
+        bookings = []
+        for i in range(n):
+            start = self.day + timedelta(minutes=rnd.randint(0, 23 * 60))
+            bookings.append(Booking(start, start + timedelta(minutes=rnd.choice([15, 30, 60, 90, 240]))))
+        return bookings
+
+    def test_columns(self):
+        bookings = self.bookings(300)
+        boxes = layout(bookings, self.day, self.day + timedelta(days=1), 600, 960)
+        self.assertEqual(len(boxes), 300)
+        self.assertEqual([box.start for box in boxes], sorted([b.start for b in bookings]))
+        for box in boxes:
+            overlapping = [other for other in boxes if overlap(box, other)]
+            # never drawn over anything it overlaps, or beyond its group's columns
+            self.assertEqual(len([other for other in overlapping if other.level == box.level]), 1)
+            self.assertTrue(box.level < box.max)
+            for other in overlapping:
+                self.assertEqual(other.max, box.max)
+            self.assertEqual(box.left, int(600 / box.max) * box.level)
+            self.assertTrue(0 <= box.top and box.top + box.height <= 960)
+        # the greedy columns are as few as the most bookings running at once
+        most = max([len([b for b in bookings if b.start <= box.start < b.end]) for box in boxes])
+        self.assertEqual(max([box.max for box in boxes]), most)
+
+    def test_geometry(self):
+        bookings = [
+            Booking(self.day + timedelta(hours=9), self.day + timedelta(hours=12)),
+            Booking(self.day + timedelta(hours=10), self.day + timedelta(hours=11)),
+            # starts as the others end, so is laid out on its own
+            Booking(self.day + timedelta(hours=12), self.day + timedelta(hours=13)),
+            # from the day before
+            Booking(self.day - timedelta(hours=2), self.day + timedelta(hours=2)),
+            Booking(self.day + timedelta(hours=20), self.day + timedelta(hours=21)),
+        ]
+        boxes = layout(bookings, self.day + timedelta(hours=8), self.day + timedelta(hours=20), 200, 120)
+        # the one from the day before is outside 8:00-20:00; the one at 20:00
+        # touches it, so is included (as by Period.classify_occurrence)
+        self.assertEqual([(box.top, box.height, box.level, box.max, box.left, box.width, box.cls) for box in boxes], [
+            (10, 30, 0, 2, 0, 98, 1),
+            (20, 10, 1, 2, 100, 98, 1),
+            (40, 10, 0, 1, 0, 198, 1),
+            (120, 0, 0, 1, 0, 198, 2),
+        ])
+        self.assertTrue(boxes[0].occurrence is bookings[0])
+
+    def test_work(self):
+        """
+        Laying out n occurrences takes O(n log n) comparisons of their times.
+        """
+        def comparisons(n):
+            bookings = [Booking(Counted.of(b.start), Counted.of(b.end)) for b in self.bookings(n)]
+            Counted.comparisons = 0
+            layout(bookings, self.day, self.day + timedelta(days=1), 600, 960)
+            return Counted.comparisons
+        small, large = comparisons(500), comparisons(4000)
+        # eight times the occurrences: about 11 times the comparisons for
+        # n log n, and 64 times for the quadratic scans
+        self.assertTrue(large < small * 16)
+
+    def test_days(self):
+        bookings = [
+            Booking(datetime(2010, 3, 1, 22, 0), datetime(2010, 3, 3, 10, 0)),
+            Booking(datetime(2010, 3, 2, 9, 0), datetime(2010, 3, 2, 11, 0)),
+        ]
+        days = layout_days(bookings, datetime(2010, 3, 1, 15, 0), 4, 100, 240, start_hour=8, end_hour=20)
+        self.assertEqual([[(box.top, box.height, box.level, box.max, box.cls) for box in day] for day in days], [
+            [],
+            [(0, 240, 0, 2, 2), (20, 40, 1, 2, 1)],
+            [(0, 40, 0, 1, 3)],
+            [],
+        ])
@@ -0,0 +1,201 @@
+import datetime
+
+from django.db import transaction
+
+from eventtools.tests.eventtools_testapp.models import *
+from eventtools.materialization import materialize, get_horizon
+from eventtools.models import Rule, count_occurrences_for_events, get_occurrences_for_events
+from eventtools.periods import Period, Month, Day
+from _inject_app import TestCaseWithApp as TestCase, TransactionTestCaseWithApp as TransactionTestCase
+
+
+def describe(occurrences):
+    return sorted([(o.start, o.end, o.generator_id, o.id, o.cancelled) for o in occurrences])
+
+
+class MaterializationFixture(object):
+    """
+    Two events, with exceptions in and out of the horizon, materialized
+    from January to July 2010. Mixed into TestCases.
+    """
+
+    def setUp(self):
+        super(MaterializationFixture, self).setUp() #monkeypatch in the test app
+        weekly = Rule.objects.create(frequency = "WEEKLY")
+        daily = Rule.objects.create(frequency = "DAILY", params = "interval:3")
+        self.exhibition = ExhibitionEvent.objects.create(title='Weekly tour')
+        self.gen = self.exhibition.create_generator(
+            start=datetime.datetime(2009, 12, 5, 10, 0),
+            end=datetime.datetime(2009, 12, 5, 11, 0),
+            rule=weekly,
+        )
+        other = ExhibitionEvent.objects.create(title='Late opening')
+        other.create_generator(
+            start=datetime.datetime(2009, 12, 1, 18, 0),
+            end=datetime.datetime(2009, 12, 1, 21, 0),
+            rule=daily,
+            repeat_until=datetime.datetime(2010, 3, 1),
+        )
+        other.create_generator(
+            start=datetime.datetime(2010, 1, 20, 9, 0),
+            end=datetime.datetime(2010, 1, 22, 17, 0),
+        )
+
+        occs = self.gen.get_occurrences(datetime.datetime(2010, 1, 1), datetime.datetime(2010, 2, 1))
+        occs[0].cancel()
+        # moved into February
+        occs[1].varied_start_date = occs[1].varied_end_date = datetime.date(2010, 2, 3)
+        occs[1].save()
+        # moved in from outside the horizon
+        occ = self.gen.get_occurrences(datetime.datetime(2011, 1, 1), datetime.datetime(2011, 1, 8))[0]
+        occ.varied_start_date = occ.varied_end_date = datetime.date(2010, 1, 27)
+        occ.save()
+
+        self.horizon = (datetime.datetime(2010, 1, 1), datetime.datetime(2010, 7, 1))
+        materialize(ExhibitionEvent, *self.horizon)
+
+    def expanded(self, start, end):
+        return get_occurrences_for_events(ExhibitionEvent.objects.all(), start, end, materialized=False)
+
+
+class TestMaterialization(MaterializationFixture, TestCase):
+
+    def test_same_as_expansion(self):
+        self.assertEqual(get_horizon(ExhibitionEvent), self.horizon)
+        for start, end in [
+            (datetime.datetime(2010, 1, 1), datetime.datetime(2010, 2, 1)),
+            (datetime.datetime(2010, 1, 27), datetime.datetime(2010, 1, 28)),
+            (datetime.datetime(2010, 2, 3), datetime.datetime(2010, 2, 4)),
+            (datetime.datetime(2010, 1, 21, 12), datetime.datetime(2010, 1, 21, 13)),
+            (datetime.datetime(2010, 1, 9, 10, 30), datetime.datetime(2010, 1, 9, 10, 45)),
+            self.horizon,
+        ]:
+            period = Period(ExhibitionEvent.objects.all(), start, end)
+            self.assertEqual(describe(period.occurrences), describe(self.expanded(start, end)))
+
+    def test_one_query_in_horizon(self):
+        events = list(ExhibitionEvent.objects.all())
+        month = Month(events, datetime.datetime(2010, 1, 1))
+        occurrences, num_queries = self.count_queries(lambda: month.occurrences)
+        self.assertTrue(occurrences)
+        # the horizon, then the occurrences
+        self.assertEqual(num_queries, 2)
+        # and the results behave like expanded ones
+        self.assertEqual(occurrences[0].generator.event.title, 'Weekly tour')
+        self.assertEqual(occurrences[0].cancelled, True)
+        self.assertEqual(occurrences[1].merged_event.title, 'Late opening')
+
+    def test_count_in_horizon(self):
+        start, end = self.horizon
+        count, num_queries = self.count_queries(count_occurrences_for_events, list(ExhibitionEvent.objects.all()), start, end)
+        occurrences = self.expanded(start, end)
+        self.assertEqual(count, len(occurrences))
+        # the horizon, then the count
+        self.assertEqual(num_queries, 2)
+        self.assertEqual(count_occurrences_for_events(ExhibitionEvent.objects.all(), start, end, include_cancelled=False),
+            len([o for o in occurrences if not o.cancelled]))
+
+    def test_fallback_outside_horizon(self):
+        start, end = datetime.datetime(2010, 6, 1), datetime.datetime(2010, 8, 1)
+        occurrences = Period(ExhibitionEvent.objects.all(), start, end).occurrences
+        self.assertEqual(occurrences[-1].start, datetime.datetime(2010, 7, 31, 10, 0))
+        self.assertEqual(describe(occurrences), describe(self.expanded(start, end)))
+
+    def test_rebuild_in_chunks(self):
+        ExhibitionEvent.objects.create(title='Never scheduled')
+        rolled = (datetime.datetime(2010, 2, 1), datetime.datetime(2010, 8, 1))
+        materialize(ExhibitionEvent, rolled[0], rolled[1], chunk_size=1)
+        self.assertEqual(get_horizon(ExhibitionEvent), rolled)
+        start, end = rolled
+        self.assertEqual(describe(Period(ExhibitionEvent.objects.all(), start, end).occurrences),
+            describe(self.expanded(start, end)))
+        self.assertEqual(ExhibitionEventMaterializedOccurrence.objects.filter(start__lt=datetime.datetime(2010, 1, 31)).count(), 0)
+
+
+class TestIncrementalRefresh(MaterializationFixture, TestCase):
+    """
+    Saving or deleting generators, rules and exceptions keeps the materialized occurrences up to date.
+    """
+
+    def assertMaterialized(self):
+        start, end = self.horizon
+        materialized = get_occurrences_for_events(ExhibitionEvent.objects.all(), start, end)
+        self.assertEqual(describe(materialized), describe(self.expanded(start, end)))
+
+    def row_ids(self):
+        return set(ExhibitionEventMaterializedOccurrence.objects.values_list('id', flat=True))
+
+    def test_exception_changes_only_touch_their_slice(self):
+        before = self.row_ids()
+        occ = self.gen.get_occurrences(datetime.datetime(2010, 3, 1), datetime.datetime(2010, 3, 8))[0]
+        occ.cancel()
+        self.assertMaterialized()
+        after = self.row_ids()
+        # one row replaced, every other row untouched
+        self.assertEqual(len(before - after), 1)
+        self.assertEqual(len(after - before), 1)
+
+        occ.promote().varied_start_time = datetime.time(15, 0)
+        occ.promote().varied_end_time = datetime.time(16, 0)
+        occ.uncancel()
+        self.assertMaterialized()
+        occ.promote().delete()
+        self.assertMaterialized()
+
+        # moving an occurrence in from outside the horizon
+        occ = self.gen.get_occurrences(datetime.datetime(2012, 1, 1), datetime.datetime(2012, 1, 8))[0]
+        occ.varied_start_date = occ.varied_end_date = datetime.date(2010, 5, 5)
+        occ.save()
+        self.assertMaterialized()
+        self.assertEqual(len(Day(ExhibitionEvent.objects.all(), datetime.datetime(2010, 5, 5)).occurrences), 1)
+
+    def test_repointed_exception(self):
+        """
+        An exception re-pointed to another occurrence gives the one it
+        replaced back.
+        """
+        occ = self.gen.occurrences.get(unvaried_start_date=datetime.date(2010, 1, 2))
+        occ.unvaried_start_date = occ.unvaried_end_date = datetime.date(2010, 3, 6)
+        occ.save()
+        self.assertMaterialized()
+        self.assertEqual([o.cancelled for o in Day(ExhibitionEvent.objects.all(), datetime.datetime(2010, 1, 2)).occurrences], [False])
+
+    def test_generator_and_rule_changes(self):
+        self.gen.first_start_time = datetime.time(12, 0)
+        self.gen.first_end_time = datetime.time(13, 0)
+        self.gen.save()
+        self.assertMaterialized()
+
+        rule = self.gen.rule
+        rule.frequency = "DAILY"
+        rule.save()
+        self.assertMaterialized()
+
+        new = self.exhibition.create_generator(
+            start=datetime.datetime(2010, 4, 1, 19, 0),
+            end=datetime.datetime(2010, 4, 1, 20, 0),
+        )
+        self.assertMaterialized()
+        self.assertEqual(len(Day(ExhibitionEvent.objects.all(), datetime.datetime(2010, 4, 1)).occurrences), 2)
+        new.delete()
+        self.assertMaterialized()
+
+        self.gen.delete()
+        self.assertMaterialized()
+        self.exhibition.delete()
+        self.assertMaterialized()
+
+
+class TestTransactions(MaterializationFixture, TransactionTestCase):
+
+    def test_refreshes_roll_back_with_the_save(self):
+        rows = describe(self.expanded(*self.horizon))
+        def create_and_roll_back():
+            self.exhibition.create_generator(
+                start=datetime.datetime(2010, 4, 1, 19, 0),
+                end=datetime.datetime(2010, 4, 1, 20, 0),
+            )
+            transaction.rollback()
+        transaction.commit_manually(create_and_roll_back)()
+        self.assertEqual(self.exhibition.generators.count(), 1)
+        self.assertEqual(describe(get_occurrences_for_events(ExhibitionEvent.objects.all(), *self.horizon)), rows)
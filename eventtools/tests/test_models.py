@@ -5,7 +5,9 @@ from django.db import models
 from django.db.models import get_model
 from django.db.models.fields.related import ReverseSingleRelatedObjectDescriptor
 from eventtools.tests.eventtools_testapp.models import *
-from datetime import date, datetime, time
+from datetime import date, datetime, time, timedelta
+from eventtools.models import Rule, GeneratedOccurrence
+from eventtools.utils import OccurrenceReplacer, RRuleCache, rrule_cache
 from _inject_app import TestCaseWithApp as TestCase
 
 class TestModelMetaClass(TestCase):
@@ -232,4 +234,199 @@ class TestModel(TestCase):
         
         # but not on an event that doesn't have a varied_by
         lesson = LessonEvent.objects.create(subject="canons")
-        self.assertRaises(AttributeError, lesson.create_variation, {'subject': 'cannons'})
\ No newline at end of file
+        self.assertRaises(AttributeError, lesson.create_variation, {'subject': 'cannons'})
+
+class TestRRuleCache(TestCase):
+
+    def setUp(self):
+        super(TestRRuleCache, self).setUp()
+        rrule_cache.invalidate()
+        self.rule = Rule.objects.create(frequency = "WEEKLY")
+        self.evt = LessonEvent.objects.create(subject="cached rules")
+        self.gen = self.evt.create_generator(start=datetime(2010, 1, 1, 13, 0), end=datetime(2010, 1, 1, 14, 0), rule=self.rule)
+
+    def test_compiled_rule_is_shared(self):
+        """
+        Generators with the same rule and start share one compiled rule, even across instances.
+        """
+        compiled = self.gen.get_rrule_object()
+        gen = self.evt.GeneratorModel.objects.get(pk=self.gen.pk)
+        self.assertTrue(gen.get_rrule_object() is compiled)
+        self.assertEqual(compiled[1], datetime(2010, 1, 8, 13, 0))
+
+    def test_invalidated_on_save(self):
+        compiled = self.gen.get_rrule_object()
+        self.rule.frequency = "DAILY"
+        self.rule.save()
+        self.assertEqual(len(rrule_cache), 0)
+        gen = self.evt.GeneratorModel.objects.get(pk=self.gen.pk)
+        self.assertEqual(gen.get_rrule_object()[1], datetime(2010, 1, 2, 13, 0))
+
+        gen.get_rrule_object()
+        gen.first_start_date = date(2010, 1, 2)
+        gen.save()
+        self.assertEqual(len(rrule_cache), 0)
+
+    def test_lru_eviction(self):
+        cache = RRuleCache(4)
+        rules = [Rule.objects.create(frequency = "DAILY") for i in range(6)]
+        start = datetime(2010, 1, 1)
+        compiled = [cache.get(rule, start) for rule in rules[:4]]
+        # touch the first rule so that it is the most recently used
+        self.assertTrue(cache.get(rules[0], start) is compiled[0])
+        cache.get(rules[4], start)
+        self.assertTrue(len(cache) <= 4)
+        self.assertTrue(cache.get(rules[0], start) is compiled[0])
+        self.assertFalse(cache.get(rules[1], start) is compiled[1])
+
+
+class TestGeneratedOccurrence(TestCase):
+
+    def setUp(self):
+        super(TestGeneratedOccurrence, self).setUp()
+        rule = Rule.objects.create(frequency = "DAILY")
+        self.evt = LectureEvent.objects.create(location='The lecture hall', title='Daily lecture')
+        self.gen = self.evt.create_generator(start=datetime(2010, 1, 1, 13, 0), end=datetime(2010, 1, 1, 14, 0), rule=rule)
+        self.occs = self.gen.get_occurrences(datetime(2010, 1, 1), datetime(2010, 1, 8))
+
+    def test_read_api(self):
+        occ = self.occs[1]
+        self.assertTrue(isinstance(occ, GeneratedOccurrence))
+        self.assertFalse(hasattr(occ, '__dict__'))
+        self.assertEqual(occ.start, datetime(2010, 1, 2, 13, 0))
+        self.assertEqual(occ.end, datetime(2010, 1, 2, 14, 0))
+        self.assertEqual(occ.original_start, occ.start)
+        self.assertEqual(occ.unvaried_end_time, time(14, 0))
+        self.assertEqual(occ.id, None)
+        self.assertEqual(occ.cancelled, False)
+        self.assertEqual(occ.is_varied, False)
+        self.assertEqual(occ.varied_event, None)
+        self.assertEqual(occ.generator, self.gen)
+        self.assertEqual(occ.merged_event.location, 'The lecture hall')
+        self.assertEqual(sorted([self.occs[2], self.occs[0], self.occs[1]]), self.occs[:3])
+        # nothing has needed a model instance yet
+        self.assertEqual(occ._occurrence, None)
+
+    def test_promoted_on_change(self):
+        occ = self.occs[1]
+        occ.varied_start_time = time(15, 0)
+        occ.varied_end_time = time(16, 0)
+        self.assertTrue(isinstance(occ.promote(), LectureEventOccurrence))
+        self.assertEqual(occ.start, datetime(2010, 1, 2, 15, 0))
+        self.assertEqual(occ.is_moved, True)
+        occ.save()
+        self.assertTrue(occ.id)
+
+        occ = self.occs[2]
+        occ.cancel()
+        self.assertTrue(occ.id)
+
+        occs = self.gen.get_occurrences(datetime(2010, 1, 1), datetime(2010, 1, 8))
+        self.assertEqual([type(o) for o in occs[:4]],
+            [GeneratedOccurrence, LectureEventOccurrence, LectureEventOccurrence, GeneratedOccurrence])
+        self.assertEqual(occs[1].start, datetime(2010, 1, 2, 15, 0))
+        self.assertEqual(occs[2].cancelled, True)
+        self.assertEqual(occs[1], self.occs[1])
+
+
+class TestOccurrenceIdentity(TestCase):
+
+    def test_replacement_without_queries(self):
+        """
+        Matching generated occurrences against exceptions compares ids, so it never queries for generators or events.
+        """
+        rule = Rule.objects.create(frequency = "HOURLY")
+        evt = LessonEvent.objects.create(subject="hourly")
+        gen = evt.create_generator(start=datetime(2010, 1, 1, 0, 0), end=datetime(2010, 1, 1, 0, 30), rule=rule)
+        start = datetime(2010, 1, 1)
+        end = start + timedelta(hours=9999)
+        for occ in gen.get_occurrences(start, end)[::1000]:
+            occ.cancel()
+
+        # fresh instances, with nothing cached on them
+        gen = evt.GeneratorModel.objects.get(pk=gen.pk)
+        exceptions = list(gen.occurrences.all())
+        generated = gen._get_occurrence_list(start, end)
+        self.assertEqual(len(generated), 10000)
+
+        def replace():
+            replacer = OccurrenceReplacer(exceptions)
+            return [replacer.get_occurrence(occ) for occ in generated]
+        replaced, num_queries = self.count_queries(replace)
+        self.assertEqual(num_queries, 0)
+        self.assertEqual(len([occ for occ in replaced if occ.cancelled]), 10)
+        self.assertEqual(replaced[1000], exceptions[1])
+        self.assertEqual(hash(replaced[1000]), hash(generated[1000]))
+
+
+class TestOccurrenceNumbering(TestCase):
+
+    def setUp(self):
+        super(TestOccurrenceNumbering, self).setUp() #monkeypatch in the test app
+        self.course = TestEvent.objects.create(title='Evening course')
+        self.weekly = self.course.create_generator(
+            start=datetime(2010, 2, 2, 18, 0),
+            end=datetime(2010, 2, 2, 20, 0),
+            rule=Rule.objects.create(frequency = "WEEKLY", params = "count:10"),
+        )
+        self.monthly = self.course.create_generator(
+            start=datetime(1990, 1, 15, 10, 0),
+            end=datetime(1990, 1, 15, 11, 0),
+            rule=Rule.objects.create(frequency = "MONTHLY", params = "bymonthday:1,15"),
+        )
+
+    def test_nth_and_ordinal(self):
+        self.assertEqual(self.weekly.get_occurrence_total(), 10)
+        fifth = self.weekly.get_nth_occurrence(4)
+        self.assertEqual(fifth.start, datetime(2010, 3, 2, 18, 0))
+        self.assertRaises(IndexError, self.weekly.get_nth_occurrence, 10)
+
+        # exceptions keep the number of the occurrence they replace
+        fifth.cancel()
+        fourth = self.weekly.get_nth_occurrence(3)
+        fourth.varied_start_date = fourth.varied_end_date = date(2010, 3, 5)
+        fourth.save()
+        self.assertEqual(self.weekly.get_nth_occurrence(4).cancelled, True)
+        self.assertEqual(self.weekly.get_nth_occurrence(3).start, datetime(2010, 3, 5, 18, 0))
+        labels = ["%s of %s" % (self.weekly.get_occurrence_ordinal(occ) + 1, self.weekly.get_occurrence_total())
+            for occ in self.weekly.get_occurrences(datetime(2010, 2, 20), datetime(2010, 3, 10))]
+        self.assertEqual(labels, ["4 of 10", "5 of 10", "6 of 10"])
+
+    def test_irregular_rule(self):
+        occ = self.monthly.get_nth_occurrence(500)
+        self.assertEqual(occ.start, datetime(2010, 11, 15, 10, 0))
+        self.assertEqual(self.monthly.get_occurrence_ordinal(occ), 500)
+        self.assertEqual(self.monthly.get_occurrence_total(), None)
+        self.monthly.repeat_until = datetime(2010, 11, 15, 10, 0)
+        self.assertEqual(self.monthly.get_occurrence_total(), 501)
+        self.assertRaises(ValueError, self.monthly.get_occurrence_ordinal,
+            GeneratedOccurrence(self.monthly, datetime(2010, 11, 2, 10, 0), datetime(2010, 11, 2, 11, 0)))
+
+
+class TestRuleToRRule(TestCase):
+
+    def test_same_as_compiled(self):
+        from dateutil.rrule import rrulestr
+        dtstart = datetime(2010, 1, 4, 9, 0)
+        until = datetime(2010, 12, 31)
+        rules = [
+            Rule(frequency="WEEKLY", params="interval:2;byweekday:0,2"),
+            Rule(frequency="MONTHLY", params="bymonthday:3,5;bymonth:3,5,8"),
+            Rule(frequency="MONTHLY", params="byweekday:4;bysetpos:-1"),
+            Rule(frequency="DAILY", params="count:10"),
+            Rule(frequency="YEARLY"),
+            Rule(complex_rule="RRULE:FREQ=WEEKLY;BYDAY=TU,TH"),
+        ]
+        for rule in rules:
+            compiled = rule.compile(dtstart)
+            expected = compiled.between(dtstart, datetime(2020, 1, 1), inc=True)
+            written = rrulestr('RRULE:' + rule.to_rrule(), dtstart=dtstart)
+            self.assertEqual(written.between(dtstart, datetime(2020, 1, 1), inc=True), expected)
+            if 'count' not in rule.get_params():
+                written = rrulestr('RRULE:' + rule.to_rrule(until), dtstart=dtstart)
+                self.assertEqual(list(written), [d for d in expected if d <= until])
+
+    def test_unwritable(self):
+        self.assertEqual(Rule(frequency="YEARLY", params="byeaster:0").to_rrule(), None)
+        self.assertEqual(Rule(complex_rule="RRULE:FREQ=DAILY\nEXRULE:FREQ=WEEKLY").to_rrule(), None)
+        self.assertEqual(Rule(frequency="DAILY", params="count:3").to_rrule(datetime(2010, 1, 1)), None)
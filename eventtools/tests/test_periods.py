@@ -1,5 +1,7 @@
 import datetime
+import itertools
 import os
+import random
 
 from django.conf import settings
 from django.core.urlresolvers import reverse
@@ -7,8 +9,8 @@ from django.core.urlresolvers import reverse
 from eventtools.conf.settings import FIRST_DAY_OF_WEEK
 from eventtools.tests.eventtools_testapp.models import *
 from eventtools.periods import Period, Month, Day, Year
-from eventtools.utils import EventListManager
-from eventtools.models import Rule
+from eventtools.utils import EventListManager, OccurrenceIndex
+from eventtools.models import Rule, SlidingExpansion, count_occurrences_for_events, get_occurrence_histogram_for_events, get_occurrences_for_events, get_occurrence_arrays_for_events, numpy
 from _inject_app import TestCaseWithApp as TestCase
 
 
@@ -258,3 +260,524 @@ class TestOccurrencePool(TestCase):
         period = Period(parent_period.events, start, end, parent_period.get_exceptional_occurrences(), parent_period.occurrences)
         self.assertEquals(parent_period.occurrences, period.occurrences)
 
+
+
+class TestBatchedOccurrences(TestCase):
+
+    def setUp(self):
+        super(TestBatchedOccurrences, self).setUp() #monkeypatch in the test app
+        self.rule = Rule(frequency = "WEEKLY")
+        self.rule.save()
+        self.start = datetime.datetime(2008, 1, 1)
+        self.end = datetime.datetime(2008, 3, 1)
+
+    def _create_events(self, num):
+        for i in range(num):
+            event = TestEvent.objects.create(title='Event %s' % i)
+            for hour in (8, 12, 16):
+                gen = event.create_generator(
+                    start=datetime.datetime(2008, 1, 5, hour, 0),
+                    end=datetime.datetime(2008, 1, 5, hour + 1, 0),
+                    rule=self.rule,
+                )
+                occs = gen.get_occurrences(self.start, self.end)
+                occs[0].cancel()
+                occs[1].varied_start_time = datetime.time(hour, 30)
+                occs[1].save()
+
+    def test_constant_query_count(self):
+        """
+        Occurrences for any number of events are fetched with the same number of queries.
+        """
+        self._create_events(1)
+        period = Period(TestEvent.objects.all(), self.start, self.end)
+        occurrences, few = self.count_queries(lambda: period.occurrences)
+        self.assertEqual(len(occurrences), 3 * 8)
+
+        self._create_events(4)
+        period = Period(TestEvent.objects.all(), self.start, self.end)
+        occurrences, many = self.count_queries(lambda: period.occurrences)
+        self.assertEqual(len(occurrences), 5 * 3 * 8)
+        self.assertEqual(few, many)
+        self.assertEqual(many, 2)
+
+        event = TestEvent.objects.all()[0]
+        occurrences, num_queries = self.count_queries(event.get_occurrences, self.start, self.end)
+        self.assertEqual(num_queries, 2)
+
+    def test_same_as_per_generator(self):
+        self._create_events(2)
+        expected = []
+        for event in TestEvent.objects.all():
+            for gen in event.generators.all():
+                expected += gen.get_occurrences(self.start, self.end)
+        actual = Period(TestEvent.objects.all(), self.start, self.end).occurrences
+        self.assertEqual(
+            [(o.start, o.end, o.cancelled, o.id) for o in actual],
+            [(o.start, o.end, o.cancelled, o.id) for o in sorted(expected)])
+
+
+class TestOccurrencesAfter(TestCase):
+
+    def setUp(self):
+        super(TestOccurrencesAfter, self).setUp() #monkeypatch in the test app
+        weekly = Rule.objects.create(frequency = "WEEKLY")
+        daily = Rule.objects.create(frequency = "DAILY")
+        for i, hour in enumerate((8, 12, 16)):
+            event = TestEvent.objects.create(title='Event %s' % i)
+            gen = event.create_generator(
+                start=datetime.datetime(2008, 1, 5, hour, 0),
+                end=datetime.datetime(2008, 1, 5, hour + 1, 0),
+                rule=weekly,
+            )
+            occs = gen.get_occurrences(datetime.datetime(2008, 1, 1), datetime.datetime(2008, 2, 1))
+            occs[1].cancel()
+            # moved later than the next occurrence
+            occs[2].varied_start_date = occs[2].varied_end_date = datetime.date(2008, 1, 28)
+            occs[2].save()
+            # moved from before ``after`` to after it
+            occs[0].varied_start_date = occs[0].varied_end_date = datetime.date(2008, 1, 15)
+            occs[0].save()
+        # a daily generator that never ends
+        TestEvent.objects.create(title='Daily').create_generator(
+            start=datetime.datetime(2000, 1, 1, 7, 0),
+            end=datetime.datetime(2000, 1, 1, 7, 30),
+            rule=daily,
+        )
+        self.after = datetime.datetime(2008, 1, 10)
+
+    def test_same_as_expansion(self):
+        end = datetime.datetime(2008, 3, 1)
+        expected = [o for o in Period(TestEvent.objects.all(), self.after, end).occurrences if o.end > self.after]
+        actual = []
+        for occ in EventListManager(TestEvent.objects.all()).occurrences_after(self.after):
+            if occ.start >= end:
+                break
+            actual.append(occ)
+        self.assertEqual(
+            [(o.start, o.end, o.cancelled, o.id) for o in actual],
+            [(o.start, o.end, o.cancelled, o.id) for o in expected])
+        self.assertEqual(actual[0].start, datetime.datetime(2008, 1, 10, 7, 0))
+
+    def test_lazy(self):
+        events = list(TestEvent.objects.all())
+        stream, num_queries = self.count_queries(EventListManager(events).occurrences_after, self.after)
+        next_ten, more_queries = self.count_queries(lambda: list(itertools.islice(stream, 10)))
+        # the generators and the exceptions, however many occurrences are taken
+        self.assertEqual(num_queries + more_queries, 2)
+        self.assertEqual(len(next_ten), 10)
+
+        event = TestEvent.objects.get(title='Event 0')
+        self.assertEqual([(o.start, o.cancelled) for o in itertools.islice(event.occurrences_after(self.after), 4)], [
+            (datetime.datetime(2008, 1, 12, 8, 0), True),
+            (datetime.datetime(2008, 1, 15, 8, 0), False),
+            (datetime.datetime(2008, 1, 26, 8, 0), False),
+            (datetime.datetime(2008, 1, 28, 8, 0), False),
+        ])
+
+
+class MixedEventsFixture(object):
+    """
+    Two events with regular, irregular and one-off generators and a few
+    exceptions. Mixed into TestCases.
+    """
+
+    def setUp(self):
+        super(MixedEventsFixture, self).setUp() #monkeypatch in the test app
+        weekly = Rule.objects.create(frequency = "WEEKLY", params = "byweekday:1,3")
+        daily = Rule.objects.create(frequency = "DAILY", params = "interval:2")
+        monthly = Rule.objects.create(frequency = "MONTHLY", params = "bymonthday:1,15")
+        event = TestEvent.objects.create(title='Tuesdays and Thursdays')
+        gen = event.create_generator(
+            start=datetime.datetime(2007, 1, 2, 18, 0),
+            end=datetime.datetime(2007, 1, 2, 20, 0),
+            rule=weekly,
+        )
+        occs = gen.get_occurrences(datetime.datetime(2008, 1, 1), datetime.datetime(2008, 2, 1))
+        occs[0].cancel()
+        occs[1].varied_start_date = occs[1].varied_end_date = datetime.date(2008, 3, 1)
+        occs[1].save()
+        occ = gen.get_occurrences(datetime.datetime(2009, 1, 1), datetime.datetime(2009, 1, 8))[0]
+        occ.varied_start_date = occ.varied_end_date = datetime.date(2008, 1, 19)
+        occ.save()
+        event.create_generator(
+            start=datetime.datetime(2000, 1, 1, 9, 0),
+            end=datetime.datetime(2000, 1, 1, 9, 30),
+            rule=daily,
+            repeat_until=datetime.datetime(2008, 1, 20),
+        )
+        other = TestEvent.objects.create(title='Other')
+        other.create_generator(
+            start=datetime.datetime(2007, 6, 1, 12, 0),
+            end=datetime.datetime(2007, 6, 1, 13, 0),
+            rule=monthly,
+        )
+        other.create_generator(
+            start=datetime.datetime(2008, 1, 10, 12, 0),
+            end=datetime.datetime(2008, 1, 12, 12, 0),
+        )
+
+
+class TestOccurrenceArrays(MixedEventsFixture, TestCase):
+
+    def test_same_as_occurrences(self):
+        if numpy is None:
+            return
+        for start, end in [
+            (datetime.datetime(2008, 1, 1), datetime.datetime(2008, 2, 1)),
+            (datetime.datetime(2008, 1, 1), datetime.datetime(2009, 1, 1)),
+            (datetime.datetime(2008, 1, 11), datetime.datetime(2008, 1, 11, 12)),
+        ]:
+            expected = get_occurrences_for_events(TestEvent.objects.all(), start, end)
+            actual = get_occurrence_arrays_for_events(TestEvent.objects.all(), start, end)
+            self.assertTrue(len(actual))
+            self.assertEqual(
+                [(o['generator_id'], o['occurrence_id'], o['start'].astype(object), o['end'].astype(object), o['cancelled']) for o in actual],
+                [(o.generator_id, o.id or -1, o.start, o.end, o.cancelled) for o in expected])
+
+
+class TestCounting(MixedEventsFixture, TestCase):
+
+    def test_counts(self):
+        for start, end in [
+            (datetime.datetime(2008, 1, 1), datetime.datetime(2008, 2, 1)),
+            (datetime.datetime(2008, 1, 1), datetime.datetime(2009, 1, 1)),
+            (datetime.datetime(2008, 1, 11), datetime.datetime(2008, 1, 11, 12)),
+            (datetime.datetime(2008, 1, 15, 20), datetime.datetime(2008, 1, 17, 18)),
+        ]:
+            occurrences = get_occurrences_for_events(TestEvent.objects.all(), start, end)
+            count, num_queries = self.count_queries(count_occurrences_for_events, list(TestEvent.objects.all()), start, end)
+            self.assertEqual(count, len(occurrences))
+            self.assertEqual(num_queries, 2)
+            self.assertEqual(count_occurrences_for_events(TestEvent.objects.all(), start, end, include_cancelled=False),
+                len([o for o in occurrences if not o.cancelled]))
+            for event in TestEvent.objects.all():
+                self.assertEqual(event.count_occurrences(start, end), len(event.get_occurrences(start, end)))
+
+    def test_long_hourly_series(self):
+        event = TestEvent.objects.create(title='Hourly')
+        gen = event.create_generator(
+            start=datetime.datetime(2000, 1, 1, 0, 30),
+            end=datetime.datetime(2000, 1, 1, 0, 45),
+            rule=Rule.objects.create(frequency = "HOURLY"),
+        )
+        start, end = datetime.datetime(2000, 1, 1), datetime.datetime(2010, 1, 1)
+        self.assertEqual(gen.count_occurrences(start, end, []), (end - start).days * 24)
+
+    def test_has_multiple_occurrences(self):
+        events = dict([(event.title, event) for event in TestEvent.objects.all()])
+        self.assertEqual(self.count_queries(lambda: events['Other'].has_multiple_occurrences), (True, 1))
+        once = TestEvent.objects.create(title='Once')
+        once.create_generator(start=datetime.datetime(2008, 1, 1, 10, 0), end=datetime.datetime(2008, 1, 1, 11, 0))
+        self.assertEqual(once.has_multiple_occurrences, False)
+        once.generators.all()[0].delete()
+        once.create_generator(start=datetime.datetime(2008, 1, 1, 10, 0), end=datetime.datetime(2008, 1, 1, 11, 0),
+            rule=Rule.objects.create(frequency = "DAILY", params = "count:1"))
+        self.assertEqual(once.has_multiple_occurrences, False)
+
+
+class TestOccurrenceIndex(TestCase):
+
+    def test_same_as_scanning(self):
+        class Occ(object):
+            def __init__(self, start, end):
+                self.start, self.end = start, end
+        rnd = random.Random(3)
+        base = datetime.datetime(2010, 1, 1)
+        occurrences = []
+        for i in range(2000):
+            start = base + datetime.timedelta(minutes=rnd.randint(0, 60 * 24 * 365))
+            # mostly short, some very long-running
+            length = rnd.choice([30, 60, 90, 60 * 24 * 3, 60 * 24 * rnd.randint(30, 300)])
+            occurrences.append(Occ(start, start + datetime.timedelta(minutes=length)))
+        occurrences.sort(key=lambda o: (o.start, o.end))
+        index = OccurrenceIndex(occurrences)
+        for i in range(200):
+            start = base + datetime.timedelta(minutes=rnd.randint(-60 * 24 * 30, 60 * 24 * 400))
+            end = start + datetime.timedelta(minutes=rnd.choice([0, 60, 60 * 24, 60 * 24 * 31]))
+            self.assertEqual(index.overlapping(start, end),
+                [o for o in occurrences if o.start <= end and o.end >= start])
+
+    def test_nested_periods(self):
+        rule = Rule.objects.create(frequency = "DAILY", params = "interval:3")
+        event = TestEvent.objects.create(title='Every few days')
+        event.create_generator(start=datetime.datetime(2009, 12, 30, 10, 0), end=datetime.datetime(2009, 12, 30, 12, 0), rule=rule)
+        event.create_generator(start=datetime.datetime(2010, 2, 20, 9, 0), end=datetime.datetime(2010, 5, 2, 17, 0))
+        year = Year(TestEvent.objects.all(), datetime.datetime(2010, 1, 1))
+        for month in year.get_months():
+            self.assertTrue(month.occurrence_pool is year.occurrence_index)
+            for day in month.get_days():
+                self.assertEqual(day.occurrences, [o for o in year.occurrences if o.start <= day.end and o.end >= day.start])
+        april = Month(TestEvent.objects.all(), datetime.datetime(2010, 4, 1))
+        self.assertEqual(
+            [len(day.occurrences) for day in april.get_days()],
+            [len(Day(TestEvent.objects.all(), day.start).occurrences) for day in april.get_days()])
+
+
+class TestCalendarTree(TestCase):
+
+    def setUp(self):
+        super(TestCalendarTree, self).setUp() #monkeypatch in the test app
+        rule = Rule.objects.create(frequency = "WEEKLY", params = "byweekday:0,2,4")
+        for i in range(5):
+            event = TestEvent.objects.create(title='Event %s' % i)
+            gen = event.create_generator(start=datetime.datetime(2009, 6, 1, 9 + i, 0), end=datetime.datetime(2009, 6, 1, 10 + i, 0), rule=rule)
+            gen.get_occurrences(datetime.datetime(2010, 3, 1), datetime.datetime(2010, 3, 8))[0].cancel()
+
+    def test_one_expansion_per_tree(self):
+        events = list(TestEvent.objects.all())
+        year = Year(events, datetime.datetime(2010, 1, 1))
+
+        def walk():
+            days = 0
+            for month in year.get_months():
+                for week in month.get_weeks():
+                    for day in week.get_days():
+                        days += len(day.occurrences)
+                # navigating within the year
+                if month.end < year.end:
+                    days += len(month.next_month().occurrences)
+                days += len(month.get_day(3).next_day().occurrences)
+            return days
+        days, num_queries = self.count_queries(walk)
+        # the generators and the exceptions, for the whole tree
+        self.assertEqual(num_queries, 2)
+        self.assertTrue(days > len(year.occurrences))
+
+        march = year.get_period(Month, datetime.datetime(2010, 3, 5))
+        self.assertTrue(march.occurrence_pool is year.occurrence_index)
+        self.assertEqual(march.occurrences, Month(events, datetime.datetime(2010, 3, 5)).occurrences)
+        # outside the year, periods are expanded as usual
+        self.assertEqual(march.next_year().occurrence_pool, None)
+        self.assertEqual(year.get_period(Month, datetime.datetime(2010, 12, 1)).next_month().occurrence_pool, None)
+
+
+class TestSlidingNavigation(TestCase):
+
+    def setUp(self):
+        super(TestSlidingNavigation, self).setUp() #monkeypatch in the test app
+        weekly = Rule.objects.create(frequency = "WEEKLY", params = "byweekday:0,3")
+        monthly = Rule.objects.create(frequency = "MONTHLY", params = "bymonthday:1,15,31")
+        for i, rule in enumerate([weekly, monthly, weekly]):
+            event = TestEvent.objects.create(title='Event %s' % i)
+            gen = event.create_generator(start=datetime.datetime(2005, 1, 3, 20 + i, 0), end=datetime.datetime(2005, 1, 4, 9, 0), rule=rule)
+            # moved into the next month, cancelled, and cancelled after moving
+            for month, move in ((3, True), (5, False), (8, True)):
+                occ = gen.get_occurrences(datetime.datetime(2010, month, 25), datetime.datetime(2010, month + 1, 1))[-1]
+                if move:
+                    occ.varied_start_date = occ.varied_end_date = datetime.date(2010, month + 1, 2)
+                    occ.save()
+                if month != 3:
+                    occ.cancel()
+        self.events = list(TestEvent.objects.all())
+
+    def key(self, occurrences):
+        return [(o.generator_id, o.start, o.end, o.cancelled) for o in occurrences]
+
+    def expected(self, periods):
+        return [self.key(get_occurrences_for_events(self.events, p.start, p.end)) for p in periods]
+
+    def walk(self, period, steps, forward=True):
+        periods = [period]
+        for i in range(steps):
+            period = forward and period.next() or period.prev()
+            periods.append(period)
+        return periods, [self.key(p.occurrences) for p in periods]
+
+    def test_paging_months(self):
+        (months, found), num_queries = self.count_queries(self.walk, Month(self.events, datetime.datetime(2009, 12, 1)), 23)
+        self.assertEqual(found, self.expected(months))
+        # the generators once, then the exceptions of each month
+        self.assertEqual(num_queries, 1 + 24)
+
+        (months, found), num_queries = self.count_queries(self.walk, Month(self.events, datetime.datetime(2011, 1, 1)), 23, False)
+        self.assertEqual(found, self.expected(months))
+        self.assertEqual(num_queries, 1 + 24)
+
+    def test_sliding_windows(self):
+        """
+        Overlapping windows keep the exceptions they share, and only fetch
+        those of the part they expose.
+        """
+        expansion = SlidingExpansion(self.events)
+        start = datetime.datetime(2010, 2, 20)
+        for day in range(60):
+            window = (start + datetime.timedelta(days=day), start + datetime.timedelta(days=day + 14))
+            occs, num_queries = self.count_queries(expansion.get_occurrences, *window)
+            self.assertEqual(self.key(occs), self.key(get_occurrences_for_events(self.events, *window)))
+            self.assertEqual(num_queries, day and 1 or 2)
+        # the monthly rule is carried on by the expansion, not by its generator
+        monthly = [g for g in expansion._generators if g.rule.frequency == "MONTHLY"][0]
+        self.assertEqual(expansion._cursors.keys(), [monthly.id])
+        self.assertEqual(monthly.get_occurrences(*window), get_occurrences_for_events(self.events[1:2], *window))
+        # and backwards
+        for day in range(60, 0, -7):
+            window = (start + datetime.timedelta(days=day), start + datetime.timedelta(days=day + 14))
+            occs = expansion.get_occurrences(*window)
+            self.assertEqual(self.key(occs), self.key(get_occurrences_for_events(self.events, *window)))
+
+
+class TestOccurrenceHistogram(TestCase):
+
+    def setUp(self):
+        super(TestOccurrenceHistogram, self).setUp() #monkeypatch in the test app
+        weekly = Rule.objects.create(frequency = "WEEKLY", params = "byweekday:0,4")
+        monthly = Rule.objects.create(frequency = "MONTHLY", params = "bymonthday:1,10,20")
+        late = TestEvent.objects.create(title='Overnight')
+        gen = late.create_generator(start=datetime.datetime(2009, 1, 2, 22, 0), end=datetime.datetime(2009, 1, 3, 2, 0), rule=weekly)
+        occs = gen.get_occurrences(datetime.datetime(2010, 3, 1), datetime.datetime(2010, 3, 8))
+        occs[0].cancel()
+        occs[1].varied_start_date = datetime.date(2010, 3, 13)
+        occs[1].varied_end_date = datetime.date(2010, 3, 14)
+        occs[1].save()
+        until_midnight = TestEvent.objects.create(title='Ends at midnight')
+        until_midnight.create_generator(start=datetime.datetime(2009, 1, 1, 20, 0), end=datetime.datetime(2009, 1, 2, 0, 0), rule=monthly)
+        fair = TestEvent.objects.create(title='Four days')
+        fair.create_generator(start=datetime.datetime(2010, 2, 27, 9, 0), end=datetime.datetime(2010, 3, 2, 17, 0))
+        self.events = list(TestEvent.objects.all())
+
+    def expected(self, start, size, bins, include_cancelled=False):
+        occurrences = get_occurrences_for_events(self.events, start - size, start + size * (bins + 1))
+        counts = []
+        for i in range(bins):
+            bin_start, bin_end = start + size * i, start + size * (i + 1)
+            counts.append(len([o for o in occurrences if o.start < bin_end and
+                (o.end > bin_start or o.end == o.start >= bin_start) and (include_cancelled or not o.cancelled)]))
+        return counts
+
+    def test_days(self):
+        month = Month(self.events, datetime.datetime(2010, 3, 1))
+        counts, num_queries = self.count_queries(month.get_occurrence_histogram)
+        self.assertEqual(num_queries, 2)
+        self.assertEqual(list(counts), self.expected(month.start, datetime.timedelta(days=1), 31))
+        # the cancelled monday night, the friday night moved to saturday the 13th
+        self.assertEqual(list(counts[:6]), [2, 1, 0, 0, 0, 0])
+        self.assertEqual(list(counts[12:14]), [2, 1])
+        self.assertEqual(list(month.get_occurrence_histogram(include_cancelled=True)),
+            self.expected(month.start, datetime.timedelta(days=1), 31, True))
+
+        # the same from occurrences that are already at hand
+        month.occurrences
+        self.assertEqual(self.count_queries(month.get_occurrence_histogram), (counts, 0))
+
+    def test_hours(self):
+        day = Day(self.events, datetime.datetime(2010, 3, 2))
+        counts = day.get_occurrence_histogram(datetime.timedelta(hours=1))
+        self.assertEqual(len(counts), 24)
+        self.assertEqual(list(counts), self.expected(day.start, datetime.timedelta(hours=1), 24))
+        self.assertEqual(list(counts[15:19]), [1, 1, 0, 0])
+
+    def test_dense_regular_rule(self):
+        """
+        A regular rule with more occurrences than bins is counted a bin at a
+        time.
+        """
+        often = Rule.objects.create(frequency = "HOURLY", params = "interval:5")
+        tour = TestEvent.objects.create(title='Tour')
+        gen = tour.create_generator(start=datetime.datetime(2010, 1, 1, 9, 0), end=datetime.datetime(2010, 1, 1, 10, 30),
+            rule=often, repeat_until=datetime.datetime(2010, 3, 1, 6, 0))
+        occs = gen.get_occurrences(datetime.datetime(2010, 2, 27), datetime.datetime(2010, 2, 28))
+        occs[0].cancel()
+        occs[1].varied_start_date = occs[1].varied_end_date = datetime.date(2010, 3, 2)
+        occs[1].save()
+        self.events = list(TestEvent.objects.all())
+        for size, bins in ((datetime.timedelta(days=1), 10), (datetime.timedelta(hours=7), 30), (datetime.timedelta(hours=2), 70)):
+            start = datetime.datetime(2010, 2, 25, 0, 30)
+            for include_cancelled in (False, True):
+                counts = get_occurrence_histogram_for_events(self.events, start, start + size * bins, size, include_cancelled)
+                self.assertEqual(list(counts), self.expected(start, size, bins, include_cancelled))
+
+    def test_month_calendar(self):
+        from eventtools.templatetags.month_calendar import month_calendar
+        weeks = month_calendar(datetime.date(2010, 3, 5), events=self.events)['month_calendar']
+        days = dict([(day['date'], day) for week in weeks for day in week])
+        self.assertEqual(days[datetime.date(2010, 3, 1)]['occurrences'], 2)
+        self.assertTrue('has_occurrences' in days[datetime.date(2010, 3, 1)]['classes'])
+        self.assertEqual(days[datetime.date(2010, 3, 3)]['occurrences'], 0)
+        self.assertFalse('has_occurrences' in days[datetime.date(2010, 3, 3)]['classes'])
+        # days of the neighbouring months are counted too
+        self.assertEqual(days[datetime.date(2010, 2, 28)]['occurrences'], 1)
+
+
+class TestTimeSlots(TestCase):
+
+    def setUp(self):
+        super(TestTimeSlots, self).setUp() #monkeypatch in the test app
+        rule = Rule.objects.create(frequency = "DAILY")
+        for i in range(40):
+            event = TestEvent.objects.create(title='Booking %s' % i)
+            start = datetime.datetime(2010, 1, 1, 6, 0) + datetime.timedelta(minutes=17 * i)
+            gen = event.create_generator(start=start, end=start + datetime.timedelta(minutes=5 * (i % 7) + 10), rule=rule)
+            if i % 9 == 0:
+                gen.get_occurrences(datetime.datetime(2010, 3, 2), datetime.datetime(2010, 3, 3))[0].cancel()
+        self.events = list(TestEvent.objects.all())
+
+    def test_five_minute_slots(self):
+        from eventtools.periods import TimeSlot
+        from eventtools.templatetags.eventstags import _cook_slots
+        day = Day(self.events, datetime.datetime(2010, 3, 2))
+        slots, num_queries = self.count_queries(lambda: [(slot, slot.occurrences, slot.has_occurrences())
+            for slot in _cook_slots(day, 5, 100, 1440)])
+        self.assertEqual(num_queries, 2)
+        self.assertEqual(len(slots), 288)
+        self.assertEqual([(s.start, s.top, s.height) for s, o, h in slots[:2]], [
+            (datetime.datetime(2010, 3, 2, 0, 0), 0, 5),
+            (datetime.datetime(2010, 3, 2, 0, 5), 5, 5),
+        ])
+        # the same as sub-periods of the day
+        for slot, occurrences, has_occurrences in slots:
+            self.assertTrue(isinstance(slot, TimeSlot))
+            period = Period(self.events, slot.start, slot.end, occurrence_pool=list(day.occurrences))
+            self.assertEqual(occurrences, period.occurrences)
+            self.assertEqual(has_occurrences, period.has_occurrences())
+        self.assertTrue(len([h for s, o, h in slots if h]) > 100)
+
+    def test_time_slot_shares_index(self):
+        day = Day(self.events, datetime.datetime(2010, 3, 2))
+        day.occurrences
+        part = day.get_time_slot(datetime.datetime(2010, 3, 2, 8, 0), datetime.datetime(2010, 3, 2, 20, 0))
+        occurrences, num_queries = self.count_queries(lambda: part.occurrences)
+        self.assertEqual(num_queries, 0)
+        self.assertEqual(occurrences, Period(self.events, part.start, part.end, occurrence_pool=list(day.occurrences)).occurrences)
+
+
+class TestExceptionWindow(TestCase):
+
+    def setUp(self):
+        super(TestExceptionWindow, self).setUp() #monkeypatch in the test app
+        rule = Rule(frequency = "WEEKLY")
+        rule.save()
+        self.event = TestEvent.objects.create(title='Weekly for years')
+        self.gen = self.event.create_generator(
+            start=datetime.datetime(2005, 1, 1, 8, 0),
+            end=datetime.datetime(2005, 1, 1, 9, 0),
+            rule=rule,
+        )
+        # an exception a year for the last few years
+        for year in range(2005, 2009):
+            occ = self.gen.get_occurrences(datetime.datetime(year, 3, 1), datetime.datetime(year, 3, 8))[0]
+            occ.cancel()
+
+    def test_only_relevant_exceptions_loaded(self):
+        day = Day(TestEvent.objects.all(), datetime.datetime(2008, 3, 3))
+        self.assertEqual(list(day.get_exceptional_occurrences()), [])
+        week = Period(TestEvent.objects.all(), datetime.datetime(2008, 3, 1), datetime.datetime(2008, 3, 8))
+        self.assertEqual(len(week.get_exceptional_occurrences()), 1)
+        self.assertEqual([o.cancelled for o in week.occurrences], [True])
+
+    def test_moved_in_from_outside(self):
+        """
+        An occurrence moved into the window from years away is still found, and it leaves a gap where it came from.
+        """
+        occ = self.gen.get_occurrences(datetime.datetime(2006, 6, 1), datetime.datetime(2006, 6, 8))[0]
+        occ.varied_start_date = datetime.date(2008, 6, 4)
+        occ.varied_end_date = datetime.date(2008, 6, 4)
+        occ.save()
+
+        moved_to = Day(TestEvent.objects.all(), datetime.datetime(2008, 6, 4))
+        self.assertEqual([o.id for o in moved_to.occurrences], [occ.id])
+        self.assertEqual(len(moved_to.get_exceptional_occurrences()), 1)
+        self.assertEqual([o.id for o in self.event.get_occurrences(moved_to.start, moved_to.end)], [occ.id])
+
+        moved_from = self.gen.get_occurrences(occ.unvaried_start, occ.unvaried_end)
+        self.assertEqual(moved_from, [])
@@ -0,0 +1,135 @@
+import random
+import unittest
+from datetime import datetime, timedelta
+from itertools import islice
+from dateutil import rrule
+
+from eventtools.recurrence import IterationCheckpoint, RegularPattern, count_until, nth, numpy, ordinal, regular_pattern
+
+
+class TestRegularPattern(unittest.TestCase):
+
+    def random_params(self, rnd):
+        params = {}
+        if rnd.random() < .7:
+            params['interval'] = rnd.randint(1, 9)
+        if rnd.random() < .3:
+            params['count'] = rnd.randint(1, 40)
+        if rnd.random() < .4:
+            params['byweekday'] = rnd.sample(range(7), rnd.randint(1, 3))
+        if rnd.random() < .3:
+            params['byhour'] = rnd.sample(range(24), rnd.randint(1, 3))
+        if rnd.random() < .2:
+            params['byminute'] = rnd.sample(range(60), rnd.randint(1, 2))
+        if rnd.random() < .1:
+            params['wkst'] = rnd.randint(0, 6)
+        return params
+
+    def test_same_as_dateutil(self):
+        rnd = random.Random(1)
+        patterns = 0
+        for i in range(200):
+            frequency = rnd.choice([rrule.WEEKLY, rrule.DAILY, rrule.HOURLY])
+            params = self.random_params(rnd)
+            dtstart = datetime(2000, 1, 1) + timedelta(seconds=rnd.randint(0, 10**8))
+            pattern = regular_pattern(frequency, dtstart, params)
+            if pattern is None:
+                continue
+            patterns += 1
+            rule = rrule.rrule(frequency, dtstart=dtstart, **params)
+            for j in range(5):
+                after = dtstart + timedelta(seconds=rnd.randint(-10**6, 10**7), microseconds=rnd.choice([0, 5]))
+                before = after + timedelta(seconds=rnd.randint(0, 10**6))
+                inc = rnd.random() < .5
+                self.assertEqual(pattern.between(after, before, inc=inc), rule.between(after, before, inc=inc))
+                self.assertEqual(pattern.after(after, inc=inc), rule.after(after, inc=inc))
+                self.assertEqual(pattern.count_between(after, before, inc=inc), len(rule.between(after, before, inc=inc)))
+                if numpy is not None:
+                    self.assertEqual(list(pattern.between_array(after, before, inc=inc).astype(object)),
+                        rule.between(after, before, inc=inc))
+            self.assertEqual(list(islice(pattern, 50)), list(islice(rule, 50)))
+            self.assertEqual(pattern[17:20], rule[17:20])
+        # nearly all of them are regular
+        self.assertTrue(patterns > 180)
+
+    def test_irregular_rules(self):
+        dtstart = datetime(2005, 1, 1, 10, 0)
+        self.assertEqual(regular_pattern(rrule.MONTHLY, dtstart, {}), None)
+        self.assertEqual(regular_pattern(rrule.WEEKLY, dtstart, {'bymonth': 3}), None)
+        self.assertEqual(regular_pattern(rrule.DAILY, dtstart, {'byweekday': rrule.MO(2)}), None)
+        # never happens (dateutil would iterate forever)
+        self.assertEqual(regular_pattern(rrule.HOURLY, dtstart, {'interval': 24, 'byhour': 3}), None)
+
+    def test_age_doesnt_matter(self):
+        """
+        Expanding a window only computes the datetimes in it, however long
+        ago the rule started.
+        """
+        def expand(dtstart):
+            pattern = regular_pattern(rrule.DAILY, dtstart, {})
+            computed = []
+            datetime_at = pattern._datetime
+            def counting(n, j):
+                computed.append((n, j))
+                return datetime_at(n, j)
+            pattern._datetime = counting
+            return pattern.between(datetime(2026, 3, 1), datetime(2026, 4, 1)), len(computed)
+        recent, recent_work = expand(datetime(2026, 1, 1, 10, 0))
+        old, old_work = expand(datetime(1906, 1, 1, 10, 0))
+        self.assertEqual(old, recent)
+        self.assertEqual(len(old), 31)
+        # the 31 in the window, and the first one after it
+        self.assertEqual(old_work, 32)
+        self.assertEqual(recent_work, 32)
+
+    def test_indexing(self):
+        pattern = regular_pattern(rrule.WEEKLY, datetime(2010, 1, 6, 9, 0), {'byweekday': [0, 2], 'count': 10})
+        self.assertTrue(isinstance(pattern, RegularPattern))
+        self.assertEqual(pattern[0], datetime(2010, 1, 6, 9, 0))
+        self.assertEqual(pattern[1], datetime(2010, 1, 11, 9, 0))
+        self.assertEqual(pattern[-1], datetime(2010, 2, 8, 9, 0))
+        self.assertRaises(IndexError, lambda: pattern[10])
+
+
+class TestRandomAccess(unittest.TestCase):
+
+    def rules(self):
+        dtstart = datetime(2001, 3, 5, 9, 0)
+        return [
+            regular_pattern(rrule.WEEKLY, dtstart, {'byweekday': [0, 3]}),
+            rrule.rrule(rrule.MONTHLY, dtstart=dtstart, bymonthday=[5, 20]),
+            rrule.rrule(rrule.MONTHLY, dtstart=dtstart, byweekday=rrule.FR(-1), count=30),
+        ]
+
+    def test_same_as_iterating(self):
+        for rule in self.rules():
+            expected = list(islice(rule, 600))
+            for n in (0, 1, 29, 500, 7, 599):
+                if n < len(expected):
+                    self.assertEqual(nth(rule, n), expected[n])
+                    self.assertEqual(ordinal(rule, expected[n]), n)
+                    self.assertEqual(count_until(rule, expected[n]), n + 1)
+                else:
+                    self.assertRaises(IndexError, nth, rule, n)
+            self.assertRaises(ValueError, ordinal, rule, expected[0] + timedelta(minutes=1))
+            self.assertRaises(IndexError, nth, rule, -1)
+
+    def test_restarting_from_checkpoints(self):
+        dtstart = datetime(2001, 3, 5, 9, 0)
+        for rule in [
+            rrule.rrule(rrule.MONTHLY, dtstart=dtstart, interval=2, byweekday=rrule.FR, bysetpos=-1),
+            rrule.rrule(rrule.YEARLY, dtstart=dtstart, byeaster=[0, 1], until=datetime(2090, 1, 1)),
+            rrule.rrule(rrule.WEEKLY, dtstart=dtstart, interval=3, wkst=rrule.SU, count=70),
+        ]:
+            expected = list(islice(rule, 200))
+            checkpoint = IterationCheckpoint(rule, interval=7)
+            for n in (150, 3, 64, 0, 13, 14, 199, 69, 70):
+                if n < len(expected):
+                    self.assertEqual(checkpoint.nth(n), expected[n])
+                    self.assertEqual(checkpoint.index(expected[n]), n)
+                    self.assertEqual(checkpoint.count_until(expected[n] - timedelta(seconds=1)), n)
+                else:
+                    self.assertRaises(IndexError, checkpoint.nth, n)
+            # only every 7th datetime is kept, and those since the last one
+            self.assertEqual(checkpoint.checkpoints, expected[:200:7])
+            self.assertTrue(len(checkpoint._tail) <= 7)
@@ -0,0 +1,115 @@
+import datetime
+import time
+
+from django.http import HttpRequest
+from django.utils import simplejson
+
+from eventtools.tests.eventtools_testapp.models import *
+from eventtools.models import Rule, get_occurrences_for_events
+from eventtools import views
+from eventtools.views import CANCELLED, MOVED, VARIED, occurrences_json
+from _inject_app import TestCaseWithApp as TestCase
+
+
+def timestamp(value):
+    return int(time.mktime(value.timetuple()))
+
+
+class TestOccurrencesJSON(TestCase):
+
+    def setUp(self):
+        super(TestOccurrencesJSON, self).setUp() #monkeypatch in the test app
+        daily = Rule.objects.create(frequency = "DAILY")
+        weekly = Rule.objects.create(frequency = "WEEKLY", params = "byweekday:1,3")
+        self.lecture = LectureEvent.objects.create(title='Weekly lecture', location='Hall')
+        self.gen = self.lecture.create_generator(start=datetime.datetime(2010, 1, 5, 18, 0),
+            end=datetime.datetime(2010, 1, 5, 19, 0), rule=weekly)
+        self.talk = LectureEvent.objects.create(title='Daily talk', location='Foyer')
+        self.talk.create_generator(start=datetime.datetime(2010, 1, 1, 12, 0),
+            end=datetime.datetime(2010, 1, 1, 12, 30), rule=daily)
+        LectureEvent.objects.create(title='Not asked for')
+
+        occs = self.gen.get_occurrences(datetime.datetime(2010, 3, 1), datetime.datetime(2010, 3, 12))
+        occs[0].cancel()
+        moved = occs[1].promote()
+        moved.varied_start_time, moved.varied_end_time = datetime.time(20, 0), datetime.time(21, 0)
+        moved.save()
+        self.variation = self.lecture.create_variation(title='Guest lecture', reason='Guest')
+        varied = occs[2].promote()
+        varied.varied_event = self.variation
+        varied.save()
+        self.ids = [self.lecture.id, self.talk.id]
+
+    def get(self, **params):
+        request = HttpRequest()
+        request.method = 'GET'
+        request.GET.update(params)
+        response = occurrences_json(request, LectureEvent.objects.all(), fields=['title', 'location'])
+        return response, ''.join(response)
+
+    def test_format(self):
+        start, end = datetime.datetime(2010, 3, 1), datetime.datetime(2010, 3, 12)
+        (response, content), num_queries = self.count_queries(self.get, start='2010-03-01', end='2010-03-12',
+            events='%s,%s' % tuple(self.ids))
+        # events, their validators (one query per table), generators,
+        # exceptions and variations
+        self.assertEqual(num_queries, 1 + 5 + 3)
+        data = simplejson.loads(content)
+        self.assertEqual((data['start'], data['end']), (timestamp(start), timestamp(end)))
+        self.assertEqual(data['columns'], ['id', 'event', 'generator', 'start', 'end', 'flags', 'variation'])
+
+        expected = get_occurrences_for_events(LectureEvent.objects.filter(id__in=self.ids), start, end)
+        self.assertEqual(len(data['occurrences']), len(expected))
+        self.assertEqual([(row[1], row[2], row[3], row[4]) for row in data['occurrences']],
+            [(o.generator.event_id, o.generator_id, timestamp(o.start), timestamp(o.end)) for o in expected])
+        exceptions = [(row[5], row[6]) for row in data['occurrences'] if row[0] is not None]
+        self.assertEqual(exceptions, [(CANCELLED, None), (MOVED, None), (VARIED, self.variation.id)])
+
+        self.assertEqual(data['events'], {
+            str(self.lecture.id): {'title': 'Weekly lecture', 'location': 'Hall'},
+            str(self.talk.id): {'title': 'Daily talk', 'location': 'Foyer'},
+        })
+        self.assertEqual(data['variations'][str(self.variation.id)]['title'], 'Guest lecture')
+
+    def test_slices(self):
+        """
+        Expanded a slice at a time, the occurrences are still each written
+        once and in order, even those that span slices or were moved into
+        another.
+        """
+        self.talk.create_generator(start=datetime.datetime(2010, 3, 2, 22, 0),
+            end=datetime.datetime(2010, 3, 5, 2, 0))
+        moved = self.gen.get_occurrences(datetime.datetime(2010, 3, 11), datetime.datetime(2010, 3, 12))[0]
+        moved.varied_start_date = moved.varied_end_date = datetime.date(2010, 3, 8)
+        moved.save()
+        start, end = datetime.datetime(2010, 3, 1), datetime.datetime(2010, 3, 12)
+        expected = get_occurrences_for_events(LectureEvent.objects.filter(id__in=self.ids), start, end)
+        days_per_slice = views.DAYS_PER_SLICE
+        views.DAYS_PER_SLICE = 2
+        try:
+            content = self.get(start='2010-03-01', end='2010-03-12', events='%s,%s' % tuple(self.ids))[1]
+        finally:
+            views.DAYS_PER_SLICE = days_per_slice
+        self.assertEqual([(row[2], row[3], row[4]) for row in simplejson.loads(content)['occurrences']],
+            [(o.generator_id, timestamp(o.start), timestamp(o.end)) for o in expected])
+
+    def test_epoch_seconds_and_all_events(self):
+        start, end = datetime.datetime(2010, 3, 1), datetime.datetime(2010, 3, 12)
+        response, content = self.get(start=str(timestamp(start)), end=str(timestamp(end)))
+        data = simplejson.loads(content)
+        self.assertEqual(len(data['events']), 3)
+        self.assertEqual(len(data['occurrences']), 11 + 4)
+
+    def test_not_modified(self):
+        response, content = self.get(start='2010-03-01', end='2010-03-12')
+        request = HttpRequest()
+        request.method = 'GET'
+        request.GET.update({'start': '2010-03-01', 'end': '2010-03-12'})
+        request.META['HTTP_IF_NONE_MATCH'] = response['ETag']
+        self.assertEqual(occurrences_json(request, LectureEvent.objects.all()).status_code, 304)
+
+    def test_bad_requests(self):
+        for params in ({}, {'start': '2010-03-01'}, {'start': 'March', 'end': '2010-04-01'},
+                {'start': '2010-03-01', 'end': '2010-02-01'}, {'start': '2010-01-01', 'end': '2012-01-01'},
+                {'start': '2010-03-01', 'end': '2010-03-12', 'events': '1,a'}):
+            self.assertEqual(self.get(**params)[0].status_code, 400)
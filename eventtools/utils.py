@@ -1,9 +1,12 @@
+import array
 import datetime
 import heapq
+import threading
+from bisect import bisect_left, bisect_right
 from django.contrib.contenttypes.models import ContentType
 from django.http import HttpResponseRedirect
 from django.conf import settings
-from eventtools.conf.settings import CHECK_PERMISSION_FUNC
+from eventtools.conf.settings import CHECK_PERMISSION_FUNC, RRULE_CACHE_SIZE
 
 class EventListManager(object):
     """
@@ -14,39 +17,42 @@ class EventListManager(object):
     def __init__(self, events):
         self.events = events
 
-    # Not used - needs fixing to work with monkeypatched occurence models.
-    # def occurrences_after(self, after=None):
-    #      """
-    #      It is often useful to know what the next occurrence is given a list of
-    #      events.  This function produces a generator that yields the
-    #      the most recent occurrence after the date ``after`` from any of the
-    #      events in ``self.events``
-    #      """
-    #      from events.models import Occurrence
-    #      if after is None:
-    #          after = datetime.datetime.now()
-    #      occ_replacer = OccurrenceReplacer(
-    #          Occurrence.objects.filter(event__in = self.events))
-    #      generators = [event._occurrences_after_generator(after) for event in self.events]
-    #      occurrences = []
-    # 
-    #      for generator in generators:
-    #          try:
-    #              heapq.heappush(occurrences, (generator.next(), generator))
-    #          except StopIteration:
-    #              pass
-    # 
-    #      while True:
-    #          if len(occurrences) == 0: raise StopIteration
-    # 
-    #          generator=occurrences[0][1]
-    # 
-    #          try:
-    #              next = heapq.heapreplace(occurrences, (generator.next(), generator))[0]
-    #          except StopIteration:
-    #              next = heapq.heappop(occurrences)[0]
-    #          yield occ_replacer.get_occurrence(next)
- 
+    def occurrences_after(self, after=None):
+        """
+        It is often useful to know what the next occurrence is given a list of
+        events.  This function produces a generator that yields the
+        the most recent occurrence after the date ``after`` from any of the
+        events in ``self.events``
+        """
+        from eventtools.models import get_occurrences_after_for_events
+        events_by_model = {}
+        for event in self.events:
+            events_by_model.setdefault(event.__class__, []).append(event)
+        return merge_occurrences([get_occurrences_after_for_events(events, after) for
+            events in events_by_model.values()])
+
+
+def merge_occurrences(streams):
+    """
+    Lazily merges iterators of occurrences that are each in start order into
+    one in start order. Only one occurrence from each iterator is held at a
+    time.
+    """
+    heap = []
+    for n, stream in enumerate(streams):
+        for occ in stream:
+            heap.append((occ.start, occ.end, n, occ, stream))
+            break
+    heapq.heapify(heap)
+    while heap:
+        start, end, n, occ, stream = heap[0]
+        yield occ
+        for occ in stream:
+            heapq.heapreplace(heap, (occ.start, occ.end, n, occ, stream))
+            break
+        else:
+            heapq.heappop(heap)
+
 
 class OccurrenceReplacer(object):
     """
@@ -54,9 +60,12 @@ class OccurrenceReplacer(object):
     before passing it forward is to make sure all of the occurrences that
     have been stored in the datebase replace, in the list you are returning,
     the generated ones that are equivalent.  This class makes this easier.
+
+    Occurrences are matched on generator_id and their unvaried start and end,
+    so matching never touches (or queries for) related objects.
     """
     def __init__(self, exceptional_occurrences):
-        lookup = [((occ.generator.event, occ.original_start, occ.original_end), occ) for
+        lookup = [((occ.generator_id, occ.original_start, occ.original_end), occ) for
             occ in exceptional_occurrences]
         self.lookup = dict(lookup)
 
@@ -66,11 +75,11 @@ class OccurrenceReplacer(object):
         has already been matched
         """
         return self.lookup.pop(
-            (occ.generator.event, occ.original_start, occ.original_end),
+            (occ.generator_id, occ.original_start, occ.original_end),
             occ)
 
     def has_occurrence(self, occ):
-        return (occ.generator.event, occ.original_start, occ.original_end) in self.lookup
+        return (occ.generator_id, occ.original_start, occ.original_end) in self.lookup
 
     def get_additional_occurrences(self, start, end):
         """
@@ -79,6 +88,183 @@ class OccurrenceReplacer(object):
         return [occ for key,occ in self.lookup.items() if (occ.start < end and occ.end >= start and not occ.cancelled)]
 
 
+class OccurrenceIndex(object):
+    """
+    Finds the occurrences in a list that overlap a window in O(log n + k),
+    rather than by scanning the whole list.
+
+    Occurrences are grouped into classes of similar duration (within a factor
+    of two of each other) and each class is sorted by start. An occurrence
+    that overlaps a window can't have started more than its class's longest
+    duration before the window, which bounds the slice of each class to look
+    at, however long-running some of the occurrences are.
+
+    ``start`` and ``end`` record the window the occurrences were expanded for,
+    i.e. the windows the index can answer for.
+    """
+    def __init__(self, occurrences, start=None, end=None):
+        self.occurrences = list(occurrences)
+        self.start = start
+        self.end = end
+        classes = {}
+        for i, occ in enumerate(self.occurrences):
+            duration = occ.end - occ.start
+            seconds = max(0, duration.days * 86400 + duration.seconds)
+            classes.setdefault(seconds.bit_length(), []).append((occ.start, i))
+        self._classes = []
+        for entries in classes.values():
+            entries.sort()
+            longest = max([self.occurrences[i].end - self.occurrences[i].start for start, i in entries])
+            self._classes.append((longest, [start for start, i in entries], [i for start, i in entries]))
+
+    def overlapping(self, start, end):
+        """
+        Returns the occurrences for which ``occ.start <= end`` and
+        ``occ.end >= start``, in their original order.
+        """
+        found = []
+        for longest, starts, positions in self._classes:
+            for k in xrange(bisect_left(starts, start - longest), bisect_right(starts, end)):
+                if self.occurrences[positions[k]].end >= start:
+                    found.append(positions[k])
+        found.sort()
+        return [self.occurrences[i] for i in found]
+
+
+def _microseconds(delta):
+    return (delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds
+
+class OccurrenceHistogram(object):
+    """
+    Counts the occurrences that overlap each of a row of equal, half-open bins
+    (``[start, start + size)``, ``[start + size, start + 2 * size)``... up to
+    ``end``), from their start and end datetimes. An occurrence that lasts no
+    time counts in the bin it starts in.
+
+    Counts are kept as differences between neighbouring bins, so adding an
+    occurrence costs the same however many bins it spans.
+    """
+    def __init__(self, start, end, size):
+        self.start = start
+        self.end = end
+        self.size = _microseconds(size)
+        self.bins = max(0, -(-_microseconds(end - start) // self.size))
+        self._differences = [0] * (self.bins + 1)
+
+    def add(self, start, end, weight=1):
+        first = _microseconds(start - self.start) // self.size
+        if end > start:
+            last = -(-_microseconds(end - self.start) // self.size) - 1
+        else:
+            last = first
+        first, last = max(first, 0), min(last, self.bins - 1)
+        if first <= last:
+            self._differences[first] += weight
+            self._differences[last + 1] -= weight
+
+    def add_pattern(self, pattern, duration, until):
+        """
+        Adds an occurrence lasting ``duration`` at each datetime of
+        ``pattern`` (a RegularPattern) up to and including ``until``, counting
+        those of each bin with ``pattern.count_between``. This costs the same
+        however many occurrences there are.
+        """
+        size = datetime.timedelta(microseconds=self.size)
+        # an occurrence overlaps a bin if it starts before the bin ends and
+        # after the bin starts less its duration (or, if it lasts no time, at
+        # or after the bin starts)
+        lead = max(duration, datetime.timedelta(microseconds=1))
+        last = until + datetime.timedelta(microseconds=1)
+        for i in range(self.bins):
+            bin_start = self.start + size * i
+            count = pattern.count_between(bin_start - lead, min(bin_start + size, last))
+            if count:
+                self._differences[i] += count
+                self._differences[i + 1] -= count
+
+    def counts(self):
+        """
+        Returns the count of each bin, as an array of integers.
+        """
+        counts = array.array('l')
+        count = 0
+        for difference in self._differences[:-1]:
+            count += difference
+            counts.append(count)
+        return counts
+
+
+class RRuleCache(object):
+    """
+    A bounded, least-recently-used store of compiled dateutil rules.
+
+    Compiling a Rule (splitting its params, or parsing its complex_rule, and
+    building the rruleset) costs far more than iterating the result, and the
+    same rule is compiled over and over while rendering a calendar. Entries are
+    keyed by the rule's id, its content (so an edited but unsaved rule never
+    sees a stale entry) and the dtstart it was compiled for.
+    """
+    def __init__(self, size):
+        self.size = size
+        self._entries = {}
+        self._clock = 0
+        self._lock = threading.Lock()
+
+    def _key(self, rule, dtstart):
+        return (rule.id, rule.frequency, rule.params, rule.complex_rule, dtstart)
+
+    def get(self, rule, dtstart):
+        """
+        Return the compiled rrule for ``rule`` starting at ``dtstart``,
+        compiling (and storing) it if it isn't cached yet.
+        """
+        if self.size <= 0:
+            return rule.compile(dtstart)
+        key = self._key(rule, dtstart)
+        self._clock += 1
+        entry = self._entries.get(key)
+        if entry is not None:
+            entry[0] = self._clock
+            return entry[1]
+        compiled = rule.compile(dtstart)
+        self._lock.acquire()
+        try:
+            self._entries[key] = [self._clock, compiled]
+            if len(self._entries) > self.size:
+                self._evict()
+        finally:
+            self._lock.release()
+        return compiled
+
+    def _evict(self):
+        # drop the least recently used quarter in one go, so that eviction
+        # doesn't cost a sort on every miss once the cache is full.
+        entries = sorted(self._entries.items(), key=lambda item: item[1][0])
+        for key, entry in entries[:len(entries) - (self.size * 3 / 4)]:
+            del self._entries[key]
+
+    def invalidate(self, rule_id=None):
+        """
+        Forget every entry compiled from the rule with id ``rule_id``, or
+        everything if no id is given.
+        """
+        self._lock.acquire()
+        try:
+            if rule_id is None:
+                self._entries.clear()
+            else:
+                for key in self._entries.keys():
+                    if key[0] == rule_id:
+                        del self._entries[key]
+        finally:
+            self._lock.release()
+
+    def __len__(self):
+        return len(self._entries)
+
+rrule_cache = RRuleCache(RRULE_CACHE_SIZE)
+
+
 class check_event_permissions(object):
 
     def __init__(self, f):
@@ -98,6 +284,18 @@ class check_event_permissions(object):
         return self.f(request, *args, **kwargs)
 
 
+def bulk_create(model, objects):
+    """
+    Insert unsaved ``objects`` of ``model`` in as few queries as the installed
+    version of Django allows.
+    """
+    if hasattr(model.objects, 'bulk_create'):
+        model.objects.bulk_create(objects)
+    else:
+        for obj in objects:
+            obj.save(force_insert=True)
+
+
 def coerce_date_dict(date_dict):
     """
     given a dictionary (presumed to be from request.GET) it returns a tuple
@@ -0,0 +1,158 @@
+"""
+Views that serve occurrences to scripts rather than to templates.
+"""
+import time
+from datetime import datetime, timedelta
+from django.core.serializers.json import DjangoJSONEncoder
+from django.http import HttpResponse, HttpResponseBadRequest
+from django.utils import simplejson
+from django.views.decorators.http import condition
+from eventtools.caching import get_validators
+from eventtools.models import SlidingExpansion
+
+# bits of an occurrence's flags
+CANCELLED = 1
+MOVED = 2
+VARIED = 4
+
+COLUMNS = ('id', 'event', 'generator', 'start', 'end', 'flags', 'variation')
+
+# occurrences written to the response at a time
+ROWS_PER_CHUNK = 500
+
+# days of occurrences expanded at a time
+DAYS_PER_SLICE = 31
+
+def _timestamp(value):
+    return int(time.mktime(value.timetuple()))
+
+def _parse_time(value):
+    if value.isdigit():
+        return datetime.fromtimestamp(int(value))
+    for format in ('%Y-%m-%dT%H:%M:%S', '%Y-%m-%dT%H:%M', '%Y-%m-%d'):
+        try:
+            return datetime.strptime(value, format)
+        except ValueError:
+            pass
+    raise ValueError("Not a time: %r" % value)
+
+def _values(instance, fields):
+    if fields is None:
+        fields = [field.name for field in instance._meta.fields if not field.rel]
+    return dict([(name, getattr(instance, name)) for name in fields])
+
+def occurrences_json(request, queryset, fields=None, variation_fields=None, max_days=366):
+    """
+    Returns the occurrences between the ``start`` and ``end`` in the query
+    string (as YYYY-MM-DD, YYYY-MM-DDTHH:MM[:SS] or seconds since the epoch)
+    of the events in ``queryset``, or of those of them whose ids are in
+    ``events`` (e.g. ``events=1,2,5``), as JSON::
+
+        {"start": 1267401600, "end": 1270080000,
+         "columns": ["id", "event", "generator", "start", "end", "flags", "variation"],
+         "occurrences": [[null, 1, 1, 1267466400, 1267470000, 0, null],
+                         [12, 1, 1, 1267653600, 1267657200, 6, 3], ...],
+         "events": {"1": {"title": "Weekly lecture", ...}, ...},
+         "variations": {"3": {"title": "Guest lecture", ...}}}
+
+    Each occurrence is an array in the order of ``columns``: the id of its
+    exceptional occurrence (or null), its event and generator, its start
+    and end in seconds since the epoch, its flags (CANCELLED, MOVED and
+    VARIED) and the id of its variation (or null). The ``fields`` of each
+    event and the ``variation_fields`` of each variation (by default, all
+    but relations) are written once, after the occurrences.
+
+    The occurrences are those ``get_occurrences_for_events`` returns, in the
+    same order, but they are expanded ``DAYS_PER_SLICE`` days at a time (see
+    ``SlidingExpansion``) and written a chunk at a time, so the first are
+    sent before the last are found. The variations are read in one query.
+    Requests are answered with a 304 if the events haven't changed since
+    the client's copy (see ``eventtools.caching.get_validators``).
+
+    For example, in a URLconf::
+
+        (r'^lectures/occurrences.json$', 'eventtools.views.occurrences_json',
+            {'queryset': LectureEvent.objects.all(), 'fields': ['title']}),
+    """
+    try:
+        start = _parse_time(request.GET['start'])
+        end = _parse_time(request.GET['end'])
+    except (KeyError, ValueError):
+        return HttpResponseBadRequest("start and end are required, as YYYY-MM-DD, YYYY-MM-DDTHH:MM[:SS] or seconds since the epoch")
+    if end < start or end - start > timedelta(days=max_days):
+        return HttpResponseBadRequest("end must be after start, and at most %s days after it" % max_days)
+    if request.GET.get('events'):
+        try:
+            queryset = queryset.filter(id__in=[int(id) for id in request.GET['events'].split(',')])
+        except ValueError:
+            return HttpResponseBadRequest("events must be a comma-separated list of ids")
+    events = list(queryset)
+
+    etag, last_modified = get_validators(events)
+    def respond(request):
+        return HttpResponse(_occurrences_json(events, start, end, fields, variation_fields),
+            mimetype='application/json')
+    return condition(lambda request: etag, lambda request: last_modified)(respond)(request)
+
+def _occurrences(events, start, end):
+    """
+    Yields the sorted occurrences of ``events`` between ``start`` and ``end``,
+    expanding a slice of the window at a time. Each slice yields the
+    occurrences that start in it (the first, also those that started before
+    the window), so none is yielded twice and they stay in order.
+    """
+    expansion = SlidingExpansion(events)
+    slice_start = start
+    while True:
+        slice_end = min(slice_start + timedelta(days=DAYS_PER_SLICE), end)
+        last = slice_end == end
+        for occ in expansion.get_occurrences(slice_start, slice_end):
+            if (occ.start < slice_start and slice_start != start) or (occ.start >= slice_end and not last):
+                continue
+            yield occ
+        if last:
+            return
+        slice_start = slice_end
+
+def _occurrences_json(events, start, end, fields, variation_fields):
+    yield '{"start": %d, "end": %d, "columns": %s, "occurrences": [' % (
+        _timestamp(start), _timestamp(end), simplejson.dumps(COLUMNS))
+    variation_ids = set()
+    rows = []
+    separator = ''
+    for occ in _occurrences(events, start, end):
+        generator = occ.generator
+        if occ.id is None:
+            # generated, so there is nothing else to look up (and asking
+            # would make a model instance of it)
+            occurrence_id = variation_id = 'null'
+            flags = 0
+        else:
+            occurrence_id = occ.id
+            flags = occ.cancelled and CANCELLED or 0
+            if occ.is_moved:
+                flags |= MOVED
+            variation_id = getattr(occ, '_varied_event_id', None)
+            if variation_id is None:
+                variation_id = 'null'
+            else:
+                flags |= VARIED
+                variation_ids.add(variation_id)
+        rows.append('[%s,%d,%d,%d,%d,%d,%s]' % (occurrence_id, generator.event_id, generator.id,
+            _timestamp(occ.start), _timestamp(occ.end), flags, variation_id))
+        if len(rows) == ROWS_PER_CHUNK:
+            yield separator + ','.join(rows)
+            separator = ','
+            rows = []
+    if rows:
+        yield separator + ','.join(rows)
+
+    event_values = dict([(event.id, _values(event, fields)) for event in events])
+    variation_values = {}
+    if variation_ids:
+        VariationModel = events[0].OccurrenceModel._meta.get_field('_varied_event').rel.to
+        for variation in VariationModel.objects.filter(id__in=variation_ids):
+            variation_values[variation.id] = _values(variation, variation_fields)
+    yield '], "events": %s, "variations": %s}' % (
+        simplejson.dumps(event_values, cls=DjangoJSONEncoder),
+        simplejson.dumps(variation_values, cls=DjangoJSONEncoder))